@@ -225,6 +225,52 @@ def purge_queues():
     utils.purge_queues()
 
 
+@harvester.group()
+def dlq():
+    """Manage the dead letter queue, where the harvest objects that failed
+    to be fetched too many times are sent.
+    """
+    pass
+
+
+@dlq.command("list")
+@click.option("-l", "--limit", type=click.IntRange(min=1),
+              help="Maximum number of messages to list")
+@click.pass_context
+def dlq_list(ctx, limit):
+    """Lists the messages on the dead letter queue, with their last error.
+    """
+    flask_app = ctx.meta["flask_app"]
+    with flask_app.test_request_context():
+        result = utils.list_dead_letters(limit)
+    click.echo(result)
+
+
+@dlq.command("replay")
+@click.option("-l", "--limit", type=click.IntRange(min=1),
+              help="Maximum number of messages to replay")
+@click.pass_context
+def dlq_replay(ctx, limit):
+    """Sends the messages on the dead letter queue back to the fetch queue.
+
+    Their harvest objects are set back to WAITING. Note that objects of
+    jobs that have finished will be set to ERROR again by the fetch
+    consumer.
+    """
+    flask_app = ctx.meta["flask_app"]
+    with flask_app.test_request_context():
+        count = utils.replay_dead_letters(limit)
+    click.echo("Sent {0} messages back to the fetch queue".format(count))
+
+
+@dlq.command("purge")
+def dlq_purge():
+    """Removes all the messages from the dead letter queue.
+    """
+    count = utils.purge_dead_letters()
+    click.echo("Removed {0} messages from the dead letter queue".format(count))
+
+
 @harvester.command()
 def gather_consumer():
     """Starts the consumer for the gathering queue.
@@ -234,11 +280,61 @@ def gather_consumer():
 
 
 @harvester.command()
-def fetch_consumer():
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of threads handling messages in each consumer process",
+)
+@click.option(
+    "-p",
+    "--processes",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of consumer processes to fork",
+)
+@click.option(
+    "-a",
+    "--async-fetches",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Number of objects fetched at the same time by each consumer "
+    "process, with the harvesters that implement async_fetch_stage",
+)
+@click.option(
+    "-b",
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of messages taken off the queue and acknowledged together",
+)
+def fetch_consumer(workers, processes, async_fetches, batch_size):
     """Starts the consumer for the fetching queue.
 
+    Use --workers to fetch and import several objects at the same time
+    on a pool of threads, and --processes to run several consumers from
+    a single command.
+
+    Use --async-fetches instead of --workers for harvesters that
+    implement async_fetch_stage.
+
+    Use --batch-size to take several messages off the queue at once,
+    which saves round trips to the queue backend when the harvest
+    objects are quick to fetch and import.
+
     """
-    utils.fetch_consumer()
+    if async_fetches and workers > 1:
+        tk.error_shout("--workers and --async-fetches can not be combined")
+        raise click.Abort()
+    if batch_size > 1 and (async_fetches or workers > 1):
+        tk.error_shout(
+            "--batch-size can not be combined with --workers or --async-fetches")
+        raise click.Abort()
+    utils.fetch_consumer(workers, processes, async_fetches, batch_size)
 
 
 @harvester.command()
@@ -371,6 +467,23 @@ def job_all(ctx):
     click.echo(result)
 
 
+@harvester.command("reconcile-job-stats")
+@click.option("--job-id", help="Only count the stats of this job")
+@click.pass_context
+def reconcile_job_stats(ctx, job_id):
+    """Counts the stats of the harvest jobs again.
+
+    The stats are kept up to date as the harvest objects change. Run this
+    after upgrading, to count them for the existing jobs, or if they ever
+    drift, eg after changing objects with bulk updates.
+
+    """
+    flask_app = ctx.meta["flask_app"]
+    with flask_app.test_request_context():
+        result = utils.reconcile_job_stats(job_id)
+    click.echo(result)
+
+
 @harvester.command()
 @click.pass_context
 def reindex(ctx):
@@ -382,6 +495,24 @@ def reindex(ctx):
         utils.reindex()
 
 
+@harvester.command("search-index-rebuild")
+@click.option("-o", "--only-missing", is_flag=True,
+              help="Index non indexed datasets only")
+@click.option("-f", "--force", is_flag=True,
+              help="Ignore exceptions when rebuilding the index")
+@click.pass_context
+def search_index_rebuild(ctx, only_missing, force):
+    """Rebuilds the search index of all the datasets.
+
+    Like `ckan search-index rebuild`, but loads the harvest metadata of all
+    the harvested datasets with one query, instead of one query per dataset.
+
+    """
+    flask_app = ctx.meta["flask_app"]
+    with flask_app.test_request_context():
+        utils.search_index_rebuild(only_missing, force)
+
+
 @harvester.command("harvesters_info")
 @click.pass_context
 def harvesters_info(ctx):
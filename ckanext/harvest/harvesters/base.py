@@ -1,21 +1,39 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import datetime
+import hashlib
+import itertools
+import json
 import logging
+import os
 import re
+import threading
+import time
 import uuid
+from urllib.parse import urlsplit
 
+import requests
+from requests.adapters import HTTPAdapter
 import sqlalchemy as sa
 from sqlalchemy.orm import contains_eager
+from urllib3.util.retry import Retry
 
 from ckantoolkit import config
 
 from ckan import plugins as p
 from ckan import model
 from ckan.model import Session, Package, PACKAGE_NAME_MAX_LENGTH
+from ckan.model.types import make_uuid
 
 from ckan.logic.schema import default_create_package_schema
 from ckan.lib.navl.validators import ignore_missing, ignore
 from ckan.lib.munge import munge_title_to_name, munge_tag
+try:
+    from ckan.lib.signals import action_succeeded
+except ImportError:
+    # CKAN <= 2.9
+    action_succeeded = None
 
 from ckanext.harvest.model import (HarvestObject, HarvestGatherError,
                                    HarvestObjectError, HarvestJob)
@@ -27,6 +45,39 @@ from ckanext.harvest.logic.schema import unicode_safe
 
 log = logging.getLogger(__name__)
 
+HTTP_TIMEOUT = 60
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_POOL_SIZE = 10
+# Responses worth retrying, besides connection errors
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# requests sessions, per process and remote site
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+LOOKUP_CACHE_TTL = 300
+# Number of jobs whose lookup caches are kept
+LOOKUP_CACHE_JOBS = 10
+# Number of lookups between the log messages with the hit rate
+LOOKUP_CACHE_REPORT_EVERY = 1000
+# Actions after which the lookup caches are cleared
+LOOKUP_CACHE_CLEARED_BY = frozenset([
+    'group_create', 'group_update', 'group_patch', 'group_delete',
+    'group_purge', 'organization_create', 'organization_update',
+    'organization_patch', 'organization_delete', 'organization_purge'])
+
+# Number of parsed source configurations kept
+SOURCE_CONFIG_CACHE_SIZE = 100
+
+# SourceConfig per source id and hash of the configuration, oldest first
+_source_configs = collections.OrderedDict()
+_source_configs_lock = threading.Lock()
+
+# LookupCache per harvest job id, oldest first
+_lookup_caches = collections.OrderedDict()
+_lookup_caches_lock = threading.Lock()
+
 
 class HarvesterBase(SingletonPlugin):
     '''
@@ -40,6 +91,10 @@ class HarvesterBase(SingletonPlugin):
 
     config = None
 
+    # Number of harvest objects inserted at once by
+    # _create_harvest_objects_in_bulk
+    object_batch_size = 1000
+
     _user_name = None
 
     @classmethod
@@ -189,6 +244,85 @@ class HarvesterBase(SingletonPlugin):
 
         return self._user_name
 
+    def _get_http_session(self, url):
+        '''
+        Returns the requests Session to use for requests to ``url``.
+
+        There is one session per remote site (scheme and host), shared by all
+        the harvesters and threads of the process, so the connections are
+        kept alive between requests. Responses are requested compressed,
+        and failed requests (connection errors and the statuses in
+        ``HTTP_RETRY_STATUSES``) are retried with an exponential backoff,
+        using these config options:
+
+           ckan.harvest.http.retries = 3
+           ckan.harvest.http.backoff_factor = 0.5
+
+        Pass ``timeout=self._get_http_timeout()`` to each request.
+        '''
+        parts = urlsplit(url)
+        key = (os.getpid(), parts.scheme, parts.netloc)
+        with _http_sessions_lock:
+            session = _http_sessions.get(key)
+            if session is None:
+                session = _http_sessions[key] = _create_http_session()
+        return session
+
+    def _get_http_timeout(self):
+        '''
+        Returns the timeout, in seconds, of the HTTP requests to the remote
+        site, from the ``ckan.harvest.http.timeout`` config option (60 by
+        default, 0 for no timeout).
+        '''
+        return _config_number('ckan.harvest.http.timeout', HTTP_TIMEOUT,
+                              float) or None
+
+    def _get_source_config(self, source):
+        '''
+        Returns the SourceConfig of a harvest source, with its configuration
+        already parsed.
+
+        It is only parsed again if the configuration of the source changes,
+        not for every harvest object.
+        '''
+        config_str = source.config or ''
+        key = (source.id, get_config_hash(config_str))
+        with _source_configs_lock:
+            source_config = _source_configs.get(key)
+            if source_config is not None:
+                _source_configs.move_to_end(key)
+                return source_config
+        source_config = SourceConfig(source.id, config_str)
+        with _source_configs_lock:
+            _source_configs[key] = source_config
+            while len(_source_configs) > SOURCE_CONFIG_CACHE_SIZE:
+                _source_configs.popitem(last=False)
+        return source_config
+
+    def _get_lookup_cache(self, harvest_job_id):
+        '''
+        Returns the LookupCache of a harvest job, to remember the results of
+        the lookups done for every object of the job (eg whether a group
+        exists) during ``ckan.harvest.lookup_cache_ttl`` seconds (300 by
+        default, 0 to disable it).
+
+        The caches of all the jobs are cleared when a group or an organization
+        is created in this process. This relies on the signals of CKAN 2.10,
+        so on older versions nothing is cached.
+        '''
+        with _lookup_caches_lock:
+            cache = _lookup_caches.get(harvest_job_id)
+            if cache is None:
+                ttl = _config_number('ckan.harvest.lookup_cache_ttl',
+                                     LOOKUP_CACHE_TTL, float)
+                cache = _lookup_caches[harvest_job_id] = LookupCache(
+                    'job %s' % harvest_job_id,
+                    ttl if action_succeeded is not None else 0)
+                while len(_lookup_caches) > LOOKUP_CACHE_JOBS:
+                    _, old_cache = _lookup_caches.popitem(last=False)
+                    old_cache.report()
+        return cache
+
     def _create_harvest_objects(self, remote_ids, harvest_job):
         '''
         Given a list of remote ids and a Harvest Job, create as many Harvest Objects and
@@ -199,16 +333,87 @@ class HarvesterBase(SingletonPlugin):
         try:
             object_ids = []
             if len(remote_ids):
-                for remote_id in remote_ids:
-                    # Create a new HarvestObject for this identifier
-                    obj = HarvestObject(guid=remote_id, job=harvest_job)
-                    obj.save()
-                    object_ids.append(obj.id)
+                for ids in self._create_harvest_objects_in_bulk(
+                        harvest_job, ((remote_id, None) for remote_id in remote_ids)):
+                    object_ids.extend(ids)
                 return object_ids
             else:
                 self._save_gather_error('No remote datasets could be identified', harvest_job)
         except Exception as e:
-            self._save_gather_error('%r' % e.message, harvest_job)
+            self._save_gather_error('%r' % e, harvest_job)
+
+    def _create_harvest_objects_in_bulk(self, harvest_job, objects):
+        '''
+        Creates a Harvest Object for each ``(guid, content)`` or
+        ``(guid, content, metadata_modified_date)`` tuple in ``objects``
+        (which can be any iterable, eg a generator), inserting
+        ``object_batch_size`` of them with a single statement and committing
+        each batch, instead of saving every object on its own.
+
+        This is a generator that yields the list of ids of each batch as soon
+        as it has been committed, so they can be sent to the fetch queue while
+        the next batch is created.
+
+        Note that the objects are inserted without going through the ORM, so
+        they don't get any HarvestObjectExtra and any object added to the
+        session before is committed with the first batch.
+        '''
+        table = HarvestObject.__table__
+        config_hash = get_config_hash(harvest_job.source.config)
+        objects = iter(objects)
+        while True:
+            batch = list(itertools.islice(objects, self.object_batch_size))
+            if not batch:
+                break
+            gathered = datetime.datetime.utcnow()
+            rows = [{
+                'id': make_uuid(),
+                'guid': obj[0],
+                'content': obj[1],
+                'metadata_modified_date': obj[2] if len(obj) > 2 else None,
+                'config_hash': config_hash,
+                'gathered': gathered,
+                'state': 'WAITING',
+                'current': False,
+                'retry_times': 0,
+                'harvest_job_id': harvest_job.id,
+                'harvest_source_id': harvest_job.source_id,
+            } for obj in batch]
+            try:
+                Session.execute(table.insert(), rows)
+                Session.commit()
+            except Exception:
+                Session.rollback()
+                raise
+            log.debug('Created %d harvest objects for job %s',
+                      len(rows), harvest_job.id)
+            yield [row['id'] for row in rows]
+
+    def _get_current_modified_dates(self, harvest_source):
+        '''
+        Returns a dict with the ``metadata_modified_date`` of the current
+        harvest object of each guid of a source, ie the modification date of
+        the remote record when its dataset was last created or updated, so
+        the records that haven't changed since can be skipped in the gather
+        stage.
+
+        Guids without a date are left out, as well as those gathered with
+        another configuration of the source, or whose dataset has been
+        changed or deleted locally since it was imported.
+        '''
+        query = Session.query(
+            HarvestObject.guid, HarvestObject.metadata_modified_date
+        ).join(
+            Package, Package.id == HarvestObject.package_id
+        ).filter(
+            HarvestObject.harvest_source_id == harvest_source.id,
+            HarvestObject.current == True,  # noqa: E712
+            HarvestObject.metadata_modified_date != None,  # noqa: E711
+            HarvestObject.config_hash == get_config_hash(harvest_source.config),
+            Package.state == 'active',
+            Package.metadata_modified <= HarvestObject.import_finished
+        )
+        return dict(query)
 
     def _create_or_update_package(self, package_dict, harvest_object,
                                   package_dict_form='rest'):
@@ -415,3 +620,149 @@ class HarvesterBase(SingletonPlugin):
         for job in jobs:
             if len(job.objects) == 0:
                 return job
+
+
+class SourceConfig(object):
+    '''
+    The configuration of a harvest source, parsed, and the values derived
+    from it that are used for every harvest object:
+
+    * ``config``: the parsed configuration (an empty dict if there is none,
+      or if it isn't a JSON object). It is shared, so it must not be
+      modified.
+    * ``default_group_dicts``: the local groups of ``default_groups``, as
+      stored by ``validate_config``.
+    * ``default_extras``: list of ``(key, value)`` tuples of the
+      ``default_extras``, with ``value`` a ``string.Formatter`` template when
+      it is a string (see ``format_extra``).
+    '''
+
+    def __init__(self, source_id, config_str):
+        self.source_id = source_id
+        self.config = {}
+        if config_str:
+            try:
+                self.config = json.loads(config_str)
+            except ValueError:
+                log.warning('The configuration of harvest source %s is not '
+                            'JSON', source_id)
+            if not isinstance(self.config, dict):
+                self.config = {}
+        self.default_group_dicts = self.config.get('default_group_dicts') or []
+        default_extras = self.config.get('default_extras')
+        self.default_extras = list(default_extras.items()) \
+            if isinstance(default_extras, dict) else []
+
+    @staticmethod
+    def format_extra(value, harvest_object, dataset_id):
+        '''
+        Replaces the ``{harvest_source_id}``, ``{harvest_source_url}``,
+        ``{harvest_source_title}``, ``{harvest_job_id}``,
+        ``{harvest_object_id}`` and ``{dataset_id}`` placeholders of a default
+        extra value.
+        '''
+        if not isinstance(value, str):
+            return value
+        source = harvest_object.job.source
+        return value.format(
+            harvest_source_id=source.id,
+            harvest_source_url=source.url.strip('/'),
+            harvest_source_title=source.title,
+            harvest_job_id=harvest_object.job.id,
+            harvest_object_id=harvest_object.id,
+            dataset_id=dataset_id)
+
+
+class LookupCache(object):
+    '''
+    Remembers the values returned by lookup functions for ``ttl`` seconds,
+    and counts how many lookups were answered from the cache.
+    '''
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, lookup):
+        '''
+        Returns the value cached for ``key``, or else calls ``lookup()`` and
+        caches the value it returns. None and exceptions are not cached, as
+        whatever wasn't found may be created meanwhile, eg by another process.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._values.get(key)
+            hit = entry is not None and entry[0] > now
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            lookups = self.hits + self.misses
+        if lookups % LOOKUP_CACHE_REPORT_EVERY == 0:
+            self.report()
+        if hit:
+            return entry[1]
+
+        value = lookup()
+        if self.ttl and value is not None:
+            with self._lock:
+                self._values[key] = (now + self.ttl, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def report(self):
+        log.info('Lookup cache of %s: %d lookups, %.1f%% from the cache',
+                 self.name, self.hits + self.misses, self.hit_rate * 100)
+
+
+def get_config_hash(config_str):
+    '''
+    Returns the digest of the configuration of a harvest source.
+    '''
+    return hashlib.sha1((config_str or '').encode('utf-8')).hexdigest()
+
+
+def _clear_lookup_caches(sender, **kwargs):
+    if sender in LOOKUP_CACHE_CLEARED_BY:
+        with _lookup_caches_lock:
+            caches = list(_lookup_caches.values())
+        for cache in caches:
+            cache.clear()
+
+
+if action_succeeded is not None:
+    action_succeeded.connect(_clear_lookup_caches)
+
+
+def _config_number(key, default, type_=int):
+    try:
+        return max(0, type_(config.get(key, default)))
+    except (TypeError, ValueError):
+        return default
+
+
+def _create_http_session():
+    retries = Retry(
+        total=_config_number('ckan.harvest.http.retries', HTTP_RETRIES),
+        backoff_factor=_config_number('ckan.harvest.http.backoff_factor',
+                                      HTTP_BACKOFF_FACTOR, float),
+        status_forcelist=HTTP_RETRY_STATUSES,
+        raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retries, pool_maxsize=HTTP_POOL_SIZE)
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
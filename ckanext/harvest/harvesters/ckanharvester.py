@@ -1,8 +1,11 @@
 from __future__ import absolute_import
-import requests
 from requests.exceptions import HTTPError, RequestException
 
+import collections
+import copy
 import datetime
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 from urllib.parse import urlencode
 from ckan import model
@@ -10,12 +13,15 @@ from ckan.logic import ValidationError, NotFound, get_action
 from ckan.lib.helpers import json
 from ckan.plugins import toolkit
 
-from ckanext.harvest.model import HarvestObject
-from .base import HarvesterBase
+from .base import HarvesterBase, HTTP_POOL_SIZE
 
 import logging
 log = logging.getLogger(__name__)
 
+# Number of datasets requested per page of the remote search. CKAN caps it
+# to its ckan.search.rows_max option (1000 by default)
+SEARCH_ROWS = 1000
+
 
 class CKANHarvester(HarvesterBase):
     '''
@@ -45,7 +51,8 @@ class CKANHarvester(HarvesterBase):
             headers['Authorization'] = api_key
 
         try:
-            http_request = requests.get(url, headers=headers)
+            http_request = self._get_http_session(url).get(
+                url, headers=headers, timeout=self._get_http_timeout())
         except HTTPError as e:
             raise ContentFetchError('HTTP error: %s %s' % (e.response.status_code, e.request.url))
         except RequestException as e:
@@ -89,6 +96,17 @@ class CKANHarvester(HarvesterBase):
         else:
             self.config = {}
 
+    def _set_source_config(self, source):
+        '''Like _set_config, but using the parsed configuration of the
+        source if it hasn't changed. Returns its SourceConfig.'''
+        source_config = self._get_source_config(source)
+        # Shared by all the objects of the source, so it must not be modified,
+        # and the values added to the package dicts are copied
+        self.config = source_config.config
+        if 'api_version' in self.config:
+            self.api_version = int(self.config['api_version'])
+        return source_config
+
     def info(self):
         return {
             'name': 'ckan',
@@ -164,6 +182,14 @@ class CKANHarvester(HarvesterBase):
                 except NotFound:
                     raise ValueError('User not found')
 
+            for key in ('search_rows', 'search_concurrency'):
+                if key in config_obj:
+                    try:
+                        if int(config_obj[key]) < 1:
+                            raise ValueError
+                    except (TypeError, ValueError):
+                        raise ValueError('%s must be a positive integer' % key)
+
             for key in ('read_only', 'force_all'):
                 if key in config_obj:
                     if not isinstance(config_obj[key], bool):
@@ -182,12 +208,42 @@ class CKANHarvester(HarvesterBase):
         return package_dict
 
     def gather_stage(self, harvest_job):
+        object_ids = self._gather_stage(harvest_job)
+        if object_ids is None or isinstance(object_ids, list):
+            return object_ids
+        return [id for ids in object_ids for id in ids]
+
+    def iter_gather_stage(self, harvest_job):
+        '''Like gather_stage, but yields the ids of the harvest objects in
+        batches as they are created, while paging through the remote search.
+
+        If a page of the search fails after the first one, the error is saved
+        as a gather error and the objects created until then are still
+        fetched and imported. The job is then not error free, so the next one
+        asks again for everything modified since the last error free job.'''
+        if type(self).gather_stage is not CKANHarvester.gather_stage:
+            # Don't bypass the gather_stage of subclasses
+            object_ids = self.gather_stage(harvest_job)
+        else:
+            object_ids = self._gather_stage(harvest_job)
+        if object_ids is None:
+            yield None
+        elif isinstance(object_ids, list):
+            if object_ids:
+                yield object_ids
+        else:
+            for ids in object_ids:
+                yield ids
+
+    def _gather_stage(self, harvest_job):
+        '''Returns None if the gather stage failed, a list of ids, or a
+        generator of lists of ids of the objects created while paging.'''
         log.debug('In CKANHarvester gather_stage (%s)',
                   harvest_job.source.url)
         toolkit.requires_ckan_version(min_version='2.0')
         get_all_packages = True
 
-        self._set_config(harvest_job.source.config)
+        self._set_source_config(harvest_job.source)
 
         # Get source URL
         remote_ckan_base_url = harvest_job.source.url.rstrip('/')
@@ -234,15 +290,16 @@ class CKANHarvester(HarvesterBase):
                 .format(since=get_changes_since)
 
             try:
-                pkg_dicts = self._search_for_datasets(
+                pages = self._search_for_datasets_in_pages(
                     remote_ckan_base_url,
                     fq_terms + [fq_since_last_time])
+                first_page = next(pages, [])
             except SearchError as e:
                 log.info('Searching for datasets changed since last time '
                          'gave an error: %s', e)
                 get_all_packages = True
 
-            if not get_all_packages and not pkg_dicts:
+            if not get_all_packages and not first_page:
                 log.info('No datasets have been updated on the remote '
                          'CKAN instance since the last harvest job %s',
                          last_time)
@@ -252,8 +309,9 @@ class CKANHarvester(HarvesterBase):
         if get_all_packages:
             # Request all remote packages
             try:
-                pkg_dicts = self._search_for_datasets(remote_ckan_base_url,
-                                                      fq_terms)
+                pages = self._search_for_datasets_in_pages(
+                    remote_ckan_base_url, fq_terms)
+                first_page = next(pages, [])
             except SearchError as e:
                 log.info('Searching for all datasets gave an error: %s', e)
                 self._save_gather_error(
@@ -261,94 +319,114 @@ class CKANHarvester(HarvesterBase):
                     'terms:%s' % (e, remote_ckan_base_url, fq_terms),
                     harvest_job)
                 return None
-        if not pkg_dicts:
+        if not first_page:
             self._save_gather_error(
                 'No datasets found at CKAN: %s' % remote_ckan_base_url,
                 harvest_job)
             return []
 
-        # Create harvest objects for each dataset
-        try:
+        # Create harvest objects for each dataset, while paging through the
+        # rest of the results
+        return self._create_objects(harvest_job,
+                                    itertools.chain([first_page], pages))
+
+    def _create_objects(self, harvest_job, pages):
+        '''Creates the harvest objects for the datasets in ``pages`` and
+        yields their ids in batches, as they are committed.
+
+        Datasets that haven't been modified on the remote CKAN since they were
+        last imported are skipped, unless the force_all option is set.'''
+        if self.config.get('force_all', False):
+            modified_dates = {}
+        else:
+            modified_dates = self._get_current_modified_dates(
+                harvest_job.source)
+        unchanged = []
+
+        def objects():
             package_ids = set()
-            object_ids = []
-            for pkg_dict in pkg_dicts:
-                if pkg_dict['id'] in package_ids:
-                    log.info('Discarding duplicate dataset %s - probably due '
-                             'to datasets being changed at the same time as '
-                             'when the harvester was paging through',
-                             pkg_dict['id'])
-                    continue
-                package_ids.add(pkg_dict['id'])
-
-                log.debug('Creating HarvestObject for %s %s',
-                          pkg_dict['name'], pkg_dict['id'])
-                obj = HarvestObject(guid=pkg_dict['id'],
-                                    job=harvest_job,
-                                    content=json.dumps(pkg_dict))
-                obj.save()
-                object_ids.append(obj.id)
+            for pkg_dicts in pages:
+                for pkg_dict in pkg_dicts:
+                    if pkg_dict['id'] in package_ids:
+                        log.info('Discarding duplicate dataset %s - probably '
+                                 'due to datasets being changed at the same '
+                                 'time as when the harvester was paging '
+                                 'through', pkg_dict['id'])
+                        continue
+                    package_ids.add(pkg_dict['id'])
+
+                    modified = _parse_date(pkg_dict.get('metadata_modified'))
+                    last_modified = modified_dates.get(pkg_dict['id'])
+                    if modified and last_modified and \
+                            modified <= last_modified:
+                        unchanged.append(pkg_dict['id'])
+                        continue
+
+                    log.debug('Creating HarvestObject for %s %s',
+                              pkg_dict['name'], pkg_dict['id'])
+                    yield pkg_dict['id'], json.dumps(pkg_dict), modified
 
-            return object_ids
+        try:
+            for ids in self._create_harvest_objects_in_bulk(harvest_job,
+                                                            objects()):
+                yield ids
+            if unchanged:
+                log.info('Skipped %d datasets not modified since they were '
+                         'last harvested', len(unchanged))
+        except SearchError as e:
+            log.info('Paging through the remote datasets gave an error: %s', e)
+            self._save_gather_error(
+                'Unable to search remote CKAN for datasets: %s' % e,
+                harvest_job)
         except Exception as e:
-            self._save_gather_error('%r' % e.message, harvest_job)
+            self._save_gather_error('%r' % e, harvest_job)
 
     def _search_for_datasets(self, remote_ckan_base_url, fq_terms=None):
         '''Does a dataset search on a remote CKAN and returns the results.
 
         Deals with paging to return all the results, not just the first page.
         '''
+        return list(itertools.chain.from_iterable(
+            self._search_for_datasets_in_pages(remote_ckan_base_url,
+                                               fq_terms)))
+
+    def _search_for_datasets_in_pages(self, remote_ckan_base_url,
+                                      fq_terms=None):
+        '''Does a dataset search on a remote CKAN and yields the results of
+        each page, so they don't all need to be held in memory.
+        '''
         base_search_url = remote_ckan_base_url + self._get_search_api_offset()
-        params = {'rows': '100', 'start': '0'}
+        params = {'rows': str(self._get_search_rows())}
         # There is the worry that datasets will be changed whilst we are paging
         # through them.
-        # * In SOLR 4.7 there is a cursor, but not using that yet
-        #   because few CKANs are running that version yet.
-        # * However we sort, then new names added or removed before the current
-        #   page would cause existing names on the next page to be missed or
-        #   double counted.
-        # * Another approach might be to sort by metadata_modified and always
-        #   ask for changes since (and including) the date of the last item of
-        #   the day before. However if the entire page is of the exact same
-        #   time, then you end up in an infinite loop asking for the same page.
-        # * We choose a balanced approach of sorting by ID, which means
-        #   datasets are only missed if some are removed, which is far less
-        #   likely than any being added. If some are missed then it is assumed
-        #   they will harvested the next time anyway. When datasets are added,
-        #   we are at risk of seeing datasets twice in the paging, so we detect
-        #   and remove any duplicates.
-        params['sort'] = 'id asc'
-        if fq_terms:
-            params['fq'] = ' '.join(fq_terms)
-
-        pkg_dicts = []
+        # * Paging with an offset (start) gets slower the deeper the page, as
+        #   SOLR has to rank all the previous results again for every page.
+        #   Few CKANs support SOLR cursors in package_search, so instead we
+        #   sort by metadata_modified and ask for the datasets modified since
+        #   (and including) the last one of the previous page ("keyset"
+        #   paging), so every request is as cheap as the first one.
+        # * Datasets changed whilst we are paging move to the end of the
+        #   results, so they are not missed.
+        # * As the date is included, the datasets at the end of a page are
+        #   seen again on the next one, so we detect and remove any
+        #   duplicates. If a whole page has the exact same date, we would end
+        #   up in an infinite loop asking for the same page, so in that case
+        #   (or if the remote doesn't return metadata_modified or rejects the
+        #   query) we page with an offset instead.
+        # * However we sort, then datasets added, changed or removed before the
+        #   current page would cause existing ones on the next page to be missed
+        #   or double counted when paging with an offset. So for that we choose
+        #   a balanced approach of sorting by ID, which means datasets are only
+        #   missed if some are removed, which is far less likely than any being
+        #   added. If some are missed then it is assumed they will harvested the
+        #   next time anyway. When datasets are added, we are at risk of seeing
+        #   datasets twice in the paging, so we detect and remove any
+        #   duplicates.
+        params['sort'] = 'metadata_modified asc, id asc'
+
         pkg_ids = set()
-        previous_content = None
-        while True:
-            url = base_search_url + '?' + urlencode(params)
-            log.debug('Searching for CKAN datasets: %s', url)
-            try:
-                content = self._get_content(url)
-            except ContentFetchError as e:
-                raise SearchError(
-                    'Error sending request to search remote '
-                    'CKAN instance %s using URL %r. Error: %s' %
-                    (remote_ckan_base_url, url, e))
-
-            if previous_content and content == previous_content:
-                raise SearchError('The paging doesn\'t seem to work. URL: %s' %
-                                  url)
-            try:
-                response_dict = json.loads(content)
-            except ValueError:
-                raise SearchError('Response from remote CKAN was not JSON: %r'
-                                  % content)
-            try:
-                pkg_dicts_page = response_dict.get('result', {}).get('results',
-                                                                     [])
-            except ValueError:
-                raise SearchError('Response JSON did not contain '
-                                  'result/results: %r' % response_dict)
 
+        def new_datasets(pkg_dicts_page):
             # Weed out any datasets found on previous pages (should datasets be
             # changing while we page)
             ids_in_page = set(p['id'] for p in pkg_dicts_page)
@@ -356,22 +434,186 @@ class CKANHarvester(HarvesterBase):
             if duplicate_ids:
                 pkg_dicts_page = [p for p in pkg_dicts_page
                                   if p['id'] not in duplicate_ids]
-            pkg_ids |= ids_in_page
-
-            pkg_dicts.extend(pkg_dicts_page)
+            pkg_ids.update(ids_in_page)
+            return pkg_dicts_page
+
+        def page_by_id(since=None):
+            # Starts again from the first dataset (modified since the given
+            # date), sorted by ID
+            params['sort'] = 'id asc'
+            return False, since, 0
+
+        concurrency = self._get_search_concurrency()
+        keyset = True
+        last_modified = None
+        offset = 0
+        if concurrency > 1:
+            # Keyset paging needs the previous page to request the next one,
+            # so to request several pages at the same time we page with an
+            # offset from the start
+            keyset, last_modified, offset = page_by_id()
+        while True:
+            page_fq_terms = list(fq_terms or [])
+            if last_modified:
+                page_fq_terms.append(
+                    'metadata_modified:[{0}Z TO *]'.format(last_modified))
+            params['start'] = str(offset)
+            if page_fq_terms:
+                params['fq'] = ' '.join(page_fq_terms)
+            else:
+                params.pop('fq', None)
 
-            if len(pkg_dicts_page) == 0:
+            try:
+                pkg_dicts_page, count = self._search_page(
+                    remote_ckan_base_url, base_search_url, params)
+            except SearchError as e:
+                if not (keyset and last_modified):
+                    raise
+                log.info('Searching for datasets modified since %s gave an '
+                         'error, paging with an offset instead: %s',
+                         last_modified, e)
+                keyset, last_modified, offset = page_by_id()
+                continue
+
+            page_size = len(pkg_dicts_page)
+            if page_size == 0:
+                break
+            pkg_dicts_page = new_datasets(pkg_dicts_page)
+
+            if not pkg_dicts_page and keyset and last_modified:
+                log.info('The whole page of datasets was modified at %s, '
+                         'paging with an offset instead', last_modified)
+                keyset, last_modified, offset = page_by_id(last_modified)
+                continue
+
+            if pkg_dicts_page:
+                yield pkg_dicts_page
+
+            if not keyset:
+                if concurrency > 1 and offset == 0 and count:
+                    # Now that we know how many datasets there are, request
+                    # the rest of the pages at the same time (as many as the
+                    # remote returned on the first one), then look for any
+                    # dataset added in the meantime after them
+                    log.debug('Requesting %d datasets from %s, %d pages at a '
+                              'time', count, remote_ckan_base_url, concurrency)
+                    for pkg_dicts_page, _ in self._search_pages_in_parallel(
+                            remote_ckan_base_url, base_search_url, params,
+                            range(page_size, count, page_size), concurrency):
+                        pkg_dicts_page = new_datasets(pkg_dicts_page)
+                        if pkg_dicts_page:
+                            yield pkg_dicts_page
+                    offset = max(count, page_size)
+                else:
+                    offset += page_size
+                continue
+
+            if count is not None and count <= page_size:
+                # That was the last page
                 break
 
-            params['start'] = str(int(params['start']) + int(params['rows']))
+            last_modified = _solr_date(
+                pkg_dicts_page[-1].get('metadata_modified'))
+            if not last_modified:
+                log.info('The remote CKAN doesn\'t return the datasets\' '
+                         'metadata_modified, paging with an offset instead')
+                keyset, last_modified, offset = page_by_id()
+
+    def _search_pages_in_parallel(self, remote_ckan_base_url, base_search_url,
+                                  params, offsets, concurrency):
+        '''Requests the pages of a dataset search starting at each of the
+        ``offsets``, up to ``concurrency`` at a time, and yields their results
+        and counts in order. The limit applies to this search only, not to
+        all the requests to the remote site.'''
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            offsets = iter(offsets)
+            futures = collections.deque()
+
+            def submit(offset):
+                futures.append(executor.submit(
+                    self._search_page, remote_ckan_base_url, base_search_url,
+                    dict(params, start=str(offset))))
+
+            for offset in itertools.islice(offsets, concurrency):
+                submit(offset)
+            while futures:
+                result = futures.popleft().result()
+                for offset in itertools.islice(offsets, 1):
+                    submit(offset)
+                yield result
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _search_page(self, remote_ckan_base_url, base_search_url, params):
+        '''Requests a page of a dataset search on a remote CKAN and returns
+        its results and the total number of results (or None).'''
+        url = base_search_url + '?' + urlencode(params)
+        log.debug('Searching for CKAN datasets: %s', url)
+        try:
+            content = self._get_content(url)
+        except ContentFetchError as e:
+            raise SearchError(
+                'Error sending request to search remote '
+                'CKAN instance %s using URL %r. Error: %s' %
+                (remote_ckan_base_url, url, e))
 
-        return pkg_dicts
+        try:
+            response_dict = json.loads(content)
+        except ValueError:
+            raise SearchError('Response from remote CKAN was not JSON: %r'
+                              % content)
+        if response_dict.get('success') is False:
+            raise SearchError('Search on remote CKAN failed: %r'
+                              % response_dict.get('error'))
+        try:
+            result = response_dict.get('result', {})
+            return result.get('results', []), result.get('count')
+        except (AttributeError, ValueError):
+            raise SearchError('Response JSON did not contain '
+                              'result/results: %r' % response_dict)
+
+    def _get_search_concurrency(self):
+        # No more requests at the same time than connections kept to the
+        # remote site
+        try:
+            concurrency = int(self.config.get('search_concurrency', 1))
+        except (TypeError, ValueError):
+            return 1
+        return min(max(1, concurrency), HTTP_POOL_SIZE)
+
+    def _get_search_rows(self):
+        try:
+            return max(1, int(self.config.get('search_rows', SEARCH_ROWS)))
+        except (TypeError, ValueError):
+            return SEARCH_ROWS
 
     def fetch_stage(self, harvest_object):
         # Nothing to do here - we got the package dict in the search in the
         # gather stage
         return True
 
+    def _find_local_group(self, context, group_):
+        '''Returns the id and name of the local group with the id or else the
+        name of the remote ``group_``, or None if there is none.'''
+        for key in ('id', 'name'):
+            if key in group_:
+                try:
+                    group = get_action('group_show')(
+                        context.copy(), {'id': group_[key]})
+                    return {'id': group['id'], 'name': group['name']}
+                except NotFound:
+                    pass
+        return None
+
+    def _find_local_organization(self, context, org_ref):
+        '''Returns the id of the local organization ``org_ref`` or None.'''
+        try:
+            return get_action('organization_show')(
+                context.copy(), {'id': org_ref})['id']
+        except NotFound:
+            return None
+
     def import_stage(self, harvest_object):
         log.debug('In CKANHarvester import_stage')
 
@@ -387,7 +629,8 @@ class CKANHarvester(HarvesterBase):
                                     harvest_object, 'Import')
             return False
 
-        self._set_config(harvest_object.job.source.config)
+        source_config = self._set_source_config(harvest_object.job.source)
+        lookups = self._get_lookup_cache(harvest_object.harvest_job_id)
 
         try:
             package_dict = json.loads(harvest_object.content)
@@ -401,8 +644,8 @@ class CKANHarvester(HarvesterBase):
             if default_tags:
                 if 'tags' not in package_dict:
                     package_dict['tags'] = []
-                package_dict['tags'].extend(
-                    [t for t in default_tags if t not in package_dict['tags']])
+                package_dict['tags'].extend(copy.deepcopy(
+                    [t for t in default_tags if t not in package_dict['tags']]))
 
             remote_groups = self.config.get('remote_groups', None)
             if remote_groups not in ('only_local', 'create'):
@@ -416,24 +659,13 @@ class CKANHarvester(HarvesterBase):
                 validated_groups = []
 
                 for group_ in package_dict['groups']:
-                    try:
-                        try:
-                            if 'id' in group_:
-                                data_dict = {'id': group_['id']}
-                                group = get_action('group_show')(base_context.copy(), data_dict)
-                            else:
-                                raise NotFound
-
-                        except NotFound:
-                            if 'name' in group_:
-                                data_dict = {'id': group_['name']}
-                                group = get_action('group_show')(base_context.copy(), data_dict)
-                            else:
-                                raise NotFound
+                    group = lookups.get(
+                        ('group', group_.get('id'), group_.get('name')),
+                        lambda: self._find_local_group(base_context, group_))
+                    if group:
                         # Found local group
-                        validated_groups.append({'id': group['id'], 'name': group['name']})
-
-                    except NotFound:
+                        validated_groups.append(group)
+                    else:
                         log.info('Group %s is not available', group_)
                         if remote_groups == 'create':
                             try:
@@ -452,8 +684,11 @@ class CKANHarvester(HarvesterBase):
                 package_dict['groups'] = validated_groups
 
             # Local harvest source organization
-            source_dataset = get_action('package_show')(base_context.copy(), {'id': harvest_object.source.id})
-            local_org = source_dataset.get('owner_org')
+            local_org = lookups.get(
+                ('source_org', harvest_object.source.id),
+                lambda: get_action('package_show')(
+                    base_context.copy(),
+                    {'id': harvest_object.source.id}).get('owner_org'))
 
             remote_orgs = self.config.get('remote_orgs', None)
 
@@ -469,11 +704,11 @@ class CKANHarvester(HarvesterBase):
                 remote_org = package_dict['owner_org']
 
                 if remote_org:
-                    try:
-                        data_dict = {'id': remote_org}
-                        org = get_action('organization_show')(base_context.copy(), data_dict)
-                        validated_org = org['id']
-                    except NotFound:
+                    validated_org = lookups.get(
+                        ('organization', remote_org),
+                        lambda: self._find_local_organization(base_context,
+                                                              remote_org))
+                    if not validated_org:
                         log.info('Organization %s is not available', remote_org)
                         if remote_orgs == 'create':
                             try:
@@ -501,36 +736,29 @@ class CKANHarvester(HarvesterBase):
                 if 'groups' not in package_dict:
                     package_dict['groups'] = []
                 existing_group_ids = [g['id'] for g in package_dict['groups']]
-                package_dict['groups'].extend(
-                    [g for g in self.config['default_group_dicts']
-                     if g['id'] not in existing_group_ids])
+                package_dict['groups'].extend(copy.deepcopy(
+                    [g for g in source_config.default_group_dicts
+                     if g['id'] not in existing_group_ids]))
 
             # Set default extras if needed
-            default_extras = self.config.get('default_extras', {})
-
             def get_extra(key, package_dict):
                 for extra in package_dict.get('extras', []):
                     if extra['key'] == key:
                         return extra
-            if default_extras:
+            if source_config.default_extras:
                 override_extras = self.config.get('override_extras', False)
                 if 'extras' not in package_dict:
                     package_dict['extras'] = []
-                for key, value in default_extras.items():
+                for key, value in source_config.default_extras:
                     existing_extra = get_extra(key, package_dict)
                     if existing_extra and not override_extras:
                         continue  # no need for the default
                     if existing_extra:
                         package_dict['extras'].remove(existing_extra)
                     # Look for replacement strings
-                    if isinstance(value, str):
-                        value = value.format(
-                            harvest_source_id=harvest_object.job.source.id,
-                            harvest_source_url=harvest_object.job.source.url.strip('/'),
-                            harvest_source_title=harvest_object.job.source.title,
-                            harvest_job_id=harvest_object.job.id,
-                            harvest_object_id=harvest_object.id,
-                            dataset_id=package_dict['id'])
+                    value = source_config.format_extra(
+                        copy.deepcopy(value), harvest_object,
+                        package_dict['id'])
 
                     package_dict['extras'].append({'key': key, 'value': value})
 
@@ -573,3 +801,26 @@ class RemoteResourceError(Exception):
 
 class SearchError(Exception):
     pass
+
+
+def _solr_date(value):
+    '''Returns a metadata_modified value from the CKAN API (eg
+    2014-05-09T22:00:01.486366) truncated to the milliseconds SOLR keeps, or
+    None.'''
+    if not value or not isinstance(value, str):
+        return None
+    value = value.rstrip('Z')
+    if '.' in value:
+        value = value[:value.index('.') + 4]
+    return value
+
+
+def _parse_date(value):
+    '''Returns a metadata_modified value from the CKAN API as a datetime,
+    or None.'''
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.rstrip('Z'))
+    except ValueError:
+        return None
@@ -91,6 +91,27 @@ class IHarvester(Interface):
         :returns: A list of HarvestObject ids
         '''
 
+    def iter_gather_stage(self, harvest_job):
+        '''
+
+        [optional]
+
+        Generator function (``yield``) with the same responsibilities as
+        ``gather_stage``, that yields the ids of the HarvestObjects (or lists
+        of ids) as they are created. When provided, the gather consumer uses
+        it instead of ``gather_stage``, so the objects are sent to the fetch
+        queue before the gather stage finishes. The HarvestObjects must be
+        committed before their ids are yielded. Yield None if the gather
+        stage failed, as when ``gather_stage`` returns None.
+
+        Objects already yielded are fetched and imported even if the gather
+        stage records a HarvestGatherError afterwards, but they are all
+        deleted if it raises an exception.
+
+        :param harvest_job: HarvestJob object
+        :returns: An iterator of HarvestObject ids or of lists of ids
+        '''
+
     def fetch_stage(self, harvest_object):
         '''
         The fetch stage will receive a HarvestObject object and will be
@@ -110,6 +131,30 @@ class IHarvester(Interface):
                   all, False if not successful
         '''
 
+    def async_fetch_stage(self, harvest_object):
+        '''
+
+        [optional]
+
+        Harvesters that spend most of the fetch stage waiting for remote
+        servers can provide this coroutine function (``async def``) as well as
+        ``fetch_stage``. When the fetch consumer is run with
+        ``--async-fetches``, it is used instead of ``fetch_stage``, so that a
+        single process can fetch many objects at the same time.
+
+        It has the same responsibilities and return values as ``fetch_stage``.
+        All the fetches share the thread of the fetch consumer, so it must not
+        block: use an asyncio HTTP client and ``await`` the requests. Each
+        fetch has its own ``model.Session``, and the object has been committed
+        before this is called. Avoid using the database while awaiting, as
+        every transaction left open holds on to a connection until the object
+        is saved.
+
+        :param harvest_object: HarvestObject object
+        :returns: True if successful, 'unchanged' if nothing to import after
+                  all, False if not successful
+        '''
+
     def import_stage(self, harvest_object):
         '''
         The import stage will receive a HarvestObject object and will be
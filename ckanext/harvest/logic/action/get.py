@@ -1,6 +1,8 @@
+import copy
 import logging
+import time
 from ckan.lib.base import config
-from sqlalchemy import or_
+from sqlalchemy import event, func, or_
 from ckan.model import User, Package
 import datetime
 
@@ -16,6 +18,7 @@ from ckanext.harvest import model as harvest_model
 from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject, HarvestLog)
 from ckanext.harvest.logic.dictization import (harvest_source_dictize,
                                                harvest_job_dictize,
+                                               harvest_jobs_dictize,
                                                harvest_object_dictize,
                                                harvest_log_dictize)
 
@@ -59,6 +62,33 @@ def harvest_source_show(context, data_dict):
     return source_dict
 
 
+# Seconds the status of a harvest source is cached, see
+# harvest_source_show_status
+SOURCE_STATUS_CACHE_TTL = 10
+# Cached statuses by source id, then by the context options that change them
+_source_status_cache = {}
+
+
+def _clear_source_status(mapper, connection, target):
+    source_id = getattr(target, 'source_id', None) or \
+        getattr(target, 'harvest_source_id', None)
+    _source_status_cache.pop(source_id, None)
+
+
+def _evict_source_statuses(now):
+    for source_id, statuses in list(_source_status_cache.items()):
+        for key, (expires, _) in list(statuses.items()):
+            if expires <= now:
+                statuses.pop(key, None)
+        if not statuses:
+            _source_status_cache.pop(source_id, None)
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(HarvestJob, _event, _clear_source_status)
+event.listen(HarvestObject, 'after_update', _clear_source_status)
+
+
 @side_effect_free
 def harvest_source_show_status(context, data_dict):
     '''
@@ -69,6 +99,10 @@ def harvest_source_show_status(context, data_dict):
     Note that this information is already included on the output of
     harvest_source_show, under the 'status' field.
 
+    The status is cached for ``ckan.harvest.source_status_cache_ttl`` seconds
+    (10 by default, 0 to disable it), or until a job or object of the source
+    changes in this process.
+
     :param id: the id or name of the harvest source
     :type id: string
 
@@ -77,37 +111,40 @@ def harvest_source_show_status(context, data_dict):
 
     p.toolkit.check_access('harvest_source_show_status', context, data_dict)
 
-    model = context.get('model')
-
     source = harvest_model.HarvestSource.get(data_dict['id'])
     if not source:
         raise p.toolkit.ObjectNotFound('Harvest source {0} does not exist'.format(data_dict['id']))
 
+    ttl = p.toolkit.asint(
+        config.get('ckan.harvest.source_status_cache_ttl', SOURCE_STATUS_CACHE_TTL))
+    if ttl <= 0:
+        return _get_source_status(source, context)
+
+    # The options of harvest_job_dictize
+    key = (context.get('return_stats', True),
+           context.get('return_error_summary', True),
+           context.get('error_summmary_limit', 20))
+    now = time.monotonic()
+    cached = _source_status_cache.get(source.id, {}).get(key)
+    if cached is None or cached[0] <= now:
+        _evict_source_statuses(now)
+        cached = (now + ttl, _get_source_status(source, context))
+        _source_status_cache.setdefault(source.id, {})[key] = cached
+    return copy.deepcopy(cached[1])
+
+
+def _get_source_status(source, context):
+    model = context.get('model')
+
     out = {
            'job_count': 0,
            'last_job': None,
            'total_datasets': 0,
            }
 
-    jobs = harvest_model.HarvestJob.filter(source=source).all()
-
-    job_count = len(jobs)
-    if job_count == 0:
-        return out
-
-    out['job_count'] = job_count
-
-    # Get the most recent job
-    last_job = harvest_model.HarvestJob.filter(source=source) \
-        .order_by(harvest_model.HarvestJob.created.desc()).first()
-
-    if not last_job:
-        return out
-
-    out['last_job'] = harvest_job_dictize(last_job, context)
-
     # Overall statistics
-    packages = model.Session.query(model.Package) \
+    total_datasets = model.Session.query(func.count(model.Package.id)) \
+        .select_from(model.Package) \
         .join(harvest_model.HarvestObject) \
         .filter(harvest_model.HarvestObject.harvest_source_id == source.id) \
         .filter(
@@ -115,8 +152,22 @@ def harvest_source_show_status(context, data_dict):
     ).filter(model.Package.state == u'active') \
         .filter(
         model.Package.private == False  # noqa: E712
-    )
-    out['total_datasets'] = packages.count()
+    ).scalar_subquery()
+
+    # Get the most recent job, the number of jobs and the datasets at once
+    row = model.Session.query(
+        harvest_model.HarvestJob,
+        func.count(harvest_model.HarvestJob.id).over(),
+        total_datasets) \
+        .filter(harvest_model.HarvestJob.source_id == source.id) \
+        .order_by(harvest_model.HarvestJob.created.desc()) \
+        .first()
+
+    if not row:
+        return out
+
+    last_job, out['job_count'], out['total_datasets'] = row
+    out['last_job'] = harvest_job_dictize(last_job, context)
 
     return out
 
@@ -243,7 +294,7 @@ def harvest_job_list(context, data_dict):
     jobs = query.all()
 
     context['return_error_summary'] = False
-    return [harvest_job_dictize(job, context) for job in jobs]
+    return harvest_jobs_dictize(jobs, context)
 
 
 @side_effect_free
@@ -26,9 +26,12 @@ from ckanext.harvest.utils import (
     DATASET_TYPE_NAME
 )
 from ckanext.harvest.queue import (
-    get_gather_publisher, resubmit_jobs, resubmit_objects)
+    get_gather_publisher, resubmit_jobs, resubmit_objects,
+    get_index_commit_batch_size, commit_search_index)
 
-from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject, HarvestGatherError
+from ckanext.harvest.model import (
+    HarvestSource, HarvestJob, HarvestObject, HarvestGatherError, reconcile_job_stats
+)
 from ckanext.harvest.logic import HarvestJobExists
 from ckanext.harvest.logic.dictization import harvest_job_dictize
 
@@ -615,6 +618,8 @@ def harvest_jobs_run(context, data_dict):
     # Flag finished jobs as such
     jobs = harvest_job_list(
         context, {'source_id': source_id, 'status': u'Running'})
+    # the fetch consumers may have deferred the commits of the search index
+    index_committed = not get_index_commit_batch_size()
     if len(jobs):
         for job in jobs:
             job_obj = HarvestJob.get(job['id'])
@@ -633,6 +638,7 @@ def harvest_jobs_run(context, data_dict):
 
                     err = HarvestGatherError(message=msg, job=job_obj)
                     err.save()
+                    reconcile_job_stats([job_obj.id])
                     log.info('Marking job as finished due to error: %s %s',
                              job_obj.source.url, job_obj.id)
                     continue
@@ -646,6 +652,9 @@ def harvest_jobs_run(context, data_dict):
                            .count()
 
                 if num_objects_in_progress == 0:
+                    if not index_committed:
+                        commit_search_index()
+                        index_committed = True
 
                     job_obj.status = u'Finished'
                     log.info('Marking job as finished %s %s',
@@ -664,6 +673,9 @@ def harvest_jobs_run(context, data_dict):
                     else:
                         job_obj.finished = job['gather_finished']
                     job_obj.save()
+                    # The stats are kept up to date as the objects are saved,
+                    # count them again in case they drifted
+                    reconcile_job_stats([job_obj.id])
 
                     # Reindex the harvest source dataset so it has the latest
                     # status
@@ -820,9 +832,6 @@ def harvest_send_job_to_gather_queue(context, data_dict):
 
     check_access('harvest_send_job_to_gather_queue', context, job)
 
-    # gather queue
-    publisher = get_gather_publisher()
-
     # Check the source is active
     source = harvest_source_show(context, {'id': job['source_id']})
     if not source['active']:
@@ -831,7 +840,11 @@ def harvest_send_job_to_gather_queue(context, data_dict):
     job_obj = HarvestJob.get(job['id'])
     job_obj.status = job['status'] = u'Running'
     job_obj.save()
+
+    # gather queue
+    publisher = get_gather_publisher()
     publisher.send({'harvest_job_id': job['id']})
+    publisher.close()
     log.info('Sent job %s to the gather queue', job['id'])
 
     return harvest_job_dictize(job_obj, context)
@@ -3,7 +3,9 @@ from sqlalchemy import func, text
 from ckan.model import Group
 from ckan import logic
 from ckanext.harvest.model import (HarvestJob, HarvestObject,
-                                   HarvestGatherError, HarvestObjectError)
+                                   HarvestGatherError, HarvestObjectError,
+                                   HarvestJobStats, count_job_stats,
+                                   job_stats_dict)
 
 
 def harvest_source_dictize(source, context, last_job_status=False):
@@ -27,57 +29,76 @@ def harvest_source_dictize(source, context, last_job_status=False):
 
 
 def harvest_job_dictize(job, context):
-    out = job.as_dict()
+    return harvest_jobs_dictize([job], context)[0]
 
-    model = context['model']
+
+def harvest_jobs_dictize(jobs, context):
+    '''
+    Dictizes a list of jobs, getting the stats of all of them with a few
+    grouped queries instead of several queries per job.
+    '''
+    out = [job.as_dict() for job in jobs]
 
     if context.get('return_stats', True):
-        stats = model.Session.query(
-            HarvestObject.report_status,
-            func.count(HarvestObject.id).label('total_objects'))\
-            .filter_by(harvest_job_id=job.id)\
-            .group_by(HarvestObject.report_status).all()
-        out['stats'] = {'added': 0, 'updated': 0, 'not modified': 0,
-                        'errored': 0, 'deleted': 0}
-        for status, count in stats:
-            out['stats'][status] = count
-
-        # We actually want to check which objects had errors, because they
-        # could have been added/updated anyway (eg bbox errors)
-        count = model.Session.query(
-            func.distinct(HarvestObjectError.harvest_object_id)) \
-            .join(HarvestObject) \
-            .filter(HarvestObject.harvest_job_id == job.id) \
-            .count()
-        if count > 0:
-            out['stats']['errored'] = count
-
-        # Add gather errors to the error count
-        count = model.Session.query(HarvestGatherError) \
-            .filter(HarvestGatherError.harvest_job_id == job.id) \
-            .count()
-        if count > 0:
-            out['stats']['errored'] = out['stats'].get('errored', 0) + count
+        stats = _get_jobs_stats([job.id for job in jobs], context)
+        for job_dict in out:
+            job_dict['stats'] = stats[job_dict['id']]
 
     if context.get('return_error_summary', True):
-        q = model.Session.query(
-            HarvestObjectError.message,
-            func.count(HarvestObjectError.message).label('error_count')) \
-            .join(HarvestObject) \
-            .filter(HarvestObject.harvest_job_id == job.id) \
-            .group_by(HarvestObjectError.message) \
-            .order_by(text('error_count desc')) \
-            .limit(context.get('error_summmary_limit', 20))
-        out['object_error_summary'] = harvest_error_dictize(q.all(), context)
-        q = model.Session.query(
-            HarvestGatherError.message,
-            func.count(HarvestGatherError.message).label('error_count')) \
-            .filter(HarvestGatherError.harvest_job_id == job.id) \
-            .group_by(HarvestGatherError.message) \
-            .order_by(text('error_count desc')) \
-            .limit(context.get('error_summmary_limit', 20))
-        out['gather_error_summary'] = harvest_error_dictize(q.all(), context)
+        for job, job_dict in zip(jobs, out):
+            job_dict.update(_get_job_error_summary(job, context))
+
+    return out
+
+
+# Maximum number of job ids in each query of _get_jobs_stats
+JOB_STATS_BATCH_SIZE = 500
 
+
+def _get_jobs_stats(job_ids, context):
+    '''
+    Returns the stats of some jobs by job id, from the harvest_job_stats table,
+    or counted with grouped queries for the jobs without a row there.
+    '''
+    model = context['model']
+
+    stats = {}
+    for start in range(0, len(job_ids), JOB_STATS_BATCH_SIZE):
+        batch = job_ids[start:start + JOB_STATS_BATCH_SIZE]
+
+        q = model.Session.query(HarvestJobStats) \
+            .filter(HarvestJobStats.harvest_job_id.in_(batch))
+        for job_stats in q:
+            stats[job_stats.harvest_job_id] = job_stats.as_stats_dict()
+
+        counts = count_job_stats(
+            [job_id for job_id in batch if job_id not in stats])
+        for job_id, job_counts in counts.items():
+            stats[job_id] = job_stats_dict(job_counts)
+
+    return stats
+
+
+def _get_job_error_summary(job, context):
+    model = context['model']
+    out = {}
+    q = model.Session.query(
+        HarvestObjectError.message,
+        func.count(HarvestObjectError.message).label('error_count')) \
+        .join(HarvestObject) \
+        .filter(HarvestObject.harvest_job_id == job.id) \
+        .group_by(HarvestObjectError.message) \
+        .order_by(text('error_count desc')) \
+        .limit(context.get('error_summmary_limit', 20))
+    out['object_error_summary'] = harvest_error_dictize(q.all(), context)
+    q = model.Session.query(
+        HarvestGatherError.message,
+        func.count(HarvestGatherError.message).label('error_count')) \
+        .filter(HarvestGatherError.harvest_job_id == job.id) \
+        .group_by(HarvestGatherError.message) \
+        .order_by(text('error_count desc')) \
+        .limit(context.get('error_summmary_limit', 20))
+    out['gather_error_summary'] = harvest_error_dictize(q.all(), context)
     return out
 
 
@@ -0,0 +1,32 @@
+"""add harvest object content hash
+
+Revision ID: a3f1c8e2d9b4
+Revises: 75d650dfd519
+Create Date: 2026-10-18 10:12:41.528310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a3f1c8e2d9b4"
+down_revision = "75d650dfd519"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "harvest_object", sa.Column("content_hash", sa.UnicodeText, nullable=True)
+    )
+    op.create_index(
+        "harvest_source_guid_current_idx",
+        "harvest_object",
+        ["harvest_source_id", "guid", "current"],
+    )
+
+
+def downgrade():
+    op.drop_index("harvest_source_guid_current_idx", "harvest_object")
+    op.drop_column("harvest_object", "content_hash")
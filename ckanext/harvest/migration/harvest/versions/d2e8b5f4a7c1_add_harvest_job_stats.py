@@ -0,0 +1,81 @@
+"""add harvest job stats
+
+Revision ID: d2e8b5f4a7c1
+Revises: a3f1c8e2d9b4
+Create Date: 2026-10-18 14:37:05.114872
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d2e8b5f4a7c1"
+down_revision = "a3f1c8e2d9b4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "harvest_job_stats",
+        sa.Column(
+            "harvest_job_id",
+            sa.UnicodeText,
+            sa.ForeignKey("harvest_job.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("added", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("updated", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("not_modified", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("errored", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("deleted", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("errored_objects", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("gather_errors", sa.Integer, nullable=False, server_default="0"),
+    )
+    # Count the stats of the existing jobs, like reconcile_job_stats
+    op.execute(
+        """
+        INSERT INTO harvest_job_stats (harvest_job_id, added, updated,
+            not_modified, errored, deleted, errored_objects, gather_errors)
+        SELECT harvest_job.id,
+            COALESCE(o.added, 0), COALESCE(o.updated, 0),
+            COALESCE(o.not_modified, 0), COALESCE(o.errored, 0),
+            COALESCE(o.deleted, 0), COALESCE(e.errored_objects, 0),
+            COALESCE(g.gather_errors, 0)
+        FROM harvest_job
+        LEFT JOIN (
+            SELECT harvest_job_id,
+                SUM(CASE WHEN report_status = 'added' THEN 1 ELSE 0 END)
+                    AS added,
+                SUM(CASE WHEN report_status = 'updated' THEN 1 ELSE 0 END)
+                    AS updated,
+                SUM(CASE WHEN report_status = 'not modified' THEN 1 ELSE 0 END)
+                    AS not_modified,
+                SUM(CASE WHEN report_status = 'errored' THEN 1 ELSE 0 END)
+                    AS errored,
+                SUM(CASE WHEN report_status = 'deleted' THEN 1 ELSE 0 END)
+                    AS deleted
+            FROM harvest_object
+            GROUP BY harvest_job_id
+        ) o ON o.harvest_job_id = harvest_job.id
+        LEFT JOIN (
+            SELECT harvest_object.harvest_job_id,
+                COUNT(DISTINCT harvest_object_error.harvest_object_id)
+                    AS errored_objects
+            FROM harvest_object_error
+            JOIN harvest_object
+                ON harvest_object.id = harvest_object_error.harvest_object_id
+            GROUP BY harvest_object.harvest_job_id
+        ) e ON e.harvest_job_id = harvest_job.id
+        LEFT JOIN (
+            SELECT harvest_job_id, COUNT(*) AS gather_errors
+            FROM harvest_gather_error
+            GROUP BY harvest_job_id
+        ) g ON g.harvest_job_id = harvest_job.id
+        """
+    )
+
+
+def downgrade():
+    op.drop_table("harvest_job_stats")
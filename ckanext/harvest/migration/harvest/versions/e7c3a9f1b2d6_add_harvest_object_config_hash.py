@@ -0,0 +1,26 @@
+"""add harvest object config hash
+
+Revision ID: e7c3a9f1b2d6
+Revises: d2e8b5f4a7c1
+Create Date: 2026-10-18 16:02:17.630945
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e7c3a9f1b2d6"
+down_revision = "d2e8b5f4a7c1"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "harvest_object", sa.Column("config_hash", sa.UnicodeText, nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column("harvest_object", "config_hash")
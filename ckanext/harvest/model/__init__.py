@@ -1,12 +1,16 @@
 import logging
 import datetime
+from collections import OrderedDict
 
 from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy import select
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import types
 from sqlalchemy import Index
-from sqlalchemy.orm import backref, relationship
+from sqlalchemy.orm import backref, column_property, object_session, relationship
 from sqlalchemy.exc import InvalidRequestError
 
 from ckan.model.meta import Session
@@ -218,6 +222,12 @@ class HarvestObject(BaseModel, HarvestDomainObject):
     # state: WAITING, FETCH, IMPORT, COMPLETE, ERROR
     state = Column(types.UnicodeText, default="WAITING")
     metadata_modified_date = Column(types.DateTime)
+    # Digest of the fetched content and the source config, to skip importing
+    # objects that haven't changed since the current one for the same guid
+    content_hash = Column(types.UnicodeText, nullable=True)
+    # Digest of the source config when the object was gathered, so the gather
+    # stage doesn't skip unchanged records once the config has changed
+    config_hash = Column(types.UnicodeText, nullable=True)
     retry_times = Column(types.Integer, default=0)
     harvest_job_id = Column(types.UnicodeText, ForeignKey("harvest_job.id"))
     harvest_source_id = Column(types.UnicodeText, ForeignKey("harvest_source.id"))
@@ -227,11 +237,17 @@ class HarvestObject(BaseModel, HarvestDomainObject):
         nullable=True,
     )
     # report_status: 'added', 'updated', 'not modified', 'deleted', 'errored'
-    report_status = Column(types.UnicodeText, nullable=True)
+    # the previous value is loaded when it changes, to update HarvestJobStats
+    report_status = column_property(
+        Column(types.UnicodeText, nullable=True), active_history=True
+    )
     harvest_job_id_idx = Index("harvest_job_id")
     harvest_source_id_idx = Index("harvest_source_id")
     package_id_idx = Index("package_id")
     guid_idx = Index("guid")
+    harvest_source_guid_current_idx = Index(
+        "harvest_source_guid_current_idx", "harvest_source_id", "guid", "current"
+    )
     package = relationship(
         Package,
         lazy="select",
@@ -337,6 +353,134 @@ class HarvestObjectError(BaseModel, HarvestDomainObject):
             log.debug(log_message)
 
 
+class HarvestJobStats(BaseModel, HarvestDomainObject):
+    """Counts of the harvest objects of a job by report status and of its
+    errors. They are updated as the objects and errors are saved (see the
+    listeners below), so the stats of a job don't need counting every time
+    they are shown. ``reconcile_job_stats`` counts them again.
+    """
+
+    __tablename__ = "harvest_job_stats"
+
+    key_attr = "harvest_job_id"
+
+    harvest_job_id = Column(
+        types.UnicodeText,
+        ForeignKey("harvest_job.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    added = Column(types.Integer, default=0, nullable=False)
+    updated = Column(types.Integer, default=0, nullable=False)
+    not_modified = Column(types.Integer, default=0, nullable=False)
+    errored = Column(types.Integer, default=0, nullable=False)
+    deleted = Column(types.Integer, default=0, nullable=False)
+    # objects with errors, whatever their report status
+    errored_objects = Column(types.Integer, default=0, nullable=False)
+    gather_errors = Column(types.Integer, default=0, nullable=False)
+
+    def as_stats_dict(self):
+        return job_stats_dict(
+            dict((column, getattr(self, column)) for column in JOB_STATS_COLUMNS)
+        )
+
+
+# Columns of HarvestJobStats counting each report_status of the objects
+REPORT_STATUS_COLUMNS = OrderedDict([
+    ("added", "added"),
+    ("updated", "updated"),
+    ("not modified", "not_modified"),
+    ("errored", "errored"),
+    ("deleted", "deleted"),
+])
+JOB_STATS_COLUMNS = list(REPORT_STATUS_COLUMNS.values()) + [
+    "errored_objects", "gather_errors"]
+
+
+def job_stats_dict(counts):
+    """
+    Returns the stats of a job shown by the API from the counts of its objects
+    and errors, as stored in HarvestJobStats.
+    """
+    stats = dict(
+        (status, counts[column]) for status, column in REPORT_STATUS_COLUMNS.items()
+    )
+    # We actually want to check which objects had errors, because they
+    # could have been added/updated anyway (eg bbox errors)
+    if counts["errored_objects"] > 0:
+        stats["errored"] = counts["errored_objects"]
+    # Add gather errors to the error count
+    stats["errored"] += counts["gather_errors"]
+    return stats
+
+
+def count_job_stats(job_ids):
+    """
+    Counts the objects and errors of some jobs from the harvest_object and
+    error tables, with one grouped query for each. Returns a dict with the
+    counts of each job, by job id, with the columns of HarvestJobStats.
+    """
+    counts = {}
+    for job_id in job_ids:
+        counts[job_id] = dict((column, 0) for column in JOB_STATS_COLUMNS)
+    if not job_ids:
+        return counts
+
+    q = Session.query(
+        HarvestObject.harvest_job_id,
+        HarvestObject.report_status,
+        func.count(HarvestObject.id)) \
+        .filter(HarvestObject.harvest_job_id.in_(job_ids)) \
+        .group_by(HarvestObject.harvest_job_id, HarvestObject.report_status)
+    for job_id, status, count in q:
+        if status in REPORT_STATUS_COLUMNS:
+            counts[job_id][REPORT_STATUS_COLUMNS[status]] = count
+
+    q = Session.query(
+        HarvestObject.harvest_job_id,
+        func.count(func.distinct(HarvestObjectError.harvest_object_id))) \
+        .select_from(HarvestObjectError) \
+        .join(HarvestObject,
+              HarvestObjectError.harvest_object_id == HarvestObject.id) \
+        .filter(HarvestObject.harvest_job_id.in_(job_ids)) \
+        .group_by(HarvestObject.harvest_job_id)
+    for job_id, count in q:
+        counts[job_id]["errored_objects"] = count
+
+    q = Session.query(
+        HarvestGatherError.harvest_job_id,
+        func.count(HarvestGatherError.id)) \
+        .filter(HarvestGatherError.harvest_job_id.in_(job_ids)) \
+        .group_by(HarvestGatherError.harvest_job_id)
+    for job_id, count in q:
+        counts[job_id]["gather_errors"] = count
+
+    return counts
+
+
+def reconcile_job_stats(job_ids=None, batch_size=500):
+    """
+    Counts the stats of some jobs (or of all of them) again and stores them in
+    HarvestJobStats, in case they drifted (eg objects changed with bulk
+    updates, which don't call the listeners) or the jobs are older than the
+    table. Returns the number of jobs.
+    """
+    if job_ids is None:
+        job_ids = [job_id for job_id, in Session.query(HarvestJob.id)]
+    table = HarvestJobStats.__table__
+    for start in range(0, len(job_ids), batch_size):
+        counts = count_job_stats(job_ids[start:start + batch_size])
+        Session.execute(
+            table.delete().where(table.c.harvest_job_id.in_(list(counts)))
+        )
+        Session.execute(
+            table.insert(),
+            [dict(harvest_job_id=job_id, **job_counts)
+             for job_id, job_counts in counts.items()],
+        )
+        Session.commit()
+    return len(job_ids)
+
+
 class HarvestLog(BaseModel, HarvestDomainObject):
     """HarvestLog objects are created each time something is logged
     using python's standard logging module
@@ -363,6 +507,129 @@ def harvest_object_before_insert_listener(mapper, connection, target):
         target.harvest_source_id = target.job.source.id
 
 
+def _update_job_stats(connection, job_id, **increments):
+    table = HarvestJobStats.__table__
+    connection.execute(
+        table.update()
+        .where(table.c.harvest_job_id == job_id)
+        .values(dict(
+            (column, getattr(table.c, column) + increment)
+            for column, increment in increments.items()
+        ))
+    )
+
+
+# Keys of Session.info with what the flush in progress changed in the stats
+JOB_STATS_INCREMENTS = "harvest_job_stats_increments"
+NEW_OBJECT_ERRORS = "harvest_job_stats_new_object_errors"
+
+
+def _add_job_stats(target, job_id, **increments):
+    """
+    Adds to the stats of a job when the flush in progress is done (see
+    job_stats_after_flush_listener).
+    """
+    job_increments = object_session(target).info.setdefault(
+        JOB_STATS_INCREMENTS, {}).setdefault(job_id, {})
+    for column, increment in increments.items():
+        job_increments[column] = job_increments.get(column, 0) + increment
+
+
+def harvest_job_after_insert_listener(mapper, connection, target):
+    """
+    Creates the stats of a new job. Those of the jobs created before the
+    harvest_job_stats table are counted by its migration.
+    """
+    connection.execute(
+        HarvestJobStats.__table__.insert().values(harvest_job_id=target.id)
+    )
+
+
+def harvest_object_after_insert_listener(mapper, connection, target):
+    if target.report_status in REPORT_STATUS_COLUMNS:
+        _add_job_stats(target, target.harvest_job_id, **{
+            REPORT_STATUS_COLUMNS[target.report_status]: 1})
+
+
+def harvest_object_after_update_listener(mapper, connection, target):
+    """
+    Moves the object from the count of its previous report status to the new
+    one when it changes, eg when it reaches the end of the import stage.
+    """
+    history = inspect(target).attrs.report_status.history
+    if not history.has_changes():
+        return
+    increments = {}
+    for status in history.deleted:
+        if status in REPORT_STATUS_COLUMNS:
+            increments[REPORT_STATUS_COLUMNS[status]] = -1
+    for status in history.added:
+        if status in REPORT_STATUS_COLUMNS:
+            column = REPORT_STATUS_COLUMNS[status]
+            increments[column] = increments.get(column, 0) + 1
+    _add_job_stats(target, target.harvest_job_id, **increments)
+
+
+def harvest_object_error_after_insert_listener(mapper, connection, target):
+    """
+    Keeps the new error, its object is counted as errored when the flush is
+    done if it has no errors from earlier flushes.
+    """
+    if target.harvest_object_id:
+        object_session(target).info.setdefault(
+            NEW_OBJECT_ERRORS, {})[target.id] = target.harvest_object_id
+
+
+def harvest_gather_error_after_insert_listener(mapper, connection, target):
+    _add_job_stats(target, target.harvest_job_id, gather_errors=1)
+
+
+def job_stats_before_flush_listener(session, flush_context, instances):
+    # in case an earlier flush failed before job_stats_after_flush_listener
+    session.info.pop(JOB_STATS_INCREMENTS, None)
+    session.info.pop(NEW_OBJECT_ERRORS, None)
+
+
+def job_stats_after_flush_listener(session, flush_context):
+    """
+    Updates the stats of the jobs whose objects and errors were saved by the
+    flush, with one UPDATE for each job rather than one for each object.
+    Concurrent workers harvesting the same job wait on each other's row lock
+    once per flush.
+
+    Deleted objects and errors, and bulk updates, are not counted here.
+    ``harvest_jobs_run`` counts the stats of each job again when it finishes
+    it (see ``reconcile_job_stats``).
+    """
+    increments = session.info.pop(JOB_STATS_INCREMENTS, {})
+    new_errors = session.info.pop(NEW_OBJECT_ERRORS, {})
+    if not increments and not new_errors:
+        return
+    connection = session.connection()
+    if new_errors:
+        errors = HarvestObjectError.__table__
+        objects = HarvestObject.__table__
+        earlier_error = select(errors.c.id).where(
+            errors.c.harvest_object_id == objects.c.id,
+            errors.c.id.notin_(list(new_errors)),
+        )
+        q = select(objects.c.harvest_job_id, func.count(objects.c.id)).where(
+            objects.c.id.in_(set(new_errors.values())),
+            ~earlier_error.exists(),
+        ).group_by(objects.c.harvest_job_id)
+        for job_id, count in connection.execute(q):
+            job_increments = increments.setdefault(job_id, {})
+            job_increments["errored_objects"] = count
+    # in the same order in every transaction, so they can't deadlock
+    for job_id in sorted(increments):
+        job_increments = dict(
+            (column, increment)
+            for column, increment in increments[job_id].items() if increment
+        )
+        if job_increments:
+            _update_job_stats(connection, job_id, **job_increments)
+
+
 class PackageIdHarvestSourceIdMismatch(Exception):
     """
     The package created for the harvest source must match the id of the
@@ -386,3 +653,14 @@ def clean_harvest_log(condition):
 
 
 event.listen(HarvestObject, "before_insert", harvest_object_before_insert_listener)
+event.listen(HarvestJob, "after_insert", harvest_job_after_insert_listener)
+event.listen(HarvestObject, "after_insert", harvest_object_after_insert_listener)
+event.listen(HarvestObject, "after_update", harvest_object_after_update_listener)
+event.listen(
+    HarvestObjectError, "after_insert", harvest_object_error_after_insert_listener
+)
+event.listen(
+    HarvestGatherError, "after_insert", harvest_gather_error_after_insert_listener
+)
+event.listen(Session, "before_flush", job_stats_before_flush_listener)
+event.listen(Session, "after_flush", job_stats_after_flush_listener)
@@ -2,6 +2,9 @@
 
 import os
 import json
+import time
+import contextlib
+import datetime
 from logging import getLogger
 
 from collections import OrderedDict
@@ -115,16 +118,25 @@ class Harvest(p.SingletonPlugin, DefaultDatasetForm, DefaultTranslation):
 
         return search_params
 
-    def _add_or_update_harvest_metadata(self, key, value, data_dict):
-        """Adds extras fields or updates them if already exist."""
+    def _add_harvest_metadata(self, harvest_extras, data_dict):
+        """Sets the harvest metadata in the root of `data_dict` if the keys
+        already exist there, or else adds or updates them in its extras."""
+        missing = OrderedDict()
+        for key, value in harvest_extras:
+            if key in data_dict:
+                data_dict[key] = value
+            else:
+                missing[key] = value
+        if not missing:
+            return
+
         if not data_dict.get("extras"):
             data_dict["extras"] = []
 
-        for e in data_dict.get("extras"):
-            if e.get("key") == key:
-                e.update({"value": value})
-                break
-        else:
+        for e in data_dict["extras"]:
+            if e.get("key") in missing:
+                e.update({"value": missing.pop(e["key"])})
+        for key, value in missing.items():
             data_dict["extras"].append({"key": key, "value": value})
 
     def before_dataset_index(self, pkg_dict):
@@ -150,35 +162,24 @@ class Harvest(p.SingletonPlugin, DefaultDatasetForm, DefaultTranslation):
             except ValueError:
                 pkg_dict.pop('status', None)
 
-        harvest_object = model.Session.query(HarvestObject) \
-            .filter(HarvestObject.package_id == pkg_dict["id"]) \
-            .filter(
-                HarvestObject.current == True # noqa
-            ).order_by(HarvestObject.import_finished.desc()) \
-            .first()
+        harvest_object = _get_current_harvest_object(
+            pkg_dict["id"], pkg_dict.get("metadata_modified"))
 
         if not harvest_object:
             return pkg_dict
 
+        object_id, source_id, source_title = harvest_object
         harvest_extras = [
-            ("harvest_object_id", harvest_object.id),
-            ("harvest_source_id", harvest_object.source.id),
-            ("harvest_source_title", harvest_object.source.title),
+            ("harvest_object_id", object_id),
+            ("harvest_source_id", source_id),
+            ("harvest_source_title", source_title),
         ]
 
         data_dict = json.loads(pkg_dict["data_dict"])
-        for key, value in harvest_extras:
-            if key in data_dict.keys():
-                data_dict[key] = value
-                continue
-            self._add_or_update_harvest_metadata(key, value, data_dict)
+        self._add_harvest_metadata(harvest_extras, data_dict)
 
         validated_data_dict = json.loads(pkg_dict["validated_data_dict"])
-        for key, value in harvest_extras:
-            if key in validated_data_dict.keys():
-                validated_data_dict[key] = value
-                continue
-            self._add_or_update_harvest_metadata(key, value, validated_data_dict)
+        self._add_harvest_metadata(harvest_extras, validated_data_dict)
 
         # Add harvest extras to main indexed pkg_dict
         for key, value in harvest_extras:
@@ -489,6 +490,85 @@ def _delete_harvest_source_object(context, data_dict):
     return source
 
 
+def _get_current_harvest_object(package_id, metadata_modified=None):
+    """Returns the id of the current harvest object of a dataset, and the id
+    and title of its source, or None if the dataset wasn't harvested.
+
+    Within `index_prefetch` they are looked up in a map of all the harvested
+    datasets, loaded with one query (see `_prefetch_harvest_objects`), unless
+    the dataset was modified (`metadata_modified`) after the map was loaded.
+    """
+    if _index_prefetch["enabled"]:
+        objects = _prefetch_harvest_objects()
+        prefetched = objects.get(package_id)
+        if prefetched and not (
+                metadata_modified
+                and metadata_modified >= _index_prefetch["loaded"]):
+            object_id, source_id = prefetched
+            return object_id, source_id, _index_prefetch["sources"][source_id]
+
+    return model.Session.query(
+        HarvestObject.id, HarvestSource.id, HarvestSource.title
+    ).join(
+        HarvestSource, HarvestObject.harvest_source_id == HarvestSource.id
+    ).filter(
+        HarvestObject.package_id == package_id
+    ).filter(
+        HarvestObject.current == True  # noqa: E712
+    ).order_by(HarvestObject.import_finished.desc()).first()
+
+
+# Current harvest objects of the harvested datasets, see index_prefetch
+_index_prefetch = {"enabled": False, "loaded": None, "objects": {}, "sources": {}}
+
+
+@contextlib.contextmanager
+def index_prefetch():
+    """Looks up the harvest metadata added to the datasets indexed in the
+    block in a map of all the harvested datasets, loaded with one query when
+    the first one is indexed, instead of with one query per dataset. Meant
+    for rebuilds of the search index (see `harvester search-index-rebuild`).
+    The map is dropped when the block ends.
+    """
+    _index_prefetch.update(enabled=True, loaded=None, objects={}, sources={})
+    try:
+        yield
+    finally:
+        _index_prefetch.update(enabled=False, loaded=None, objects={},
+                               sources={})
+
+
+def _prefetch_harvest_objects():
+    """Returns a dict with the id of the current harvest object and source id
+    of every harvested dataset, by dataset id, loading it the first time.
+    """
+    if _index_prefetch["loaded"] is not None:
+        return _index_prefetch["objects"]
+
+    start = time.time()
+    # as in metadata_modified, to tell the datasets modified since
+    loaded = datetime.datetime.utcnow().isoformat()
+    query = model.Session.query(
+        HarvestObject.package_id, HarvestObject.id,
+        HarvestObject.harvest_source_id
+    ).filter(
+        HarvestObject.current == True  # noqa: E712
+    ).filter(
+        HarvestObject.package_id != None  # noqa: E711
+    ).order_by(HarvestObject.import_finished)
+    # ordered so the last imported object of a dataset wins, like in
+    # _get_current_harvest_object
+    objects = {}
+    for package_id, object_id, source_id in query.yield_per(10000):
+        objects[package_id] = (object_id, source_id)
+    sources = dict(model.Session.query(HarvestSource.id, HarvestSource.title))
+
+    _index_prefetch.update(loaded=loaded, objects=objects, sources=sources)
+    log.info("Loaded the harvest objects of %d datasets in %.1fs",
+             len(objects), time.time() - start)
+    return objects
+
+
 def _configure_db_logger(config):
     # Log scope
     #
@@ -1,17 +1,30 @@
 import logging
+import asyncio
+import contextlib
 import datetime
+import functools
+import hashlib
+import inspect
+import itertools
 import json
-
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import redis
 import pika
 import sqlalchemy
+import sqlalchemy.orm
 
 from ckan.lib.base import config
-from ckan.plugins import PluginImplementations
+from ckan.plugins import PluginImplementations, toolkit
 from ckan import model
+from ckan.lib import search
 
-from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError
+from ckanext.harvest.model import (HarvestJob, HarvestObject, HarvestGatherError,
+                                   HarvestObjectError)
 from ckanext.harvest.interfaces import IHarvester
 
 log = logging.getLogger(__name__)
@@ -29,21 +42,106 @@ VIRTUAL_HOST = '/'
 MQ_TYPE = 'redis'
 REDIS_PORT = 6379
 REDIS_DB = 0
+PUBLISH_BATCH_SIZE = 1000
+PREFETCH_COUNT = 0  # no limit
+MAX_FETCH_ATTEMPTS = 5
+FETCH_COMMIT_MODES = ('state', 'stage', 'object')
+# settings for the source lanes, see source_lanes_enabled
+MAX_PRIORITY = 9
+LANES_REFRESH = 5
+FETCH_CONCURRENCY = 10
+# seconds before the in-flight time of a Redis batch is renewed, see BatchAck
+BATCH_RESTAMP_INTERVAL = 1
 
 # settings for AMQP
 EXCHANGE_TYPE = 'direct'
 EXCHANGE_NAME = 'ckan.harvest'
 
 
+# Connections shared by the publishers and consumers, see get_connection
+_redis_connections = {}
+_amqp_connections = threading.local()
+# Search index commits of the running fetch consumer, see defer_index_commits
+_index_commits = None
+# Copies of the harvesters of each worker thread, see _thread_harvester
+_worker_harvesters = threading.local()
+
+
 def get_connection():
+    '''
+    Returns a connection to the queue backend, reused by all the publishers
+    and consumers of the process, so that each of them doesn't need a new
+    handshake with the server.
+
+    Pika connections are not thread safe, so with RabbitMQ each thread gets
+    its own connection, which is replaced if it has been closed (e.g. after
+    the server restarted). The Redis client is thread safe and reconnects by
+    itself. Connections are never shared with forked processes.
+    '''
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
     if backend in ('amqp', 'ampq'):  # "ampq" is for compat with old typo
-        return get_connection_amqp()
+        connections = getattr(_amqp_connections, 'connections', None)
+        if connections is None:
+            connections = _amqp_connections.connections = {}
+        key = (os.getpid(), _connection_settings())
+        connection = connections.get(key)
+        if connection is None or not connection.is_open:
+            connection = connections[key] = get_connection_amqp()
+        return connection
     if backend == 'redis':
-        return get_connection_redis()
+        key = (os.getpid(), _connection_settings())
+        connection = _redis_connections.get(key)
+        if connection is None:
+            connection = _redis_connections[key] = get_connection_redis()
+        return connection
     raise Exception('not a valid queue type %s' % backend)
 
 
+def get_amqp_channel():
+    '''
+    Returns the shared RabbitMQ connection (see get_connection) and a new
+    channel on it.
+
+    A connection the server dropped quietly (eg in an idle web process, whose
+    heartbeats are never serviced) may still say it is open, and only fail
+    when a channel is opened. In that case it is replaced with a new one,
+    once.
+    '''
+    connection = get_connection()
+    try:
+        return connection, connection.channel()
+    except pika.exceptions.AMQPConnectionError as e:
+        log.warning('Lost the connection to RabbitMQ, reconnecting: %r', e)
+        _evict_amqp_connection(connection)
+        connection = get_connection()
+        return connection, connection.channel()
+
+
+def _evict_amqp_connection(connection):
+    connections = getattr(_amqp_connections, 'connections', {})
+    for key, cached in list(connections.items()):
+        if cached is connection:
+            del connections[key]
+    try:
+        if connection.is_open:
+            connection.close()
+    except pika.exceptions.AMQPError:
+        pass
+
+
+def _connection_settings():
+    return tuple(config.get(key) for key in (
+        'ckan.harvest.mq.type',
+        'ckan.harvest.mq.hostname',
+        'ckan.harvest.mq.port',
+        'ckan.harvest.mq.user_id',
+        'ckan.harvest.mq.password',
+        'ckan.harvest.mq.virtual_host',
+        'ckan.harvest.mq.redis_db',
+        'ckan.redis.url',
+    ))
+
+
 def get_connection_amqp():
     try:
         port = int(config.get('ckan.harvest.mq.port', PORT))
@@ -83,14 +181,34 @@ def get_connection_redis():
         )
 
 
+def source_lanes_enabled():
+    '''
+    Whether the fetch queue is shared fairly between the harvest sources
+    (``ckan.harvest.mq.source_lanes``), so that small sources don't wait for
+    the big ones queued before them.
+
+    On Redis every source gets its own list, and the consumers take messages
+    from them in turns. On RabbitMQ a priority queue is used instead (see
+    ``get_fetch_priority``).
+    '''
+    return toolkit.asbool(config.get('ckan.harvest.mq.source_lanes', False))
+
+
+def _priority_queues():
+    return source_lanes_enabled() and \
+        config.get('ckan.harvest.mq.type', MQ_TYPE) in ('amqp', 'ampq')
+
+
 def get_gather_queue_name():
     return 'ckan.harvest.{0}.gather'.format(config.get('ckan.site_id',
                                                        'default'))
 
 
 def get_fetch_queue_name():
-    return 'ckan.harvest.{0}.fetch'.format(config.get('ckan.site_id',
+    name = 'ckan.harvest.{0}.fetch'.format(config.get('ckan.site_id',
                                                       'default'))
+    # RabbitMQ can't turn an existing queue into a priority one
+    return name + '.priority' if _priority_queues() else name
 
 
 def get_gather_routing_key():
@@ -99,19 +217,51 @@ def get_gather_routing_key():
 
 
 def get_fetch_routing_key():
-    return 'ckanext-harvest:{0}:harvest_object_id'.format(
+    key = 'ckanext-harvest:{0}:harvest_object_id'.format(
         config.get('ckan.site_id', 'default'))
+    return key + '.priority' if _priority_queues() else key
+
+
+def get_publish_batch_size():
+    try:
+        return max(1, int(config.get('ckan.harvest.mq.publish_batch_size',
+                                     PUBLISH_BATCH_SIZE)))
+    except ValueError:
+        return PUBLISH_BATCH_SIZE
+
+
+def get_prefetch_count():
+    '''
+    Returns how many unacknowledged messages RabbitMQ sends to each consumer
+    (``ckan.harvest.mq.prefetch_count``), 0 meaning no limit.
+    '''
+    try:
+        return max(0, int(config.get('ckan.harvest.mq.prefetch_count',
+                                     PREFETCH_COUNT)))
+    except ValueError:
+        return PREFETCH_COUNT
+
+
+def _chunks(iterable, size):
+    '''Yields lists of at most ``size`` items, without materializing the
+    whole iterable (so generators of ids can be published as they come).'''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def purge_queues():
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
-    connection = get_connection()
     if backend in ('amqp', 'ampq'):
-        channel = connection.channel()
+        _, channel = get_amqp_channel()
         channel.queue_purge(queue=get_gather_queue_name())
         log.info('AMQP queue purged: %s', get_gather_queue_name())
         channel.queue_purge(queue=get_fetch_queue_name())
         log.info('AMQP queue purged: %s', get_fetch_queue_name())
+        channel.close()
     elif backend == 'redis':
         get_gather_consumer().queue_purge()
         log.info('Redis gather queue purged')
@@ -127,43 +277,16 @@ def resubmit_jobs():
     '''
     if config.get('ckan.harvest.mq.type') != 'redis':
         return
-    redis = get_connection()
-
-    # fetch queue
-    harvest_object_pending = redis.keys(get_fetch_routing_key() + ':*')
-    for key in harvest_object_pending:
-        redis_value = redis.get(key)
-        if redis_value is None:
-            log.info('Fetch Queue: Redis cannot get value for key {}'.format(key))
-            continue
-        date_of_key = datetime.datetime.strptime(
-            redis_value, "%Y-%m-%d %H:%M:%S.%f")
-        log.debug('[Fetch queue]: Check key {} with value {}'.format(key, date_of_key))
-        # 3 minutes for fetch and import max
-        if (datetime.datetime.now() - date_of_key).seconds > 180:
-            log.debug('[Fetch queue]: Re-new harvest object with KEY {} in redis'.format(key))
-            redis.rpush(get_fetch_routing_key(),
-                        json.dumps({'harvest_object_id': key.split(':')[-1]})
-                        )
-            redis.delete(key)
-
-    # gather queue
-    harvest_jobs_pending = redis.keys(get_gather_routing_key() + ':*')
-    for key in harvest_jobs_pending:
-        redis_value = redis.get(key)
-        if redis_value is None:
-            log.info('Gather Queue: Redis cannot get value for key {}'.format(key))
-            continue
-        date_of_key = datetime.datetime.strptime(
-            redis_value, "%Y-%m-%d %H:%M:%S.%f")
-        log.debug('[Gather queue]: Check key {} with value {}'.format(key, date_of_key))
-        # 3 hours for a gather
-        if (datetime.datetime.now() - date_of_key).seconds > 7200:
-            log.debug('[Gather queue]: Re-new harvest job with KEY {} in redis'.format(key))
-            redis.rpush(get_gather_routing_key(),
-                        json.dumps({'harvest_job_id': key.split(':')[-1]})
-                        )
-            redis.delete(key)
+
+    # fetch queue: 3 minutes for fetch and import max
+    count = get_fetch_consumer().resubmit_stale(180)
+    if count:
+        log.info('[Fetch queue]: Re-sent %s stale harvest objects', count)
+
+    # gather queue: 2 hours for a gather
+    count = get_gather_consumer().resubmit_stale(7200)
+    if count:
+        log.info('[Gather queue]: Re-sent %s stale harvest jobs', count)
 
 
 def resubmit_objects():
@@ -172,23 +295,31 @@ def resubmit_objects():
     '''
     if config.get('ckan.harvest.mq.type') != 'redis':
         return
-    redis = get_connection()
     publisher = get_fetch_publisher()
 
-    waiting_objects = model.Session.query(HarvestObject.id) \
-        .filter_by(state='WAITING') \
-        .all()
+    # Queues filled before the index of queued ids existed need it rebuilt
+    # once, otherwise all their objects would be sent twice
+    publisher.ensure_queued_index()
+    # and ids left behind by consumers that died would stop their objects
+    # from ever being sent again
+    publisher.prune_queued_index()
 
-    objects_in_queue = []
-    fetch_routing_key = get_fetch_routing_key()
-
-    objects_in_queue = [json.loads(o)['harvest_object_id']
-                        for o in redis.lrange(fetch_routing_key, 0, -1)]
-
-    for object_id, in waiting_objects:
-        if object_id not in objects_in_queue:
+    waiting = model.Session.query(HarvestObject.id,
+                                  HarvestObject.harvest_source_id) \
+        .filter_by(state='WAITING') \
+        .yield_per(get_publish_batch_size())
+
+    batch_size = get_publish_batch_size()
+    for objects in _chunks(waiting, batch_size):
+        object_ids = [object_id for object_id, _ in objects]
+        missing = [(object_id, source_id) for (object_id, source_id), in_queue
+                   in zip(objects, publisher.queued(object_ids))
+                   if not in_queue]
+        for object_id, _ in missing:
             log.debug('Re-sent object {} to the fetch queue'.format(object_id))
-            publisher.send({'harvest_object_id': object_id})
+        publisher.send_many(
+            {'harvest_object_id': object_id, 'harvest_source_id': source_id}
+            for object_id, source_id in missing)
 
     publisher.close()
 
@@ -200,24 +331,74 @@ class Publisher(object):
         self.exchange = exchange
         self.routing_key = routing_key
 
-    def send(self, body, **kw):
+    def send(self, body, priority=None, **kw):
+        try:
+            return self._publish(body, priority, **kw)
+        except (pika.exceptions.AMQPConnectionError,
+                pika.exceptions.ChannelWrongStateError) as e:
+            # The shared connection may have been dropped by the server since
+            # it was last used, retry once on a new one
+            log.warning('Lost the connection to RabbitMQ, reconnecting: %r', e)
+            _evict_amqp_connection(self.connection)
+            self.connection, self.channel = get_amqp_channel()
+            self.channel.exchange_declare(exchange=self.exchange, durable=True)
+            return self._publish(body, priority, **kw)
+
+    def _publish(self, body, priority, **kw):
         return self.channel.basic_publish(
             self.exchange,
             self.routing_key,
             json.dumps(body),
             properties=pika.BasicProperties(
                 delivery_mode=2,  # make message persistent
+                priority=priority,
             ),
             **kw)
 
+    def send_many(self, bodies, **kw):
+        '''
+        Publishes all the given message bodies, returning how many were sent.
+
+        Messages are published in chunks of
+        ``ckan.harvest.mq.publish_batch_size``. Pika's blocking channel waits
+        for a broker round trip on every message when publisher confirms are
+        enabled, so instead the buffered frames are flushed once per chunk,
+        which also keeps the connection heartbeats serviced during long
+        publishing runs.
+        '''
+        count = 0
+        for chunk in _chunks(bodies, get_publish_batch_size()):
+            for body in chunk:
+                self.send(body, **kw)
+            self.connection.process_data_events(time_limit=0)
+            count += len(chunk)
+        return count
+
     def close(self):
-        self.connection.close()
+        # The connection is shared (see get_connection), only close the channel
+        if self.channel.is_open:
+            self.channel.close()
 
 
 class RedisPublisher(object):
     def __init__(self, redis, routing_key):
         self.redis = redis  # not used
         self.routing_key = routing_key
+        self.message_key = routing_key.split(':')[-1]
+        # Set of the ids of the messages waiting on the queue, kept in step
+        # with it so membership can be checked without reading the whole list
+        # (see RedisConsumer for the removals)
+        self.queued_key = routing_key + '.queued'
+        # Set of the per source lists, see source_lanes_enabled
+        self.lanes_key = routing_key + '.lanes'
+        self.lanes = source_lanes_enabled()
+
+    def lane_key(self, body):
+        '''Returns the list a message goes to.'''
+        source_id = body.get('harvest_source_id') if self.lanes else None
+        if not source_id:
+            return self.routing_key
+        return self.lanes_key + '.' + source_id
 
     def send(self, body, **kw):
         value = json.dumps(body)
@@ -233,24 +414,186 @@ class RedisPublisher(object):
                     self.redis.lrem(self.routing_key, value, 0)
                 else:
                     raise
-        self.redis.rpush(self.routing_key, value)
+        # MULTI/EXEC, so the message is never on the queue without its id in
+        # the set of queued ids or the other way round
+        pipe = self.redis.pipeline(transaction=True)
+        self._push(pipe, [body])
+        pipe.execute()
+
+    def send_many(self, bodies, **kw):
+        '''
+        Publishes all the given message bodies, returning how many were sent.
+
+        Messages are pushed with a Redis transaction in chunks of
+        ``ckan.harvest.mq.publish_batch_size``, so publishing N messages costs
+        N / batch size round trips instead of N.
+        '''
+        if self.routing_key == get_gather_routing_key():
+            # Gather messages need de-duplicating one by one (see `send`), and
+            # there are never many of them anyway
+            count = 0
+            for body in bodies:
+                self.send(body, **kw)
+                count += 1
+            return count
+
+        count = 0
+        for chunk in _chunks(bodies, get_publish_batch_size()):
+            pipe = self.redis.pipeline(transaction=True)
+            self._push(pipe, chunk)
+            pipe.execute()
+            count += len(chunk)
+        return count
+
+    def _push(self, pipe, bodies):
+        lanes = {}
+        for body in bodies:
+            lanes.setdefault(self.lane_key(body), []).append(json.dumps(body))
+        for key, values in lanes.items():
+            pipe.rpush(key, *values)
+            if key != self.routing_key:
+                # after the push, so consumers never drop a lane with messages
+                pipe.sadd(self.lanes_key, key)
+        self._add_queued(pipe, bodies)
+
+    def _add_queued(self, pipe, bodies):
+        ids = [body[self.message_key] for body in bodies
+               if body.get(self.message_key) is not None]
+        if ids:
+            pipe.sadd(self.queued_key, *ids)
+
+    def queued(self, ids):
+        '''
+        Returns a list of booleans telling whether each of the given message
+        ids is waiting on the queue.
+        '''
+        if not ids:
+            return []
+        try:
+            return [bool(found)
+                    for found in self.redis.smismember(self.queued_key, ids)]
+        except redis.ResponseError:
+            # SMISMEMBER needs Redis >= 6.2
+            pipe = self.redis.pipeline(transaction=False)
+            for id in ids:
+                pipe.sismember(self.queued_key, id)
+            return [bool(found) for found in pipe.execute()]
+
+    def ensure_queued_index(self):
+        '''
+        Builds the set of queued ids from the queue itself if the queue has
+        messages but the set doesn't exist (e.g. they were sent by an older
+        version of this extension), returning how many ids were added.
+        '''
+        # Use a script to make the operation atomic, consumers take messages
+        # off the queue while it is being read
+        lua_code = b'''
+            local routing_key = KEYS[1]
+            local queued_key = KEYS[2]
+            local lanes_key = KEYS[3]
+            local message_key = ARGV[1]
+            local batch_size = tonumber(ARGV[2])
+            if redis.call("exists", queued_key) == 1 then
+                return 0
+            end
+            local queues = redis.call("smembers", lanes_key)
+            queues[#queues + 1] = routing_key
+            local count = 0
+            for _, queue in ipairs(queues) do
+                local ids = {}
+                for _, s in ipairs(redis.call("lrange", queue, 0, -1)) do
+                    local ok, value = pcall(cjson.decode, s)
+                    if ok and type(value) == "table" and type(value[message_key]) == "string" then
+                        ids[#ids + 1] = value[message_key]
+                        if #ids == batch_size then
+                            count = count + redis.call("sadd", queued_key, unpack(ids))
+                            ids = {}
+                        end
+                    end
+                end
+                if #ids > 0 then
+                    count = count + redis.call("sadd", queued_key, unpack(ids))
+                end
+            end
+            return count
+        '''
+        script = self.redis.register_script(lua_code)
+        count = script(
+            keys=[self.routing_key, self.queued_key, self.lanes_key],
+            # unpack() is limited by the size of the Lua stack
+            args=[self.message_key, min(get_publish_batch_size(), 5000)])
+        if count:
+            log.info('Built the index of queued messages for %s (%d ids)',
+                     self.routing_key, count)
+        return count
+
+    def prune_queued_index(self):
+        '''
+        Removes the ids of the messages that are no longer on the queue from
+        the set of queued ids, returning how many were removed.
+
+        A consumer waiting with BLPOP removes the id of the message it got in
+        a separate call, so one that dies in between leaves its id behind.
+        The set then has more ids than the queue has messages, which is cheap
+        to check, and only in that case is the queue read to find them.
+        '''
+        # Use a script to make the operation atomic, consumers take messages
+        # off the queue while it is being read
+        lua_code = b'''
+            local routing_key = KEYS[1]
+            local queued_key = KEYS[2]
+            local lanes_key = KEYS[3]
+            local message_key = ARGV[1]
+            local queues = redis.call("smembers", lanes_key)
+            queues[#queues + 1] = routing_key
+            local length = 0
+            for _, queue in ipairs(queues) do
+                length = length + redis.call("llen", queue)
+            end
+            if redis.call("scard", queued_key) <= length then
+                return 0
+            end
+            local found = {}
+            for _, queue in ipairs(queues) do
+                for _, s in ipairs(redis.call("lrange", queue, 0, -1)) do
+                    local ok, value = pcall(cjson.decode, s)
+                    if ok and type(value) == "table" and type(value[message_key]) == "string" then
+                        found[value[message_key]] = true
+                    end
+                end
+            end
+            local count = 0
+            for _, id in ipairs(redis.call("smembers", queued_key)) do
+                if not found[id] then
+                    count = count + redis.call("srem", queued_key, id)
+                end
+            end
+            return count
+        '''
+        script = self.redis.register_script(lua_code)
+        count = script(
+            keys=[self.routing_key, self.queued_key, self.lanes_key],
+            args=[self.message_key])
+        if count:
+            log.warning('Removed %d ids of messages no longer queued from '
+                        'the index of %s', count, self.routing_key)
+        return count
 
     def close(self):
         return
 
 
 def get_publisher(routing_key):
-    connection = get_connection()
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
     if backend in ('amqp', 'ampq'):
-        channel = connection.channel()
+        connection, channel = get_amqp_channel()
         channel.exchange_declare(exchange=EXCHANGE_NAME, durable=True)
         return Publisher(connection,
                          channel,
                          EXCHANGE_NAME,
                          routing_key=routing_key)
     if backend == 'redis':
-        return RedisPublisher(connection, routing_key)
+        return RedisPublisher(get_connection(), routing_key)
 
 
 class FakeMethod(object):
@@ -268,25 +611,369 @@ class RedisConsumer(object):
         # Message keys are harvest_job_id for the gather consumer and
         # harvest_object_id for the fetch consumer
         self.message_key = routing_key.split(':')[-1]
+        # Sorted set of the ids of the messages being processed, scored by the
+        # time they were taken off the queue, so stale ones can be found
+        # without scanning the whole keyspace
+        self.inflight_key = routing_key + '.inflight'
+        # See RedisPublisher
+        self.queued_key = routing_key + '.queued'
+        self.lanes_key = routing_key + '.lanes'
+        self.lanes = source_lanes_enabled()
+        # Hashes of how many times each message was delivered, and of the last
+        # error while handling it, cleared when it is acknowledged
+        self.retries_key = routing_key + '.retries'
+        self.errors_key = routing_key + '.errors'
+        # The lists to take messages from (see queue_keys), the one to try
+        # first next time and when the list of lanes was last refreshed
+        self._queues = [routing_key]
+        self._next_queue = routing_key
+        self._queues_refreshed = 0
+
+    def consume(self, queue, inactivity_timeout=None):
+        '''
+        Yields the messages on the queue as they come.
 
-    def consume(self, queue):
+        Like with pika, if ``inactivity_timeout`` (in seconds) is given,
+        ``(None, None, None)`` is yielded when no message arrived in that time.
+        '''
         while True:
-            key, body = self.redis.blpop(self.routing_key)
+            message = self._blpop(inactivity_timeout)
+            if message is None:
+                yield (None, None, None)
+                continue
+            key, body = message
             try:
-                self.redis.set(self.persistance_key(body), str(datetime.datetime.now()))
+                self._start(body)
             except Exception as e:
                 log.error("Redis Exception: %s", e)
                 continue
 
             yield (FakeMethod(body), self, body)
 
+    def queue_keys(self):
+        '''
+        Returns the lists to take messages from, in the order to try them.
+
+        With source lanes enabled, these are the lists of the sources with
+        messages waiting plus the main one, starting after the one the last
+        message was taken from, so that each source gets its turn.
+        '''
+        if not self.lanes:
+            return [self.routing_key]
+        if time.time() - self._queues_refreshed > LANES_REFRESH:
+            self._queues = sorted(self._active_lanes()) + [self.routing_key]
+            self._queues_refreshed = time.time()
+        if self._next_queue not in self._queues:
+            return list(self._queues)
+        start = self._queues.index(self._next_queue)
+        return self._queues[start:] + self._queues[:start]
+
+    def _active_lanes(self):
+        # Use a script to make the operation atomic, RedisPublisher adds
+        # lanes back after pushing to them
+        lua_code = b'''
+            local lanes_key = KEYS[1]
+            local active = {}
+            for _, lane in ipairs(redis.call("smembers", lanes_key)) do
+                if redis.call("llen", lane) == 0 then
+                    redis.call("srem", lanes_key, lane)
+                else
+                    active[#active + 1] = lane
+                end
+            end
+            return active
+        '''
+        script = self.redis.register_script(lua_code)
+        return script(keys=[self.lanes_key])
+
+    def _taken_from(self, key):
+        '''Makes the list after ``key`` the first one tried next time.'''
+        if self.lanes and key in self._queues:
+            index = self._queues.index(key) + 1
+            self._next_queue = self._queues[index % len(self._queues)]
+
+    def _blpop(self, inactivity_timeout):
+        '''
+        Waits for the next message on the queue, returning ``(key, body)``,
+        or None if none arrived in ``inactivity_timeout`` seconds.
+        '''
+        if not self.lanes:
+            return self.redis.blpop(self.routing_key,
+                                    timeout=inactivity_timeout or 0)
+        # New lanes are only seen when refreshing them, so don't block for
+        # longer than that at a time
+        deadline = time.time() + inactivity_timeout \
+            if inactivity_timeout else None
+        while True:
+            timeout = LANES_REFRESH
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.time())
+                if timeout <= 0:
+                    return None
+            message = self.redis.blpop(self.queue_keys(),
+                                       timeout=max(1, int(math.ceil(timeout))))
+            if message is not None:
+                self._taken_from(message[0])
+                return message
+
+    def _start(self, body):
+        # BLPOP can't be used in a script, so this happens after the message
+        # was taken off the queue. If the consumer dies in between, the id is
+        # left in the set of queued ids, see RedisPublisher.prune_queued_index
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self.persistance_key(body), str(datetime.datetime.now()))
+        pipe.zadd(self.inflight_key, {self.message_id(body): time.time()})
+        pipe.srem(self.queued_key, self.message_id(body))
+        pipe.execute()
+
+    def consume_batch(self, queue, size, inactivity_timeout=None):
+        '''
+        Like ``consume``, but yields lists of up to ``size`` messages.
+
+        The messages are taken off the queue, and their persistence keys set,
+        by a single script call. When the queue is empty it waits for the
+        next message with BLPOP. If the server can't run the script (e.g.
+        scripting is disabled) it falls back to ``consume``, yielding batches
+        of one message.
+
+        If ``inactivity_timeout`` is given, an empty list is yielded when no
+        message arrived in that time.
+        '''
+        # Use a script to make the operation atomic
+        lua_code = b'''
+            local routing_key = KEYS[1]
+            local inflight_key = KEYS[2]
+            local queued_key = KEYS[3]
+            local message_key = ARGV[1]
+            local size = tonumber(ARGV[2])
+            -- the lists to take the messages from, one from each in turn
+            local queues = {}
+            for i = 4, #KEYS do
+                queues[#queues + 1] = KEYS[i]
+            end
+            local messages = {}
+            local last = ""
+            while #messages < size and #queues > 0 do
+                local remaining = {}
+                for _, queue in ipairs(queues) do
+                    if #messages == size then
+                        break
+                    end
+                    local s = redis.call("lpop", queue)
+                    if s ~= false then
+                        local ok, value = pcall(cjson.decode, s)
+                        if ok and type(value) == "table" and type(value[message_key]) == "string" then
+                            local id = value[message_key]
+                            redis.call("set", routing_key .. ":" .. id, ARGV[3])
+                            redis.call("zadd", inflight_key, ARGV[4], id)
+                            redis.call("srem", queued_key, id)
+                        end
+                        messages[#messages + 1] = s
+                        remaining[#remaining + 1] = queue
+                        last = queue
+                    end
+                end
+                queues = remaining
+            end
+            return {messages, last}
+        '''
+        script = self.redis.register_script(lua_code)
+        while True:
+            try:
+                batch, popped = self._pop_batch(script, size)
+            except redis.exceptions.ResponseError as e:
+                log.warning('Could not take a batch of messages off %s, '
+                            'falling back to BLPOP: %s', self.routing_key, e)
+                for message in self.consume(queue, inactivity_timeout):
+                    yield [] if message[0] is None else [message]
+                return
+            if batch:
+                yield batch
+                continue
+            if popped:
+                continue
+
+            # The queue is empty, wait for the next message
+            message = self._blpop(inactivity_timeout)
+            if message is None:
+                yield []
+                continue
+            key, body = message
+            try:
+                self._start(body)
+            except Exception as e:
+                log.error("Redis Exception: %s", e)
+                continue
+            batch = [(FakeMethod(body), self, body)]
+            if size > 1:
+                # and take any others sent with it
+                batch.extend(self._pop_batch(script, size - 1)[0])
+            yield batch
+
+    def _pop_batch(self, script, size):
+        bodies, last = script(
+            keys=[self.routing_key, self.inflight_key, self.queued_key]
+            + self.queue_keys(),
+            args=[self.message_key, size,
+                  str(datetime.datetime.now()), time.time()])
+        self._taken_from(last)
+        batch = []
+        for body in bodies:
+            try:
+                valid = isinstance(self.message_id(body), str)
+            except (ValueError, KeyError, TypeError):
+                valid = False
+            if valid:
+                batch.append((FakeMethod(body), self, body))
+            else:
+                log.error('Invalid message on %s: %s', self.routing_key, body)
+        return batch, len(bodies)
+
+    def message_id(self, message):
+        return json.loads(message)[self.message_key]
+
     def persistance_key(self, message):
         # If you change this, make sure to update the script in `queue_purge`
-        message = json.loads(message)
-        return self.routing_key + ':' + message[self.message_key]
+        return self.routing_key + ':' + self.message_id(message)
 
     def basic_ack(self, message):
-        self.redis.delete(self.persistance_key(message))
+        self.basic_ack_many([message])
+
+    def basic_ack_many(self, messages):
+        '''Acknowledges all the given messages with a single round trip.'''
+        if not messages:
+            return
+        ids = [self.message_id(m) for m in messages]
+        pipe = self.redis.pipeline(transaction=False)
+        for message in messages:
+            pipe.delete(self.persistance_key(message))
+        pipe.zrem(self.inflight_key, *ids)
+        pipe.hdel(self.retries_key, *ids)
+        pipe.hdel(self.errors_key, *ids)
+        pipe.execute()
+
+    def touch(self, messages):
+        '''
+        Renews the in-flight time of the given messages, if they are still in
+        flight.
+        '''
+        now = time.time()
+        self.redis.zadd(self.inflight_key,
+                        dict((self.message_id(m), now) for m in messages),
+                        xx=True)
+
+    def count_delivery(self, message):
+        '''
+        Counts a new delivery of the message, returning how many times it has
+        been delivered.
+        '''
+        return self.redis.hincrby(self.retries_key, self.message_id(message), 1)
+
+    def record_error(self, message, error):
+        '''Records the error raised while handling the message.'''
+        self.redis.hset(self.errors_key, self.message_id(message), json.dumps({
+            'error': '{0}: {1}'.format(type(error).__name__, error),
+            'time': datetime.datetime.utcnow().isoformat(),
+        }))
+
+    def last_error(self, message):
+        value = self.redis.hget(self.errors_key, self.message_id(message))
+        return json.loads(value) if value else None
+
+    def resubmit_stale(self, max_age):
+        '''
+        Puts back on the queue the messages that were taken off it more than
+        ``max_age`` seconds ago and never acknowledged, returning how many
+        were resubmitted.
+        '''
+        self.seed_inflight()
+        cutoff = time.time() - max_age
+        stale_ids = self.redis.zrangebyscore(self.inflight_key, '-inf', cutoff)
+        if not stale_ids:
+            return 0
+
+        args = [cutoff]
+        for id in stale_ids:
+            log.debug('Re-new message %s on %s in redis', id, self.routing_key)
+            args.extend([id, json.dumps({self.message_key: id})])
+
+        # Use a script to make the operation atomic
+        lua_code = b'''
+            local routing_key = KEYS[1]
+            local inflight_key = KEYS[2]
+            local queued_key = KEYS[3]
+            local cutoff = tonumber(ARGV[1])
+            local count = 0
+            for i = 2, #ARGV, 2 do
+                local id = ARGV[i]
+                local score = redis.call("zscore", inflight_key, id)
+                -- skip messages acknowledged since they were listed
+                if score and tonumber(score) <= cutoff then
+                    redis.call("rpush", routing_key, ARGV[i + 1])
+                    redis.call("sadd", queued_key, id)
+                    redis.call("del", routing_key .. ":" .. id)
+                    redis.call("zrem", inflight_key, id)
+                    count = count + 1
+                end
+            end
+            return count
+        '''
+        script = self.redis.register_script(lua_code)
+        return script(
+            keys=[self.routing_key, self.inflight_key, self.queued_key],
+            args=args)
+
+    def seed_inflight(self):
+        '''
+        Adds to the in-flight sorted set the messages that only have a
+        persistence key, returning how many were added.
+
+        Messages taken off the queue by a version of this extension without
+        the sorted set (up to 1.6.x) only have their persistence key, whose
+        value is the time they were taken. This runs once, the first time
+        stale messages are looked for after upgrading, and can be dropped in
+        the next release.
+        '''
+        seeded_key = self.inflight_key + '.seeded'
+        if self.redis.exists(seeded_key):
+            return 0
+
+        args = []
+        prefix = self.routing_key + ':'
+        for key in self.redis.scan_iter(match=prefix + '*',
+                                        count=get_publish_batch_size()):
+            value = self.redis.get(key)
+            if value is None:
+                continue
+            try:
+                taken = datetime.datetime.fromisoformat(value).timestamp()
+            except ValueError:
+                log.warning('Invalid persistence key %s: %s', key, value)
+                continue
+            args.extend([key[len(prefix):], taken])
+
+        # Use a script to make the operation atomic, skipping messages
+        # acknowledged since their key was read
+        lua_code = b'''
+            local routing_key = KEYS[1]
+            local inflight_key = KEYS[2]
+            local count = 0
+            for i = 1, #ARGV, 2 do
+                local id = ARGV[i]
+                if redis.call("exists", routing_key .. ":" .. id) == 1 then
+                    count = count + redis.call("zadd", inflight_key, "NX", ARGV[i + 1], id)
+                end
+            end
+            redis.call("set", KEYS[3], 1)
+            return count
+        '''
+        script = self.redis.register_script(lua_code)
+        count = script(
+            keys=[self.routing_key, self.inflight_key, seeded_key], args=args)
+        if count:
+            log.info('Added %d messages in flight on %s to %s', count,
+                     self.routing_key, self.inflight_key)
+        return count
 
     def queue_purge(self, queue=None):
         '''
@@ -298,42 +985,233 @@ class RedisConsumer(object):
         # Use a script to make the operation atomic
         lua_code = b'''
             local routing_key = KEYS[1]
+            local inflight_key = KEYS[2]
+            local queued_key = KEYS[3]
+            local lanes_key = KEYS[4]
             local message_key = ARGV[1]
             local count = 0
-            while true do
-                local s = redis.call("lpop", routing_key)
-                if s == false then
-                    break
+            redis.call("del", inflight_key)
+            redis.call("del", queued_key)
+            redis.call("del", KEYS[5])
+            redis.call("del", KEYS[6])
+            local queues = redis.call("smembers", lanes_key)
+            queues[#queues + 1] = routing_key
+            redis.call("del", lanes_key)
+            for _, queue in ipairs(queues) do
+                while true do
+                    local s = redis.call("lpop", queue)
+                    if s == false then
+                        break
+                    end
+                    local value = cjson.decode(s)
+                    local id = value[message_key]
+                    local persistance_key = routing_key .. ":" .. id
+                    redis.call("del", persistance_key)
+                    count = count + 1
                 end
-                local value = cjson.decode(s)
-                local id = value[message_key]
-                local persistance_key = routing_key .. ":" .. id
-                redis.call("del", persistance_key)
-                count = count + 1
             end
             return count
         '''
         script = self.redis.register_script(lua_code)
-        return script(keys=[self.routing_key], args=[self.message_key])
+        return script(
+            keys=[self.routing_key, self.inflight_key, self.queued_key,
+                  self.lanes_key, self.retries_key, self.errors_key],
+            args=[self.message_key])
 
     def basic_get(self, queue):
-        body = self.redis.lpop(self.routing_key)
+        # Use a script to make the operation atomic, so the id never stays in
+        # the set of queued ids once the message is off the queue
+        lua_code = b'''
+            local queued_key = KEYS[1]
+            local message_key = ARGV[1]
+            for i = 2, #KEYS do
+                local s = redis.call("lpop", KEYS[i])
+                if s ~= false then
+                    local ok, value = pcall(cjson.decode, s)
+                    if ok and type(value) == "table" and type(value[message_key]) == "string" then
+                        redis.call("srem", queued_key, value[message_key])
+                    end
+                    return {s, KEYS[i]}
+                end
+            end
+            return false
+        '''
+        script = self.redis.register_script(lua_code)
+        # Don't miss lanes added since they were last refreshed
+        self._queues_refreshed = 0
+        body = None
+        popped = script(keys=[self.queued_key] + self.queue_keys(),
+                        args=[self.message_key])
+        if popped:
+            body, key = popped
+            self._taken_from(key)
         return (FakeMethod(body), self, body)
 
 
 def get_consumer(queue_name, routing_key):
 
-    connection = get_connection()
     backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
 
     if backend in ('amqp', 'ampq'):
-        channel = connection.channel()
+        _, channel = get_amqp_channel()
         channel.exchange_declare(exchange=EXCHANGE_NAME, durable=True)
-        channel.queue_declare(queue=queue_name, durable=True)
+        arguments = None
+        if _priority_queues() and queue_name == get_fetch_queue_name():
+            arguments = {'x-max-priority': MAX_PRIORITY}
+        channel.queue_declare(queue=queue_name, durable=True, arguments=arguments)
         channel.queue_bind(queue=queue_name, exchange=EXCHANGE_NAME, routing_key=routing_key)
+        if get_prefetch_count():
+            channel.basic_qos(prefetch_count=get_prefetch_count())
         return channel
     if backend == 'redis':
-        return RedisConsumer(connection, routing_key)
+        return RedisConsumer(get_connection(), routing_key)
+
+
+class RedisDeadLetters(object):
+    '''
+    The fetch messages that were delivered too many times, kept on a Redis
+    list along with why and when they failed.
+    '''
+    def __init__(self, redis, routing_key):
+        self.redis = redis
+        self.key = routing_key + '.dead'
+
+    def add(self, record):
+        self.redis.rpush(self.key, json.dumps(record))
+
+    def list(self, limit=None):
+        end = -1 if limit is None else limit - 1
+        return [json.loads(value)
+                for value in self.redis.lrange(self.key, 0, end)]
+
+    def take(self, count):
+        '''
+        Returns the first ``count`` records and a function that removes them,
+        to call once they have been dealt with.
+
+        The records stay on the list until then, so none are lost if they
+        can't be dealt with. Two replays running at the same time can take the
+        same records, which are then sent twice but only removed once.
+        '''
+        values = self.redis.lrange(self.key, 0, count - 1)
+
+        def remove():
+            # Remove these very records, in one transaction: records may have
+            # been added, purged or removed by another replay since they were
+            # read, so the list can't just be trimmed by their count
+            pipe = self.redis.pipeline(transaction=True)
+            for value in values:
+                pipe.lrem(self.key, 1, value)
+            pipe.execute()
+        return [json.loads(value) for value in values], remove
+
+    def purge(self):
+        pipe = self.redis.pipeline()
+        pipe.llen(self.key)
+        pipe.delete(self.key)
+        count, _ = pipe.execute()
+        return count
+
+    def close(self):
+        return
+
+
+class AmqpDeadLetters(object):
+    '''
+    The fetch messages that were delivered too many times, kept on a
+    RabbitMQ queue along with why and when they failed.
+    '''
+    def __init__(self, connection, channel, queue_name):
+        self.connection = connection
+        self.queue_name = queue_name
+        self.channel = channel
+        self.channel.queue_declare(queue=queue_name, durable=True)
+
+    def add(self, record):
+        self.channel.basic_publish(
+            '', self.queue_name, json.dumps(record),
+            properties=pika.BasicProperties(delivery_mode=2))
+
+    def list(self, limit=None):
+        # Messages that are not acknowledged go back to the queue when the
+        # channel is closed
+        channel = self.connection.channel()
+        records = []
+        try:
+            while limit is None or len(records) < limit:
+                method, header, body = channel.basic_get(self.queue_name)
+                if method is None:
+                    break
+                records.append(json.loads(body))
+        finally:
+            channel.close()
+        return records
+
+    def take(self, count):
+        '''
+        Returns the first ``count`` records and a function that removes them,
+        to call once they have been dealt with.
+        '''
+        records = []
+        last_tag = None
+        while len(records) < count:
+            method, header, body = self.channel.basic_get(self.queue_name)
+            if method is None:
+                break
+            records.append(json.loads(body))
+            last_tag = method.delivery_tag
+
+        def remove():
+            if last_tag is not None:
+                self.channel.basic_ack(last_tag, multiple=True)
+        return records, remove
+
+    def purge(self):
+        return self.channel.queue_purge(queue=self.queue_name).method.message_count
+
+    def close(self):
+        # The connection is shared (see get_connection), only close the channel
+        if self.channel.is_open:
+            self.channel.close()
+
+
+def get_dead_letters():
+    backend = config.get('ckan.harvest.mq.type', MQ_TYPE)
+    if backend in ('amqp', 'ampq'):
+        connection, channel = get_amqp_channel()
+        return AmqpDeadLetters(connection, channel,
+                               get_fetch_queue_name() + '.dead')
+    if backend == 'redis':
+        return RedisDeadLetters(get_connection(), get_fetch_routing_key())
+
+
+def replay_dead_letters(limit=None):
+    '''
+    Sends the messages of the dead letter queue back to the fetch queue
+    (up to ``limit`` of them), setting their objects back to WAITING.
+    Returns how many were sent.
+    '''
+    dead_letters = get_dead_letters()
+    publisher = get_fetch_publisher()
+    batch_size = get_publish_batch_size()
+    count = 0
+    while limit is None or count < limit:
+        size = batch_size if limit is None else min(batch_size, limit - count)
+        records, remove = dead_letters.take(size)
+        if not records:
+            break
+        model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(
+                [record['harvest_object_id'] for record in records])) \
+            .update({'state': 'WAITING', 'retry_times': 0},
+                    synchronize_session=False)
+        model.Session.commit()
+        publisher.send_many(record['payload'] for record in records)
+        remove()
+        count += len(records)
+    publisher.close()
+    dead_letters.close()
+    return count
 
 
 def gather_callback(channel, method, header, body):
@@ -370,30 +1248,36 @@ def gather_callback(channel, method, header, body):
     # matches
     harvester = get_harvester(job.source.type)
     if harvester:
+        # Send the ids to the fetch queue as the gather stage creates them
+        sent = 0
         try:
-            harvest_object_ids = gather_stage(harvester, job)
+            # Closed before returning, so the job is saved as gathered
+            with contextlib.closing(iter_gather_stage(harvester, job)) as batches:
+                for harvest_object_ids in batches:
+                    if harvest_object_ids is None:
+                        log.error('Gather stage failed')
+                        publisher.close()
+                        channel.basic_ack(method.delivery_tag)
+                        return False
+
+                    log.debug('Received from plugin gather_stage: {0} objects (first: {1} last: {2})'.format(
+                        len(harvest_object_ids), harvest_object_ids[:1], harvest_object_ids[-1:]))
+                    sent += publisher.send_many(
+                        ({'harvest_object_id': id, 'harvest_source_id': job.source_id}
+                         for id in harvest_object_ids),
+                        priority=get_fetch_priority(
+                            job.source, sent + len(harvest_object_ids)))
         except (Exception, KeyboardInterrupt):
             channel.basic_ack(method.delivery_tag)
             raise
 
-        if not isinstance(harvest_object_ids, list):
-            log.error('Gather stage failed')
-            publisher.close()
-            channel.basic_ack(method.delivery_tag)
-            return False
-
-        if len(harvest_object_ids) == 0:
+        if sent == 0:
             log.info('No harvest objects to fetch')
             publisher.close()
             channel.basic_ack(method.delivery_tag)
             return False
 
-        log.debug('Received from plugin gather_stage: {0} objects (first: {1} last: {2})'.format(
-            len(harvest_object_ids), harvest_object_ids[:1], harvest_object_ids[-1:]))
-        for id in harvest_object_ids:
-            # Send the id to the fetch queue
-            publisher.send({'harvest_object_id': id})
-        log.debug('Sent {0} objects to the fetch queue'.format(len(harvest_object_ids)))
+        log.debug('Sent {0} objects to the fetch queue'.format(sent))
 
     else:
         # This can occur if you:
@@ -424,12 +1308,66 @@ def gather_stage(harvester, job):
     some error handling.
 
     This is split off from gather_callback so that tests can call it without
-    dealing with queue stuff.
+    dealing with queue stuff. If the harvester implements
+    ``iter_gather_stage``, all the ids it yields are collected in the list
+    returned.
+    '''
+    harvest_object_ids = []
+    with contextlib.closing(iter_gather_stage(harvester, job)) as batches:
+        for ids in batches:
+            if ids is None:
+                return None
+            harvest_object_ids.extend(ids)
+    return harvest_object_ids
+
+
+def iter_gather_stage(harvester, job):
+    '''
+    Calls the harvester's gather stage and yields the harvest object ids it
+    creates, in lists, as soon as they are available.
+
+    If the harvester implements ``iter_gather_stage`` (a generator of ids or
+    of lists of ids) it is used instead of ``gather_stage``, so the ids are
+    sent to the fetch queue before the gather stage finishes. Single ids are
+    yielded in lists of up to ``ckan.harvest.mq.publish_batch_size``.
+
+    ``None`` is yielded if the gather stage failed, ie ``gather_stage``
+    didn't return a list or ``iter_gather_stage`` yielded None. If the
+    harvester raises an exception, all the objects of the job are deleted,
+    including the ones already yielded.
     '''
     job.gather_started = datetime.datetime.utcnow()
 
     try:
-        harvest_object_ids = harvester.gather_stage(job)
+        if not inspect.isgeneratorfunction(
+                getattr(harvester, 'iter_gather_stage', None)):
+            harvest_object_ids = harvester.gather_stage(job)
+            if not isinstance(harvest_object_ids, list):
+                yield None
+            elif harvest_object_ids:
+                yield harvest_object_ids
+            return
+
+        batch_size = get_publish_batch_size()
+        batch = []
+        with contextlib.closing(harvester.iter_gather_stage(job)) as items:
+            for item in items:
+                if item is None or isinstance(item, (list, tuple)):
+                    if batch:
+                        yield batch
+                        batch = []
+                    if item is None:
+                        yield None
+                        return
+                    if item:
+                        yield list(item)
+                else:
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
     except (Exception, KeyboardInterrupt):
         harvest_objects = model.Session.query(HarvestObject).filter_by(
             harvest_job_id=job.id
@@ -441,96 +1379,589 @@ def gather_stage(harvester, job):
     finally:
         job.gather_finished = datetime.datetime.utcnow()
         job.save()
-    return harvest_object_ids
 
 
 def fetch_callback(channel, method, header, body):
     try:
-        id = json.loads(body)['harvest_object_id']
-        log.info('Received harvest object id: %s' % id)
-    except KeyError:
-        log.error('No harvest object id received')
-        channel.basic_ack(method.delivery_tag)
-        return False
-
-    try:
-        obj = HarvestObject.get(id)
-    except sqlalchemy.exc.DatabaseError:
+        obj = _get_object_to_fetch(channel, method, header, body)
+    except sqlalchemy.exc.DatabaseError as e:
         # Occasionally we see: sqlalchemy.exc.OperationalError
         # "SSL connection has been closed unexpectedly"
         # or DatabaseError "connection timed out"
-        log.exception('Connection Error during fetch of job %s', id)
+        log.exception('Connection Error during fetch of message %s', body)
+        _record_error(_redis_consumer(channel), body, e)
         # By not sending the ack, it will be retried later.
         # Try to clear the issue with a remove.
         model.Session.remove()
         return
     if not obj:
-        log.error('Harvest object does not exist: %s' % id)
-        channel.basic_ack(method.delivery_tag)
         return False
 
-    obj.retry_times += 1
-    obj.save()
+    # Send the harvest object to the plugins that implement
+    # the Harvester interface, only if the source type
+    # matches
+    try:
+        for harvester in PluginImplementations(IHarvester):
+            if harvester.info()['name'] == obj.source.type:
+                fetch_and_import_stages(_thread_harvester(harvester), obj)
+    except Exception as e:
+        _record_error(_redis_consumer(channel), body, e)
+        raise
+
+    model.Session.remove()
+    channel.basic_ack(method.delivery_tag)
+
+
+def fetch_batch_callback(channel, messages):
+    '''
+    Handles a batch of fetch messages (see ``consume_batches``) one after
+    the other, and then acknowledges them together.
+    '''
+    acks = BatchAck(channel, [method.delivery_tag for method, _, _ in messages])
+    try:
+        for method, header, body in messages:
+            acks.start(method.delivery_tag)
+            fetch_callback(acks, method, header, body)
+    finally:
+        acks.flush()
+
+
+class BatchAck(object):
+    '''
+    Stands in for the channel in the callbacks of a batch of messages,
+    collecting their acks so they can be sent together with ``flush``.
+
+    On Redis the messages of a batch are all marked as in flight when the
+    batch is taken off the queue, and ``resubmit_jobs`` puts back the ones in
+    flight for too long. So when a message starts more than
+    ``BATCH_RESTAMP_INTERVAL`` seconds after that, the acks so far are sent
+    and the in-flight time of the rest of the batch is renewed first.
+    '''
+    def __init__(self, channel, delivery_tags):
+        self.channel = channel
+        self.delivery_tags = delivery_tags
+        self.acked = []
+        self.stamped = time.time()
+
+    def start(self, delivery_tag):
+        '''Called before handling each message of the batch.'''
+        if not isinstance(self.channel, RedisConsumer) or \
+                time.time() - self.stamped < BATCH_RESTAMP_INTERVAL:
+            return
+        self.flush()
+        index = self.delivery_tags.index(delivery_tag)
+        self.channel.touch(self.delivery_tags[index:])
+        self.stamped = time.time()
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def flush(self):
+        if isinstance(self.channel, RedisConsumer):
+            # Messages not acknowledged are resubmitted by resubmit_jobs
+            self.channel.basic_ack_many(self.acked)
+        else:
+            # An ack with multiple=True covers every message delivered
+            # before, so the ones not acknowledged are put back on the queue
+            # first
+            for delivery_tag in self.delivery_tags:
+                if delivery_tag not in self.acked:
+                    self.channel.basic_nack(delivery_tag, requeue=True)
+            if self.acked:
+                self.channel.basic_ack(max(self.acked), multiple=True)
+        self.acked = []
+
+
+def consume_batches(consumer, queue, size):
+    '''
+    Yields lists of up to ``size`` messages from ``queue``.
+
+    On Redis they are taken off the queue together (see
+    ``RedisConsumer.consume_batch``). On RabbitMQ a batch is the next message
+    plus the ones already delivered to the consumer, so make sure the prefetch
+    count is at least ``size``.
+    '''
+    if isinstance(consumer, RedisConsumer):
+        return consumer.consume_batch(queue, size)
+    return _consume_amqp_batches(consumer, queue, size)
+
+
+def _consume_amqp_batches(channel, queue, size):
+    prefetch_count = get_prefetch_count()
+    if prefetch_count and prefetch_count < size:
+        channel.basic_qos(prefetch_count=size)
+    messages = channel.consume(queue=queue)
+    for message in messages:
+        batch = [message]
+        while len(batch) < size and channel.get_waiting_message_count():
+            batch.append(next(messages))
+        yield batch
+
+
+def _get_object_to_fetch(channel, method, header, body):
+    '''
+    Returns the harvest object of a fetch message, or None (acknowledging the
+    message) if it should not be fetched.
+
+    Messages delivered ``MAX_FETCH_ATTEMPTS`` times are moved to the dead
+    letter queue (see ``get_dead_letters``).
+    '''
+    try:
+        id = json.loads(body)['harvest_object_id']
+        log.info('Received harvest object id: %s' % id)
+    except KeyError:
+        log.error('No harvest object id received')
+        channel.basic_ack(method.delivery_tag)
+        return None
+
+    # Load the job and source with the object, as the harvesters need them
+    obj = model.Session.query(HarvestObject).autoflush(False) \
+        .options(sqlalchemy.orm.joinedload(HarvestObject.job)
+                 .joinedload(HarvestJob.source)) \
+        .filter(HarvestObject.id == id).first()
+    if not obj:
+        log.error('Harvest object does not exist: %s' % id)
+        channel.basic_ack(method.delivery_tag)
+        return None
 
-    if obj.retry_times >= 5:
+    consumer = _redis_consumer(channel)
+    attempts = _count_delivery(consumer, method, header, body, obj)
+    if attempts >= MAX_FETCH_ATTEMPTS:
         obj.state = "ERROR"
+        obj.retry_times = attempts
         obj.save()
         log.error('Too many consecutive retries for object {0}'.format(obj.id))
+        record = _dead_letter_record(consumer, body, obj, attempts)
+        if isinstance(channel, ThreadSafeChannel):
+            channel.add_dead_letter(record)
+        else:
+            dead_letters = get_dead_letters()
+            dead_letters.add(record)
+            dead_letters.close()
         channel.basic_ack(method.delivery_tag)
-        return False
+        return None
 
     # check if job has been set to finished
-    job = HarvestJob.get(obj.harvest_job_id)
+    job = obj.job
     if job.status == 'Finished':
         obj.state = "ERROR"
         obj.report_status = "errored"
         obj.save()
         log.error('Job {0} was aborted or timed out, object {1} set to error'.format(job.id, obj.id))
         channel.basic_ack(method.delivery_tag)
-        return False
+        return None
 
-    # Send the harvest object to the plugins that implement
-    # the Harvester interface, only if the source type
-    # matches
-    for harvester in PluginImplementations(IHarvester):
-        if harvester.info()['name'] == obj.source.type:
-            fetch_and_import_stages(harvester, obj)
+    return obj
 
-    model.Session.remove()
-    channel.basic_ack(method.delivery_tag)
+
+def _redis_consumer(channel):
+    '''
+    Returns the ``RedisConsumer`` a fetch message was taken from, given the
+    channel passed to the callback, or None on RabbitMQ.
+    '''
+    if isinstance(channel, BatchAck):
+        channel = channel.channel
+    return channel if isinstance(channel, RedisConsumer) else None
+
+
+def _count_delivery(consumer, method, header, body, obj):
+    '''
+    Returns how many times a fetch message has been delivered, counting
+    this delivery. ``consumer`` is the ``RedisConsumer`` it was taken from,
+    if any.
+
+    The count is kept by the queue backend rather than the database where
+    possible: on Redis in a hash (see ``RedisConsumer.count_delivery``) and on
+    RabbitMQ quorum queues in the ``x-delivery-count`` header. Classic
+    RabbitMQ queues only flag redeliveries, so those are counted on the
+    object's ``retry_times``.
+    '''
+    if consumer is not None:
+        return consumer.count_delivery(body)
+    headers = getattr(header, 'headers', None) or {}
+    if 'x-delivery-count' in headers:
+        return int(headers['x-delivery-count']) + 1
+    if not getattr(method, 'redelivered', False):
+        return 1
+    obj.retry_times = max(obj.retry_times or 0, 1) + 1
+    obj.save()
+    return obj.retry_times
+
+
+def _record_error(consumer, body, error):
+    if consumer is not None:
+        try:
+            consumer.record_error(body, error)
+        except redis.RedisError:
+            log.exception('Could not record the error of message %s', body)
+
+
+def _dead_letter_record(consumer, body, obj, attempts):
+    if consumer is not None:
+        last_error = consumer.last_error(body)
+    else:
+        last_error = None
+    if last_error is None:
+        error = model.Session.query(HarvestObjectError) \
+            .filter_by(harvest_object_id=obj.id) \
+            .order_by(HarvestObjectError.created.desc()) \
+            .first()
+        if error:
+            last_error = {'error': error.message,
+                          'time': error.created.isoformat()}
+
+    def isoformat(date):
+        return date.isoformat() if date else None
+
+    return {
+        'payload': json.loads(body),
+        'harvest_object_id': obj.id,
+        'harvest_job_id': obj.harvest_job_id,
+        'harvest_source_id': obj.harvest_source_id,
+        'attempts': attempts,
+        'last_error': last_error,
+        'gathered': isoformat(obj.gathered),
+        'fetch_started': isoformat(obj.fetch_started),
+        'fetch_finished': isoformat(obj.fetch_finished),
+        'dead_lettered': datetime.datetime.utcnow().isoformat(),
+    }
+
+
+class ThreadSafeChannel(object):
+    '''
+    Wraps an AMQP channel so that messages can be acknowledged from the fetch
+    worker threads. Pika connections are not thread safe, so the acks are
+    handed over to the thread consuming the queue.
+    '''
+    def __init__(self, channel):
+        self.channel = channel
+
+    def basic_ack(self, delivery_tag):
+        self.channel.connection.add_callback_threadsafe(
+            functools.partial(self.channel.basic_ack, delivery_tag))
+
+    def add_dead_letter(self, record):
+        '''Publishes a record on the dead letter queue through the channel of
+        the consumer, instead of a connection of the worker thread that
+        nothing would keep alive.'''
+        self.channel.connection.add_callback_threadsafe(
+            functools.partial(self._add_dead_letter, record))
+
+    def _add_dead_letter(self, record):
+        # Not closed, the channel is the consumer's
+        AmqpDeadLetters(self.channel.connection, self.channel,
+                        get_fetch_queue_name() + '.dead').add(record)
+
+
+def _init_worker():
+    _worker_harvesters.copies = {}
+
+
+def _thread_harvester(harvester):
+    '''
+    Returns the harvester to use on the current thread.
+
+    Harvesters are singletons, and many keep the state of the source being
+    handled on the instance (e.g. ``self.config``). So each worker thread of
+    ``consume_with_workers`` gets its own shallow copy, unless the harvester
+    sets ``thread_safe = True``. Other threads get the harvester itself.
+    '''
+    copies = getattr(_worker_harvesters, 'copies', None)
+    if copies is None or getattr(harvester, 'thread_safe', False):
+        return harvester
+    key = type(harvester)
+    if key not in copies:
+        # Not with copy.copy, which would go through the plugin's __new__
+        copies[key] = object.__new__(key)
+        copies[key].__dict__.update(harvester.__dict__)
+    return copies[key]
+
+
+def consume_with_workers(consumer, queue, callback, workers):
+    '''
+    Consumes ``queue`` handing each message over to ``callback`` on a pool of
+    ``workers`` threads.
+
+    A new message is only taken off the queue once a worker is free to handle
+    it, so the rest stay on the queue for other consumers. Each worker uses
+    its own (thread local) ``model.Session``, which is removed after every
+    message, and its own copy of the harvesters (see ``_thread_harvester``).
+    If a callback raises an exception the consumer stops once the messages in
+    progress are done and the exception is raised again, like the single
+    threaded consumer does. Messages not acknowledged are retried later.
+    '''
+    amqp = not isinstance(consumer, RedisConsumer)
+    if amqp:
+        channel = ThreadSafeChannel(consumer)
+        # Don't let the broker push more messages than the workers can take
+        consumer.basic_qos(prefetch_count=workers)
+    else:
+        channel = consumer
+    # Wake up regularly to check for errors on the workers
+    messages = consumer.consume(queue=queue, inactivity_timeout=1)
+
+    slots = threading.BoundedSemaphore(workers)
+    errors = []
+
+    def work(method, header, body):
+        try:
+            callback(channel, method, header, body)
+        except Exception as e:
+            log.exception('Error handling message %s', body)
+            errors.append(e)
+        finally:
+            model.Session.remove()
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers,
+                                initializer=_init_worker) as executor:
+            while not errors:
+                if amqp:
+                    # Keep running the acks and heartbeats while waiting
+                    while not slots.acquire(blocking=False):
+                        consumer.connection.process_data_events(time_limit=1)
+                else:
+                    slots.acquire()
+                method, header, body = next(messages)
+                if method is None:
+                    # inactivity timeout
+                    slots.release()
+                    continue
+                executor.submit(work, method, header, body)
+    finally:
+        if amqp and consumer.connection.is_open:
+            consumer.connection.process_data_events(time_limit=0)
+    raise errors[0]
+
+
+def get_fetch_concurrency(source):
+    '''
+    Returns how many objects of a source can be fetched at the same time by
+    the async fetch consumer: the ``fetch_concurrency`` option of the source
+    configuration, or ``ckan.harvest.fetch_concurrency``.
+    '''
+    value = _source_config_option(source, 'fetch_concurrency')
+    if value is None:
+        value = config.get('ckan.harvest.fetch_concurrency', FETCH_CONCURRENCY)
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return FETCH_CONCURRENCY
+
+
+def get_fetch_priority(source, object_count):
+    '''
+    Returns the RabbitMQ priority of the fetch messages of a job with
+    ``object_count`` objects, when the source lanes are enabled.
+
+    It is the ``fetch_priority`` option of the source configuration (0 to
+    ``MAX_PRIORITY``), or else the fewer objects the higher the priority, so
+    that small jobs go ahead of big ones.
+    '''
+    value = _source_config_option(source, 'fetch_priority')
+    if value is None:
+        value = MAX_PRIORITY - int(math.log10(max(object_count, 1)))
+    try:
+        return min(MAX_PRIORITY, max(0, int(value)))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _source_config_option(source, key):
+    try:
+        source_config = json.loads(source.config or '{}')
+    except ValueError:
+        return None
+    if isinstance(source_config, dict):
+        return source_config.get(key)
+    return None
+
+
+def consume_async(consumer, queue, max_in_flight):
+    '''
+    Consumes the fetch ``queue`` running up to ``max_in_flight`` fetches at the
+    same time on an asyncio event loop.
+
+    Objects whose harvester implements ``async_fetch_stage`` are fetched
+    concurrently, up to ``get_fetch_concurrency`` at a time for each source.
+    Everything else, including the import stage, runs on the event loop
+    thread. Each message is handled by its own task, with its own
+    ``model.Session`` (see ``_sessions_per_task``), so that the commits and
+    rollbacks of one object don't affect the others. Harvesters without
+    ``async_fetch_stage`` are run synchronously, as with ``fetch_callback``.
+    '''
+    with _sessions_per_task():
+        asyncio.run(_consume_async(consumer, queue, max_in_flight))
+
+
+def _task_scope():
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        # no event loop running on this thread
+        task = None
+    return task or threading.get_ident()
+
+
+@contextlib.contextmanager
+def _sessions_per_task():
+    '''
+    Scopes ``model.Session`` to the running asyncio task (or thread, outside
+    of tasks) until the block ends, instead of to the thread.
+    '''
+    registry = model.Session.registry
+    model.Session.registry = sqlalchemy.orm.scoped_session(
+        model.Session.session_factory, scopefunc=_task_scope).registry
+    try:
+        yield
+    finally:
+        model.Session.registry = registry
+
+
+async def _consume_async(consumer, queue, max_in_flight):
+    loop = asyncio.get_running_loop()
+    amqp = not isinstance(consumer, RedisConsumer)
+    if amqp:
+        channel = ThreadSafeChannel(consumer)
+        consumer.basic_qos(prefetch_count=max_in_flight)
+    else:
+        channel = consumer
+    # The queue is read on its own thread, so waiting for messages doesn't
+    # block the fetches. Pika connections are not thread safe, so that thread
+    # is also the one that sends the acks (see ThreadSafeChannel).
+    queue_thread = ThreadPoolExecutor(max_workers=1)
+    messages = consumer.consume(queue=queue, inactivity_timeout=1)
+
+    slots = asyncio.Semaphore(max_in_flight)
+    source_slots = {}
+    tasks = set()
+    errors = []
+
+    async def handle(method, header, body):
+        try:
+            try:
+                obj = _get_object_to_fetch(channel, method, header, body)
+            except sqlalchemy.exc.DatabaseError as e:
+                log.exception('Connection Error during fetch of message %s', body)
+                _record_error(_redis_consumer(channel), body, e)
+                # By not sending the ack, it will be retried later
+                return
+            if not obj:
+                return
+            harvester = get_harvester(obj.source.type)
+            if harvester and inspect.iscoroutinefunction(
+                    getattr(harvester, 'async_fetch_stage', None)):
+                source_slot = source_slots.get(obj.harvest_source_id)
+                if source_slot is None:
+                    source_slot = source_slots[obj.harvest_source_id] = \
+                        asyncio.Semaphore(get_fetch_concurrency(obj.source))
+                async with source_slot:
+                    await async_fetch_and_import_stages(harvester, obj)
+            elif harvester:
+                fetch_and_import_stages(harvester, obj)
+            channel.basic_ack(method.delivery_tag)
+        except Exception as e:
+            log.exception('Error handling message %s', body)
+            _record_error(_redis_consumer(channel), body, e)
+            errors.append(e)
+        finally:
+            model.Session.remove()
+            slots.release()
+
+    try:
+        while not errors:
+            await slots.acquire()
+            method, header, body = await loop.run_in_executor(
+                queue_thread, next, messages)
+            if method is None:
+                # inactivity timeout
+                slots.release()
+                continue
+            task = loop.create_task(handle(method, header, body))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        # Let the fetches in progress finish before stopping
+        await asyncio.gather(*tasks)
+    finally:
+        if amqp and consumer.connection.is_open:
+            await loop.run_in_executor(
+                queue_thread, consumer.connection.process_data_events, 0)
+        queue_thread.shutdown()
+    raise errors[0]
 
 
 def fetch_and_import_stages(harvester, obj):
+    _start_fetch(obj)
+    success_fetch = harvester.fetch_stage(obj)
+    _import_fetched(harvester, obj, success_fetch)
+
+
+async def async_fetch_and_import_stages(harvester, obj):
+    '''
+    Like ``fetch_and_import_stages``, for harvesters implementing
+    ``async_fetch_stage``.
+    '''
+    _start_fetch(obj)
+    # Don't keep the transaction, and its connection, while waiting. This
+    # commit doesn't expire the objects, so that reading them while waiting
+    # doesn't start another one.
+    session = model.Session()
+    expire_on_commit = session.expire_on_commit
+    session.expire_on_commit = False
+    try:
+        session.commit()
+    finally:
+        session.expire_on_commit = expire_on_commit
+    success_fetch = await harvester.async_fetch_stage(obj)
+    # The objects may have been changed by others while waiting, read them
+    # again before importing (keeping the changes made by the fetch)
+    session.flush()
+    session.expire_all()
+    _import_fetched(harvester, obj, success_fetch)
+
+
+def _start_fetch(obj):
     obj.fetch_started = datetime.datetime.utcnow()
     obj.state = "FETCH"
-    obj.save()
-    success_fetch = harvester.fetch_stage(obj)
+    _save(obj)
+
+
+def _import_fetched(harvester, obj, success_fetch):
     obj.fetch_finished = datetime.datetime.utcnow()
-    obj.save()
+    _save(obj, 'stage')
+    if success_fetch is True and _content_unchanged(harvester, obj):
+        obj.state = 'COMPLETE'
+        obj.report_status = 'not modified'
+        _save(obj, 'object')
+        return
     if success_fetch is True:
         # If no errors where found, call the import method
         obj.import_started = datetime.datetime.utcnow()
         obj.state = "IMPORT"
-        obj.save()
+        _save(obj)
         success_import = harvester.import_stage(obj)
+        if _index_commits is not None:
+            _index_commits.imported()
         obj.import_finished = datetime.datetime.utcnow()
         if success_import:
             obj.state = "COMPLETE"
             if success_import == 'unchanged':
                 obj.report_status = 'not modified'
-                obj.save()
+                _save(obj, 'object')
                 return
         else:
             obj.state = "ERROR"
-        obj.save()
+        _save(obj, 'stage')
     elif success_fetch == 'unchanged':
         obj.state = 'COMPLETE'
         obj.report_status = 'not modified'
-        obj.save()
+        _save(obj, 'object')
         return
     else:
         obj.state = "ERROR"
-        obj.save()
+        _save(obj)
     if obj.state == 'ERROR':
         obj.report_status = 'errored'
     elif obj.current is False:
@@ -544,7 +1975,179 @@ def fetch_and_import_stages(harvester, obj):
         obj.report_status = 'updated'
     else:
         obj.report_status = 'added'
-    obj.save()
+    _save(obj, 'object')
+
+
+def get_skip_unchanged_content():
+    '''
+    Returns whether the import stage is skipped for the harvest objects whose
+    content hasn't changed since the current object with the same guid
+    (``ckan.harvest.skip_unchanged_content``, off by default).
+    '''
+    return toolkit.asbool(
+        config.get('ckan.harvest.skip_unchanged_content', False))
+
+
+def get_content_hash(obj):
+    '''
+    Returns the digest of the content of a harvest object. The config of its
+    source is part of it, so changing the config imports everything again.
+    '''
+    digest = hashlib.sha256()
+    digest.update((obj.job.source.config or '').encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(obj.content.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _content_unchanged(harvester, obj):
+    '''
+    Sets the ``content_hash`` of a fetched harvest object, and returns True if
+    it's the same as the one of the current object with the same guid and
+    ``get_skip_unchanged_content`` is on, so it doesn't need to be imported.
+    It's always imported when forced (see ``_force_import``).
+    '''
+    if obj.content is None:
+        return False
+    obj.content_hash = get_content_hash(obj)
+    if not get_skip_unchanged_content() or _force_import(harvester, obj):
+        return False
+    current = model.Session.query(HarvestObject.content_hash).filter(
+        HarvestObject.harvest_source_id == obj.harvest_source_id,
+        HarvestObject.guid == obj.guid,
+        HarvestObject.current == True  # noqa: E712
+    ).first()
+    return current is not None and current[0] == obj.content_hash
+
+
+def _force_import(harvester, obj):
+    '''
+    Returns whether the import of a harvest object has been forced, with the
+    ``force_import`` attribute of the harvester (as set by
+    ``harvest_objects_import``), of the object, or of its job (the guids
+    given to ``harvester run-test --force-import``).
+    '''
+    if getattr(harvester, 'force_import', False) or \
+            getattr(obj, 'force_import', False):
+        return True
+    guids = getattr(obj.job, 'force_import', None)
+    return bool(guids) and obj.guid in guids
+
+
+def get_index_commit_batch_size():
+    '''
+    Returns how many harvest objects the fetch consumer imports before it
+    commits the search index (``ckan.harvest.index_commit_batch_size``). 0, the
+    default, keeps committing it after every dataset.
+    '''
+    return toolkit.asint(config.get('ckan.harvest.index_commit_batch_size', 0))
+
+
+class DeferredIndexCommits(object):
+    '''
+    Turns off the commit of the search index after every dataset
+    (``ckan.search.solr_commit``) and commits it once every ``batch_size``
+    imported objects instead. The datasets indexed since the last commit don't
+    show up in searches until the next one, or until ``harvest_jobs_run``
+    marks their job as finished.
+    '''
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.pending = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._solr_commit_set = 'ckan.search.solr_commit' in config
+        self._solr_commit = config.get('ckan.search.solr_commit')
+        config['ckan.search.solr_commit'] = False
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._solr_commit_set:
+            config['ckan.search.solr_commit'] = self._solr_commit
+        else:
+            config.pop('ckan.search.solr_commit', None)
+        self.flush()
+
+    def imported(self):
+        with self._lock:
+            self.pending += 1
+            if self.pending < self.batch_size:
+                return
+            self.pending = 0
+        commit_search_index()
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, 0
+        if pending:
+            commit_search_index()
+
+
+@contextlib.contextmanager
+def defer_index_commits():
+    '''
+    Defers the commits of the search index done by the import stage while the
+    fetch consumer runs, if ``get_index_commit_batch_size`` is more than one.
+    '''
+    global _index_commits
+    batch_size = get_index_commit_batch_size()
+    if batch_size <= 1:
+        yield None
+        return
+    _index_commits = DeferredIndexCommits(batch_size)
+    try:
+        with _index_commits:
+            yield _index_commits
+    finally:
+        _index_commits = None
+
+
+def commit_search_index():
+    '''
+    Commits the pending changes of the search index. Errors are logged, the
+    changes are committed with the next commit.
+    '''
+    try:
+        search.commit()
+    except search.SearchIndexError as e:
+        log.error('Error committing the search index: %r', e)
+
+
+def get_fetch_commit_mode():
+    '''
+    Returns when the changes of state of the harvest objects during the fetch
+    and import stages are committed (``ckan.harvest.fetch_commit_mode``):
+
+    * ``state`` (default): on every change
+    * ``stage``: at the end of the fetch stage and of the import stage
+    * ``object``: once the object is done
+
+    Changes not committed yet are written with the next commit, which may
+    happen earlier, e.g. when the harvester creates a dataset. If the fetch
+    consumer dies before that, the object is left in its last committed state
+    (e.g. WAITING rather than FETCH) and its message is retried as usual.
+    '''
+    mode = config.get('ckan.harvest.fetch_commit_mode', FETCH_COMMIT_MODES[0])
+    if mode not in FETCH_COMMIT_MODES:
+        log.warning('Unknown ckan.harvest.fetch_commit_mode %r, using %r',
+                    mode, FETCH_COMMIT_MODES[0])
+        return FETCH_COMMIT_MODES[0]
+    return mode
+
+
+def _save(obj, commit_point=None):
+    '''
+    Saves a change of state of a harvest object, committing it or not
+    depending on ``get_fetch_commit_mode``. ``commit_point`` is ``stage`` at
+    the end of a stage and ``object`` when the object is done.
+    '''
+    mode = get_fetch_commit_mode()
+    if mode == 'state' or commit_point == 'object' or \
+            (mode == 'stage' and commit_point == 'stage'):
+        obj.save()
+    else:
+        model.Session.add(obj)
 
 
 def get_gather_consumer():
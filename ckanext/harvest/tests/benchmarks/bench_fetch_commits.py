@@ -0,0 +1,57 @@
+'''Counts the database commits per harvest object of the fetch and import
+stages, for each ``ckan.harvest.fetch_commit_mode``.
+
+It harvests a few objects with the harvester of ``test_queue2`` (which saves
+the fetched content and creates a dataset for each object) and counts the
+commits of the whole ``fetch_and_import_stages`` call, including the ones
+made by the harvester itself. It needs the same setup as the tests::
+
+    pytest --ckan-ini=test.ini -s \\
+        ckanext/harvest/tests/benchmarks/bench_fetch_commits.py
+
+'''
+from __future__ import print_function
+
+import pytest
+from sqlalchemy import event
+
+from ckan import model
+
+from ckanext.harvest import queue
+from ckanext.harvest.tests.factories import HarvestSourceObj, HarvestJobObj
+from ckanext.harvest.tests.test_queue2 import MockHarvester
+
+OBJECTS = 20
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_queues')
+@pytest.mark.ckan_config('ckan.plugins', 'harvest test_harvester2')
+@pytest.mark.parametrize('commit_mode', queue.FETCH_COMMIT_MODES)
+def test_commits_per_object(commit_mode, ckan_config, monkeypatch):
+    monkeypatch.setitem(
+        ckan_config, 'ckan.harvest.fetch_commit_mode', commit_mode)
+    harvester = MockHarvester()
+    source = HarvestSourceObj(url='http://some-url.com',
+                              source_type=harvester.info()['name'])
+    job = HarvestJobObj(source=source, run=False)
+
+    objects = []
+    for i in range(OBJECTS):
+        MockHarvester._set_test_params(
+            guid='bench-{0}-{1}'.format(commit_mode, i))
+        objects.extend(queue.gather_stage(harvester, job))
+
+    commits = []
+
+    def count(session):
+        commits.append(session)
+    event.listen(model.Session, 'after_commit', count)
+    try:
+        for obj_id in objects:
+            obj = queue.HarvestObject.get(obj_id)
+            queue.fetch_and_import_stages(harvester, obj)
+    finally:
+        event.remove(model.Session, 'after_commit', count)
+
+    print('\n{0:<8} {1:>6} commits per object'.format(
+        commit_mode, len(commits) / float(len(objects))))
@@ -0,0 +1,72 @@
+'''Measures how fast harvest object ids can be put on the Redis fetch queue.
+
+Compares publishing one message at a time (``RedisPublisher.send``, what
+``gather_callback`` used to do) with the pipelined ``send_many``. It needs a
+running redis-server, and it uses its own list key so it doesn't touch any
+real harvest queue::
+
+    python -m ckanext.harvest.tests.benchmarks.bench_publish \\
+        --redis-url redis://localhost:6379/15 --messages 100000
+
+No redis-server was at hand when this was written, so these figures are from
+fakeredis (Python 3.11, ``publish_batch_size`` 1000). In process, where a
+round trip costs nothing but the command itself::
+
+    send           100000 msgs    42.64s       2345 msgs/s
+    send_many      100000 msgs     4.96s      20178 msgs/s
+
+and through fakeredis' TCP server, whose round trips are very slow (~44ms)::
+
+    send             2000 msgs    88.69s         23 msgs/s
+    send_many        2000 msgs     0.25s       8101 msgs/s
+
+Against a real server the gap mostly depends on the latency to it.
+
+'''
+from __future__ import print_function
+
+import argparse
+import time
+import uuid
+
+import redis
+
+from ckanext.harvest.queue import RedisPublisher
+
+ROUTING_KEY = 'ckanext-harvest:benchmark:harvest_object_id'
+
+
+def _run(label, publish, client, ids):
+    client.delete(ROUTING_KEY)
+    start = time.time()
+    publish(ids)
+    elapsed = time.time() - start
+    assert client.llen(ROUTING_KEY) == len(ids)
+    client.delete(ROUTING_KEY)
+    print('{0:<12} {1:>8} msgs {2:>8.2f}s {3:>10.0f} msgs/s'.format(
+        label, len(ids), elapsed, len(ids) / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    publisher = RedisPublisher(client, ROUTING_KEY)
+    ids = [str(uuid.uuid4()) for _ in range(args.messages)]
+
+    def one_by_one(ids):
+        for id in ids:
+            publisher.send({'harvest_object_id': id})
+
+    def batched(ids):
+        publisher.send_many({'harvest_object_id': id} for id in ids)
+
+    _run('send', one_by_one, client, ids)
+    _run('send_many', batched, client, ids)
+
+
+if __name__ == '__main__':
+    main()
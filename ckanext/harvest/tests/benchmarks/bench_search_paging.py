@@ -0,0 +1,62 @@
+'''Compares paging through the datasets of a large remote CKAN with keyset
+paging (sorted by metadata_modified), with an offset and with several pages
+requested at the same time (``search_concurrency``).
+
+It runs the mock CKAN of the tests, with ``--datasets`` datasets (100000 by
+default), and ranks the results like SOLR, so the deeper an offset page is the slower it is to
+return. The "large_offset" remote doesn't return metadata_modified, so the
+harvester falls back to paging with an offset. ``--latency`` adds some
+seconds to each request, like a remote site far away::
+
+    python -m ckanext.harvest.tests.benchmarks.bench_search_paging \\
+        --rows 1000 --latency 0.2 --concurrency 8
+
+'''
+from __future__ import print_function
+
+import argparse
+import time
+
+from ckanext.harvest.harvesters.ckanharvester import CKANHarvester
+from ckanext.harvest.tests.harvesters import mock_ckan
+
+
+def _run(label, remote, rows, concurrency=1):
+    harvester = CKANHarvester()
+    harvester.config = {'search_rows': rows,
+                        'search_concurrency': concurrency}
+    del mock_ckan.SEARCH_REQUESTS[:]
+    start = time.time()
+    count = 0
+    for page in harvester._search_for_datasets_in_pages(
+            'http://localhost:%s/%s' % (mock_ckan.PORT, remote)):
+        count += len(page)
+    elapsed = time.time() - start
+    seconds = [s for _, s in mock_ckan.SEARCH_REQUESTS]
+    print('{0:<14} {1:>7} datasets {2:>5} requests {3:>8.2f}s '
+          '(slowest request {4:.3f}s)'.format(
+              label, count, len(seconds), elapsed, max(seconds)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--datasets', type=int, default=100000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    mock_ckan.SEARCH_LATENCY = args.latency
+    mock_ckan.LARGE_DATASET_COUNT = args.datasets
+    mock_ckan.LARGE_MAX_ROWS = 1000
+    mock_ckan.serve()
+    large_datasets = mock_ckan.large_datasets()
+    print('{0} datasets on the remote'.format(len(large_datasets)))
+    _run('keyset', 'large', args.rows)
+    _run('offset', 'large_offset', args.rows)
+    _run('{0} in parallel'.format(args.concurrency), 'large', args.rows,
+         args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
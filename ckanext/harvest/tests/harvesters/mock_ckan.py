@@ -1,14 +1,17 @@
 from __future__ import print_function
 
+import datetime
+import heapq
 import json
 import re
 import copy
+import time
 from urllib.parse import unquote_plus
 
 from threading import Thread
 
 from http.server import SimpleHTTPRequestHandler
-from socketserver import TCPServer
+from socketserver import ThreadingMixIn, TCPServer
 
 
 PORT = 8998
@@ -90,18 +93,21 @@ class MockCkanHandler(SimpleHTTPRequestHandler):
         if self.path.startswith('/api/action/package_search'):
             params = self.get_url_params()
 
-            if self.test_name == 'datasets_added':
-                if params['start'] == '0':
-                    # when page 1 is retrieved, the site only has 1 dataset
+            count = None
+            if self.test_name in ('large', 'large_offset', 'large_same_date'):
+                return self.respond_action(self.search_large(params))
+            elif self.test_name == 'datasets_added':
+                if params['start'] == '0' and 'fq' not in params:
+                    # when page 1 is retrieved, a second dataset is being
+                    # added to the site
                     datasets = [DATASETS[0]['name']]
-                elif params['start'] == '100':
-                    # when page 2 is retrieved, the site now has new datasets,
-                    # and so the second page has the original dataset, pushed
-                    # onto this page now, plus a new one
+                    count = 2
+                else:
+                    # when page 2 is retrieved, the site now has the new
+                    # dataset, and so the second page has the original
+                    # dataset, pushed onto this page now, plus the new one
                     datasets = [DATASETS[0]['name'],
                                 DATASETS[1]['name']]
-                else:
-                    datasets = []
             else:
                 # ignore sort param for now
                 if 'sort' in params:
@@ -134,7 +140,7 @@ class MockCkanHandler(SimpleHTTPRequestHandler):
                         'Not implemented search params %s' % params,
                         status=400)
 
-            out = {'count': len(datasets),
+            out = {'count': len(datasets) if count is None else count,
                    'results': [self.get_dataset(dataset_ref_)
                                for dataset_ref_ in datasets]}
             return self.respond_action(out)
@@ -144,6 +150,44 @@ class MockCkanHandler(SimpleHTTPRequestHandler):
 
         self.respond('Mock CKAN doesnt recognize that call', status=400)
 
+    def search_large(self, params):
+        '''package_search over LARGE_DATASET_COUNT datasets, sorted by
+        metadata_modified and id, or just by id. It supports paging with start
+        and metadata_modified:[date TO *] filters, returns at most
+        LARGE_MAX_ROWS datasets and records the params and the time spent on
+        each request in SEARCH_REQUESTS. Like SOLR, it has to rank the first
+        start + rows datasets to return a page, so deep pages get slower.
+        With "large_offset" it doesn't return metadata_modified, like a remote
+        where the datasets can only be paged with an offset, and with
+        "large_same_date" all the datasets were modified at the same time.
+        Each request takes SEARCH_LATENCY seconds more.
+        '''
+        started = time.time()
+        datasets = large_datasets()
+        if self.test_name == 'large_same_date':
+            datasets = [dict(d, metadata_modified=datasets[0]['metadata_modified'])
+                        for d in datasets]
+        since = re.search(r'metadata_modified:\[(\S+) TO \*\]',
+                          params.get('fq', ''))
+        if since:
+            since = since.groups()[0].rstrip('Z')
+            datasets = [d for d in datasets if d['metadata_modified'] >= since]
+        if params.get('sort') == 'id asc':
+            def key(d):
+                return d['id']
+        else:
+            def key(d):
+                return (d['metadata_modified'], d['id'])
+        start = int(params.get('start', 0))
+        rows = min(int(params.get('rows', 10)), LARGE_MAX_ROWS)
+        ranked = heapq.nsmallest(start + rows, datasets, key=key)
+        results = ranked[start:start + rows]
+        if self.test_name == 'large_offset':
+            results = [dict(d, metadata_modified=None) for d in results]
+        time.sleep(SEARCH_LATENCY)
+        SEARCH_REQUESTS.append((params, time.time() - started))
+        return {'count': len(datasets), 'results': results}
+
     def get_dataset(self, dataset_ref):
         for dataset in DATASETS:
             if dataset['name'] == dataset_ref or \
@@ -193,8 +237,11 @@ def serve(port=PORT):
     # os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),
     #                      'mock_ckan_files'))
 
-    class TestServer(TCPServer):
+    class TestServer(ThreadingMixIn, TCPServer):
         allow_reuse_address = True
+        # so that harvesters can request several pages at the same time
+        daemon_threads = True
+        request_queue_size = 50
 
     httpd = TestServer(("", PORT), MockCkanHandler)
 
@@ -205,6 +252,35 @@ def serve(port=PORT):
     httpd_thread.start()
 
 
+LARGE_DATASET_COUNT = 300
+# Most datasets the large remote returns in a page
+LARGE_MAX_ROWS = 50
+
+# Params of each package_search request to the large remote, and the time
+# spent on it
+SEARCH_REQUESTS = []
+# Seconds added to each package_search request to the large remote, eg to
+# simulate a remote site far away
+SEARCH_LATENCY = 0
+
+_large_datasets = []
+
+
+def large_datasets():
+    '''Returns LARGE_DATASET_COUNT minimal datasets, sorted by
+    metadata_modified, three of them modified at the same time.'''
+    if not _large_datasets:
+        modified = datetime.datetime(2020, 1, 1)
+        for i in range(LARGE_DATASET_COUNT):
+            _large_datasets.append({
+                'id': 'large-%06d' % i,
+                'name': 'large-%06d' % i,
+                'metadata_modified': (
+                    modified + datetime.timedelta(seconds=i // 3)).isoformat(),
+            })
+    return _large_datasets
+
+
 def convert_dataset_to_restful_form(dataset):
     dataset = copy.deepcopy(dataset)
     dataset['extras'] = dict([(e['key'], e['value']) for e in dataset['extras']])
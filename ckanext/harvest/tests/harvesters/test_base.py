@@ -1,14 +1,18 @@
+import json
 import re
 
 import pytest
 try:
-    from unittest.mock import patch
+    from unittest.mock import patch, Mock
 except ImportError:
-    from mock import patch
+    from mock import patch, Mock
 
 
-from ckanext.harvest.harvesters.base import HarvesterBase, munge_tag
-from ckantoolkit.tests import factories
+from ckanext.harvest.harvesters.base import (HarvesterBase, LookupCache,
+                                             SourceConfig, munge_tag)
+from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.tests.factories import HarvestJobObj
+from ckantoolkit.tests import factories, helpers
 
 _ensure_name_is_unique = HarvesterBase._ensure_name_is_unique
 
@@ -113,6 +117,146 @@ class TestEnsureNameIsUnique(object):
         assert re.match(r'trees[\da-f]{5}', name)
 
 
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+class TestCreateHarvestObjectsInBulk(object):
+
+    def test_batches(self):
+        job = HarvestJobObj()
+        harvester = HarvesterBase()
+        harvester.object_batch_size = 2
+
+        batches = list(harvester._create_harvest_objects_in_bulk(
+            job, (('guid-%d' % i, '{"i": %d}' % i) for i in range(5))))
+
+        assert [len(ids) for ids in batches] == [2, 2, 1]
+        obj = HarvestObject.get(batches[2][0])
+        assert obj.guid == 'guid-4'
+        assert obj.content == '{"i": 4}'
+        assert obj.state == 'WAITING'
+        assert obj.harvest_job_id == job.id
+        assert obj.harvest_source_id == job.source_id
+
+    def test_create_harvest_objects(self):
+        job = HarvestJobObj()
+
+        ids = HarvesterBase()._create_harvest_objects(['a', 'b'], job)
+
+        assert sorted(HarvestObject.get(id).guid for id in ids) == ['a', 'b']
+
+
+class TestHttpSession(object):
+
+    def test_session_per_site(self):
+        harvester = HarvesterBase()
+
+        session = harvester._get_http_session('http://example.com/api/3/action')
+
+        assert harvester._get_http_session('http://example.com/dataset') is session
+        assert harvester._get_http_session('https://example.com/') is not session
+        assert harvester._get_http_session('http://example.org/') is not session
+        assert session.headers['Accept-Encoding'] == 'gzip, deflate'
+
+    @pytest.mark.ckan_config('ckan.harvest.http.retries', '5')
+    @pytest.mark.ckan_config('ckan.harvest.http.timeout', '0')
+    def test_config(self, ckan_config):
+        harvester = HarvesterBase()
+
+        session = harvester._get_http_session('http://retries.example.com/')
+
+        retries = session.get_adapter('http://retries.example.com/').max_retries
+        assert retries.total == 5
+        assert 503 in retries.status_forcelist
+        assert harvester._get_http_timeout() is None
+
+
+class TestSourceConfig(object):
+
+    def test_parsed_once(self):
+        harvester = HarvesterBase()
+        source = Mock(id='source-config-test', config=json.dumps({
+            'default_extras': {'from': '{harvest_source_url}', 'n': 1}}))
+
+        source_config = harvester._get_source_config(source)
+
+        assert source_config.config['default_extras']['n'] == 1
+        assert sorted(source_config.default_extras) == [
+            ('from', '{harvest_source_url}'), ('n', 1)]
+        assert harvester._get_source_config(source) is source_config
+
+        source.config = json.dumps({'default_tags': []})
+        assert harvester._get_source_config(source).config == \
+            {'default_tags': []}
+
+    def test_no_config(self):
+        source = Mock(id='source-config-empty', config=None)
+
+        assert HarvesterBase()._get_source_config(source).config == {}
+
+    @pytest.mark.parametrize('config', ['not json', '[]', '"text"'])
+    def test_not_an_object(self, config):
+        source = Mock(id='source-config-invalid', config=config)
+
+        source_config = HarvesterBase()._get_source_config(source)
+
+        assert source_config.config == {}
+        assert source_config.default_extras == []
+
+    def test_format_extra(self):
+        harvest_object = Mock(id='obj')
+        harvest_object.job.id = 'job'
+        harvest_object.job.source.url = 'http://example.com/'
+
+        assert SourceConfig.format_extra(
+            '{harvest_source_url}/{harvest_job_id}/{dataset_id}',
+            harvest_object, 'pkg') == 'http://example.com/job/pkg'
+        assert SourceConfig.format_extra(1, harvest_object, 'pkg') == 1
+
+
+class TestLookupCache(object):
+
+    def test_get(self):
+        cache = LookupCache('test', 60)
+        lookups = []
+
+        def lookup():
+            lookups.append(1)
+            return 'value'
+
+        assert cache.get('group', lookup) == 'value'
+        assert cache.get('group', lookup) == 'value'
+        assert cache.get('other', lambda: 'other') == 'other'
+
+        assert len(lookups) == 1
+        assert cache.hits == 1
+        assert cache.misses == 2
+        assert cache.hit_rate == 1 / 3.0
+
+    def test_none_not_cached(self):
+        cache = LookupCache('test', 60)
+
+        assert cache.get('group', lambda: None) is None
+
+        assert cache.get('group', lambda: 'created') == 'created'
+
+    def test_no_ttl(self):
+        cache = LookupCache('test', 0)
+
+        cache.get('key', lambda: 1)
+
+        assert cache.get('key', lambda: 2) == 2
+        assert cache.hits == 0
+
+    @pytest.mark.usefixtures('with_plugins', 'clean_db')
+    def test_cleared_when_group_deleted(self):
+        cache = HarvesterBase()._get_lookup_cache('test-job')
+        group = factories.Group()
+        cache.get('group', lambda: group['id'])
+
+        helpers.call_action('group_delete', id=group['id'])
+
+        assert cache.get('group', lambda: None) is None
+
+
 # taken from ckan/tests/lib/test_munge.py
 class TestMungeTag:
 
@@ -12,14 +12,16 @@ from requests.exceptions import HTTPError, RequestException
 from ckantoolkit.tests.helpers import call_action
 from ckantoolkit.tests.factories import Organization, Group
 from ckan import model
+from ckan.lib import search
 from ckan.plugins import toolkit
 
 from ckanext.harvest.harvesters.ckanharvester import ContentFetchError
 from ckanext.harvest.tests.factories import (HarvestSourceObj, HarvestJobObj,
                                              HarvestObjectObj)
-from ckanext.harvest.tests.lib import run_harvest
+from ckanext.harvest.tests.lib import run_harvest, run_harvest_job
 import ckanext.harvest.model as harvest_model
-from ckanext.harvest.harvesters.base import HarvesterBase
+from ckanext.harvest import plugin
+from ckanext.harvest.harvesters.base import HarvesterBase, HTTP_POOL_SIZE
 from ckanext.harvest.harvesters.ckanharvester import CKANHarvester
 
 from . import mock_ckan
@@ -55,6 +57,20 @@ class TestCkanHarvester(object):
         assert harvest_object.guid == mock_ckan.DATASETS[0]['id']
         assert json.loads(harvest_object.content) == mock_ckan.DATASETS[0]
 
+    def test_iter_gather_stage(self):
+        source = HarvestSourceObj(url='http://localhost:%s/' % mock_ckan.PORT)
+        job = HarvestJobObj(source=source)
+
+        harvester = CKANHarvester()
+        batches = list(harvester.iter_gather_stage(job))
+
+        assert job.gather_errors == []
+        assert all(isinstance(ids, list) for ids in batches)
+        obj_ids = [id for ids in batches for id in ids]
+        assert len(obj_ids) == len(mock_ckan.DATASETS)
+        harvest_object = harvest_model.HarvestObject.get(obj_ids[0])
+        assert harvest_object.guid == mock_ckan.DATASETS[0]['id']
+
     def test_fetch_normal(self):
         source = HarvestSourceObj(url='http://localhost:%s/' % mock_ckan.PORT)
         job = HarvestJobObj(source=source)
@@ -187,6 +203,24 @@ class TestCkanHarvester(object):
         assert 'harvest_source_id' in extras_dict
         assert 'harvest_source_title' in extras_dict
 
+    def test_harvest_info_in_package_show_index_prefetch(self):
+        results_by_guid = run_harvest(
+            url='http://localhost:%s' % mock_ckan.PORT,
+            harvester=CKANHarvester())
+        obj_id = results_by_guid['dataset1-id']['obj_id']
+
+        # rebuild the index with the harvest objects loaded at once
+        with plugin.index_prefetch():
+            search.rebuild(package_id=mock_ckan.DATASETS[0]['id'])
+            assert plugin._index_prefetch['objects']['dataset1-id'][0] == obj_id
+        assert plugin._index_prefetch['objects'] == {}
+
+        dataset = call_action('package_show', {"for_view": True}, id=mock_ckan.DATASETS[0]['id'])
+        extras_dict = dict((e['key'], e['value']) for e in dataset['extras'])
+        assert extras_dict['harvest_object_id'] == obj_id
+        assert 'harvest_source_id' in extras_dict
+        assert 'harvest_source_title' in extras_dict
+
     def test_remote_groups_only_local(self):
         # Create an existing group
         Group(id='10037fa4-e683-4a67-892a-efba815e24ad', name='group1')
@@ -211,9 +245,11 @@ class TestCkanHarvester(object):
             url='http://localhost:%s/' % mock_ckan.PORT,
             harvester=CKANHarvester())
 
+        # force_all stops the gather stage skipping the unchanged datasets
         results_by_guid = run_harvest(
             url='http://localhost:%s/' % mock_ckan.PORT,
-            harvester=CKANHarvester())
+            harvester=CKANHarvester(),
+            config=json.dumps({'force_all': True}))
 
         # The metadata_modified was the same for this dataset so the import
         # would have returned 'unchanged'
@@ -224,6 +260,52 @@ class TestCkanHarvester(object):
         assert result['errors'] == []
         assert was_last_job_considered_error_free()
 
+    def test_harvest_not_modified_skipped_in_gather(self):
+        run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester())
+
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester())
+
+        # The remote metadata_modified hasn't changed since the last import,
+        # so no harvest object was created
+        assert results_by_guid == {}
+        assert harvest_model.Session.query(harvest_model.HarvestObject) \
+            .filter_by(guid=mock_ckan.DATASETS[1]['id']).count() == 1
+        assert was_last_job_considered_error_free()
+
+    def test_harvest_config_changed_not_skipped_in_gather(self):
+        source = HarvestSourceObj(url='http://localhost:%s/' % mock_ckan.PORT)
+        run_harvest_job(HarvestJobObj(source=source, run=False),
+                        CKANHarvester())
+
+        source.config = json.dumps({'default_tags': [{'name': 'geo'}]})
+        source.save()
+        results_by_guid = run_harvest_job(
+            HarvestJobObj(source=source, run=False), CKANHarvester())
+
+        # The remote datasets haven't changed, but the config has, so harvest
+        # objects are created for them again
+        result = results_by_guid[mock_ckan.DATASETS[1]['id']]
+        assert result['state'] == 'COMPLETE'
+
+    def test_harvest_deleted_locally_not_skipped_in_gather(self):
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester())
+        call_action('package_delete', {},
+                    id=results_by_guid[mock_ckan.DATASETS[1]['id']]['dataset']['id'])
+
+        results_by_guid = run_harvest(
+            url='http://localhost:%s/' % mock_ckan.PORT,
+            harvester=CKANHarvester())
+
+        # Only the dataset deleted locally is harvested again
+        assert list(results_by_guid) == [mock_ckan.DATASETS[1]['id']]
+        assert results_by_guid[mock_ckan.DATASETS[1]['id']]['state'] == 'COMPLETE'
+
     def test_harvest_whilst_datasets_added(self):
         results_by_guid = run_harvest(
             url='http://localhost:%s/datasets_added' % mock_ckan.PORT,
@@ -248,6 +330,18 @@ class TestCkanHarvester(object):
         tag_names = [tag['name'] for tag in tags]
         assert 'geo' in tag_names
 
+    def test_source_config_not_modified(self):
+        config = {'default_tags': [{'name': 'geo'}]}
+        results_by_guid = run_harvest(
+            url='http://localhost:%s' % mock_ckan.PORT,
+            harvester=CKANHarvester(),
+            config=json.dumps(config))
+        source = harvest_model.HarvestObject.get(
+            results_by_guid['dataset1-id']['obj_id']).source
+
+        # The default tags added to the datasets are copies
+        assert CKANHarvester()._get_source_config(source).config == config
+
     def test_default_tags_invalid(self):
         config = {'default_tags': ['geo']}  # should be list of dicts
         with pytest.raises(toolkit.ValidationError) as harvest_context:
@@ -324,7 +418,7 @@ class TestCkanHarvester(object):
         assert 'default_extras must be a dictionary' in str(harvest_context.value)
 
     @patch('ckanext.harvest.harvesters.ckanharvester.CKANHarvester.config')
-    @patch('ckanext.harvest.harvesters.ckanharvester.requests.get', side_effect=RequestException('Test.value'))
+    @patch('requests.Session.get', side_effect=RequestException('Test.value'))
     def test_get_content_handles_request_exception(
         self, mock_requests_get, mock_config
     ):
@@ -345,7 +439,7 @@ class TestCkanHarvester(object):
             self.request.url = "http://test.example.gov.uk"
 
     @patch('ckanext.harvest.harvesters.ckanharvester.CKANHarvester.config')
-    @patch('ckanext.harvest.harvesters.ckanharvester.requests.get', side_effect=MockHTTPError())
+    @patch('requests.Session.get', side_effect=MockHTTPError())
     def test_get_content_handles_http_error(
         self, mock_requests_get, mock_config
     ):
@@ -357,3 +451,88 @@ class TestCkanHarvester(object):
             harvester._get_content("http://test.example.gov.uk")
 
         assert str(context.value) == 'HTTP error: 404 http://test.example.gov.uk'
+
+
+class TestSearchPaging(object):
+
+    def setup_method(self):
+        del mock_ckan.SEARCH_REQUESTS[:]
+
+    def test_keyset_paging(self):
+        harvester = CKANHarvester()
+        harvester.config = {'search_rows': 10}
+
+        pkg_dicts = harvester._search_for_datasets(
+            'http://localhost:%s/large' % mock_ckan.PORT)
+
+        assert [p['id'] for p in pkg_dicts] == \
+            ['large-%06d' % i for i in range(mock_ckan.LARGE_DATASET_COUNT)]
+        # One request per page of 10, where up to 3 datasets modified at the
+        # same time are seen again
+        assert len(mock_ckan.SEARCH_REQUESTS) <= \
+            mock_ckan.LARGE_DATASET_COUNT // 7 + 1
+        assert all(params['start'] == '0' and
+                   params['sort'] == 'metadata_modified asc, id asc'
+                   for params, _ in mock_ckan.SEARCH_REQUESTS)
+
+    def test_offset_paging(self):
+        harvester = CKANHarvester()
+        # More rows than the remote returns
+        harvester.config = {'search_rows': 100}
+
+        pkg_dicts = harvester._search_for_datasets(
+            'http://localhost:%s/large_offset' % mock_ckan.PORT)
+
+        assert [p['id'] for p in pkg_dicts] == \
+            ['large-%06d' % i for i in range(mock_ckan.LARGE_DATASET_COUNT)]
+        # Without metadata_modified, the first page is requested again sorted
+        # by id, and the rest with the offset of the datasets returned
+        params = [p for p, _ in mock_ckan.SEARCH_REQUESTS]
+        assert [(p['sort'], p['start']) for p in params[:3]] == [
+            ('metadata_modified asc, id asc', '0'),
+            ('id asc', '0'),
+            ('id asc', str(mock_ckan.LARGE_MAX_ROWS))]
+        assert len(params) == \
+            mock_ckan.LARGE_DATASET_COUNT // mock_ckan.LARGE_MAX_ROWS + 2
+
+    def test_same_date_paging(self):
+        harvester = CKANHarvester()
+        harvester.config = {'search_rows': 10}
+
+        pkg_dicts = harvester._search_for_datasets(
+            'http://localhost:%s/large_same_date' % mock_ckan.PORT)
+
+        assert sorted(p['id'] for p in pkg_dicts) == \
+            ['large-%06d' % i for i in range(mock_ckan.LARGE_DATASET_COUNT)]
+        # The second page is the same as the first one, so the rest are
+        # requested sorted by id, with an offset
+        params = mock_ckan.SEARCH_REQUESTS[2][0]
+        assert params['sort'] == 'id asc'
+        assert params['start'] == '0'
+        assert params['fq'] == 'metadata_modified:[2020-01-01T00:00:00Z TO *]'
+
+    def test_parallel_paging(self):
+        harvester = CKANHarvester()
+        harvester.config = {'search_rows': 10, 'search_concurrency': 4}
+
+        pkg_dicts = harvester._search_for_datasets(
+            'http://localhost:%s/large' % mock_ckan.PORT)
+
+        assert [p['id'] for p in pkg_dicts] == \
+            ['large-%06d' % i for i in range(mock_ckan.LARGE_DATASET_COUNT)]
+        # All the pages are sorted by id and requested with an offset, plus
+        # one more for the datasets added in the meantime
+        params = [p for p, _ in mock_ckan.SEARCH_REQUESTS]
+        assert set(p['sort'] for p in params) == set(['id asc'])
+        assert sorted(int(p['start']) for p in params) == \
+            list(range(0, mock_ckan.LARGE_DATASET_COUNT + 1, 10))
+
+    def test_search_concurrency_limit(self):
+        harvester = CKANHarvester()
+        harvester.config = {'search_concurrency': 100}
+
+        assert harvester._get_search_concurrency() == HTTP_POOL_SIZE
+
+    def test_search_rows_validation(self):
+        with pytest.raises(ValueError):
+            CKANHarvester().validate_config(json.dumps({'search_rows': 0}))
@@ -1,6 +1,7 @@
 import json
 import datetime
 import pytest
+import sqlalchemy
 
 from ckan import plugins as p
 from ckan import model
@@ -787,3 +788,130 @@ class TestActions():
         assert len(last_job['gather_error_summary']) == 1
         assert last_job['gather_error_summary'][0]['message'] == harvest_gather_error.message
         assert last_job['gather_error_summary'][0]['error_count'] == 1
+
+    def test_harvest_source_show_status_cache(self):
+
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        context = {'model': model}
+        data_dict = {'id': source.id}
+
+        source_status = get_action('harvest_source_show_status')(context, data_dict)
+        assert source_status['job_count'] == 0
+
+        # creating a job clears the cached status
+        job = factories.HarvestJobObj(source=source)
+        source_status = get_action('harvest_source_show_status')(context, data_dict)
+        assert source_status['job_count'] == 1
+        assert source_status['last_job']['id'] == job.id
+
+        # the cached status can't be changed by the callers
+        source_status['job_count'] = 5
+        source_status = get_action('harvest_source_show_status')(context, data_dict)
+        assert source_status['job_count'] == 1
+
+        # the status is cached separately for the dictize options
+        source_status = get_action('harvest_source_show_status')(
+            {'model': model, 'return_stats': False}, data_dict)
+        assert 'stats' not in source_status['last_job']
+        source_status = get_action('harvest_source_show_status')(context, data_dict)
+        assert 'stats' in source_status['last_job']
+
+    def test_harvest_job_list_stats(self):
+
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        jobs = []
+        for _ in range(2):
+            job = factories.HarvestJobObj(source=source)
+            job.status = 'Finished'
+            job.save()
+            jobs.append(job)
+        for job, statuses in zip(jobs, [['added', 'added', 'updated'],
+                                        ['not modified', 'errored']]):
+            for report_status in statuses:
+                obj = factories.HarvestObjectObj(job=job, source=source)
+                obj.report_status = report_status
+                obj.save()
+        harvest_model.HarvestObjectError(
+            message="Unexpected object error", object=obj).save()
+        harvest_model.HarvestGatherError(
+            message="Unexpected gather error", job=jobs[1]).save()
+
+        context = {'model': model}
+        job_list = get_action('harvest_job_list')(
+            context, {'source_id': source.id})
+
+        stats = dict((job['id'], job['stats']) for job in job_list)
+        assert stats[jobs[0].id] == {
+            'added': 2, 'updated': 1, 'not modified': 0, 'errored': 0,
+            'deleted': 0}
+        assert stats[jobs[1].id] == {
+            'added': 0, 'updated': 0, 'not modified': 1, 'errored': 2,
+            'deleted': 0}
+        for job in jobs:
+            job_dict = get_action('harvest_job_show')(context, {'id': job.id})
+            assert job_dict['stats'] == stats[job.id]
+
+    def test_harvest_job_stats_table(self):
+
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        job = factories.HarvestJobObj(source=source)
+        obj = factories.HarvestObjectObj(job=job, source=source)
+        for report_status in ('errored', 'added'):
+            obj.report_status = report_status
+            obj.save()
+        harvest_model.HarvestObjectError(
+            message="Unexpected object error", object=obj).save()
+
+        job_stats = harvest_model.HarvestJobStats.get(job.id)
+        assert (job_stats.added, job_stats.errored, job_stats.errored_objects) == (1, 0, 1)
+
+        # jobs without stats, eg older than the table, are counted
+        model.Session.delete(job_stats)
+        model.Session.commit()
+        context = {'model': model}
+        job_dict = get_action('harvest_job_show')(context, {'id': job.id})
+        assert job_dict['stats']['added'] == 1
+        assert job_dict['stats']['errored'] == 1
+
+        assert harvest_model.reconcile_job_stats([job.id]) == 1
+        job_stats = harvest_model.HarvestJobStats.get(job.id)
+        assert job_stats.as_stats_dict() == job_dict['stats']
+
+    def test_harvest_job_stats_errors_saved_together(self):
+
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        job = factories.HarvestJobObj(source=source)
+        obj = factories.HarvestObjectObj(job=job, source=source)
+        # both errors are inserted with the same statement
+        model.Session.add_all([
+            harvest_model.HarvestObjectError(message="First", object=obj),
+            harvest_model.HarvestObjectError(message="Second", object=obj)])
+        model.Session.commit()
+        harvest_model.HarvestObjectError(message="Third", object=obj).save()
+
+        job_stats = harvest_model.HarvestJobStats.get(job.id)
+        assert job_stats.errored_objects == 1
+
+    def test_harvest_job_stats_updated_once_per_flush(self):
+
+        source = factories.HarvestSourceObj(**SOURCE_DICT.copy())
+        job = factories.HarvestJobObj(source=source)
+        updates = []
+
+        def count_updates(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE harvest_job_stats'):
+                updates.append(statement)
+
+        engine = model.Session.get_bind()
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count_updates)
+        try:
+            model.Session.add_all([
+                harvest_model.HarvestObject(
+                    guid=str(i), job=job, source=source, report_status='added')
+                for i in range(5)])
+            model.Session.commit()
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count_updates)
+
+        assert len(updates) == 1
+        assert harvest_model.HarvestJobStats.get(job.id).added == 5
@@ -1,17 +1,24 @@
 import pytest
 try:
-    from unittest.mock import patch
+    from unittest.mock import call, patch, Mock
 except ImportError:
-    from mock import patch
+    from mock import call, patch, Mock
 
-from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra, HarvestSource
 from ckanext.harvest.interfaces import IHarvester
 import ckanext.harvest.queue as queue
+import pika
 from ckan.plugins.core import SingletonPlugin, implements
+import asyncio
+import datetime
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from ckan.plugins import toolkit
 from ckan import model
 from ckan.lib.base import config
+import sqlalchemy.orm
+import time
 import uuid
 
 
@@ -88,6 +95,40 @@ class MockHarvester(SingletonPlugin):
         return True
 
 
+class MockAsyncHarvester(object):
+    '''
+    Stands in for MockHarvester, fetching with ``async_fetch_stage`` and
+    recording how many objects it fetches at the same time, and with which
+    sessions.
+    '''
+    def __init__(self):
+        self.fetching = 0
+        self.max_fetching = 0
+        self.sessions = []
+
+    def info(self):
+        return {'name': 'test', 'title': 'test', 'description': 'test'}
+
+    async def async_fetch_stage(self, harvest_object):
+        assert harvest_object.state == "FETCH"
+        assert sqlalchemy.orm.object_session(harvest_object) is model.Session()
+        self.sessions.append(model.Session())
+        self.fetching += 1
+        self.max_fetching = max(self.max_fetching, self.fetching)
+        await asyncio.sleep(0.1)
+        self.fetching -= 1
+        if harvest_object.guid == 'test_to_delete':
+            raise ValueError(harvest_object.guid)
+        harvest_object.content = json.dumps({'name': harvest_object.guid})
+        return True
+
+    def import_stage(self, harvest_object):
+        assert harvest_object.state == "IMPORT"
+        # so nothing stale is indexed
+        assert model.Session().expire_on_commit
+        return True
+
+
 @pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_queues')
 @pytest.mark.ckan_config('ckan.plugins', 'harvest test_harvester')
 class TestHarvestQueue(object):
@@ -253,12 +294,416 @@ class TestHarvestQueue(object):
             queue.purge_queues()
 
             assert redis.get('ckanext-harvest:some-random-key') == 'foobar'
-            assert redis.dbsize() == num_keys
+            # the two sets of queued ids are gone as well
+            assert redis.dbsize() == num_keys - 2
             assert redis.llen(queue.get_gather_routing_key()) == 0
             assert redis.llen(queue.get_fetch_routing_key()) == 0
+            assert redis.scard(gather_consumer.queued_key) == 0
+            assert redis.scard(fetch_consumer.queued_key) == 0
         finally:
             redis.delete('ckanext-harvest:some-random-key')
 
+    @pytest.mark.ckan_config('ckan.harvest.mq.publish_batch_size', '2')
+    def test_send_many(self):
+        '''
+        Test that bulk publishing sends every message, in order, across
+        several batches.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        fetch_routing_key = queue.get_fetch_routing_key()
+        redis.flushdb()
+        try:
+            ids = [str(uuid.uuid4()) for _ in range(5)]
+            publisher = queue.get_fetch_publisher()
+            sent = publisher.send_many(
+                {'harvest_object_id': id} for id in ids)
+
+            assert sent == 5
+            assert [json.loads(item)['harvest_object_id']
+                    for item in redis.lrange(fetch_routing_key, 0, -1)] == ids
+        finally:
+            redis.flushdb()
+
+    @pytest.mark.ckan_config('ckan.harvest.mq.source_lanes', 'true')
+    def test_ensure_queued_index(self):
+        '''
+        Test that the set of queued ids is built from the queue and its
+        lanes when it is missing, and left alone when it exists.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        redis.flushdb()
+        try:
+            publisher = queue.get_fetch_publisher()
+            publisher.send_many([
+                {'harvest_object_id': 'object-1'},
+                {'harvest_object_id': 'object-2',
+                 'harvest_source_id': 'source-1'}])
+            redis.rpush(publisher.routing_key, 'not json')
+            redis.delete(publisher.queued_key)
+
+            assert publisher.ensure_queued_index() == 2
+            assert redis.smembers(publisher.queued_key) == {
+                'object-1', 'object-2'}
+
+            redis.srem(publisher.queued_key, 'object-1')
+            assert publisher.ensure_queued_index() == 0
+            assert redis.smembers(publisher.queued_key) == {'object-2'}
+        finally:
+            redis.flushdb()
+
+    def test_prune_queued_index(self):
+        '''
+        Test that ids left in the set of queued ids by a consumer that died
+        after taking their message off the queue are removed.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        redis.flushdb()
+        try:
+            publisher = queue.get_fetch_publisher()
+            publisher.send_many([
+                {'harvest_object_id': 'object-1'},
+                {'harvest_object_id': 'object-2'}])
+            assert publisher.prune_queued_index() == 0
+
+            # what BLPOP does before the consumer gets to remove the id
+            redis.lpop(publisher.routing_key)
+
+            assert publisher.prune_queued_index() == 1
+            assert redis.smembers(publisher.queued_key) == {'object-2'}
+        finally:
+            redis.flushdb()
+
+    def test_consume_with_workers(self):
+        '''
+        Test that a pool of workers handles and acknowledges every message,
+        and that errors on the workers stop the consumer.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        redis.flushdb()
+        try:
+            ids = [str(uuid.uuid4()) for _ in range(10)]
+            publisher = queue.get_fetch_publisher()
+            publisher.send_many({'harvest_object_id': id} for id in ids)
+            publisher.send({'harvest_object_id': 'stop'})
+            handled = []
+
+            def callback(channel, method, header, body):
+                id = json.loads(body)['harvest_object_id']
+                if id == 'stop':
+                    raise ValueError(id)
+                handled.append(id)
+                channel.basic_ack(method.delivery_tag)
+
+            consumer = queue.get_fetch_consumer()
+            with pytest.raises(ValueError):
+                queue.consume_with_workers(
+                    consumer, queue.get_fetch_queue_name(), callback, 4)
+
+            assert sorted(handled) == sorted(ids)
+            assert redis.zrange(consumer.inflight_key, 0, -1) == ['stop']
+        finally:
+            redis.flushdb()
+
+    def test_consume_with_workers_harvester_copies(self):
+        '''
+        Test that each worker thread gets its own copy of the harvesters, so
+        they don't overwrite each other's source configuration.
+        '''
+        harvester = queue.get_harvester('test')
+        assert queue._thread_harvester(harvester) is harvester
+
+        copies = []
+
+        def work():
+            copy = queue._thread_harvester(harvester)
+            copy.config = {'thread': threading.current_thread().name}
+            copies.append(copy)
+            assert queue._thread_harvester(harvester) is copy
+
+        with ThreadPoolExecutor(max_workers=2,
+                                initializer=queue._init_worker) as executor:
+            futures = [executor.submit(work) for _ in range(6)]
+            for future in futures:
+                future.result()
+
+        assert len(set(map(id, copies))) <= 2
+        assert all(isinstance(copy, type(harvester)) for copy in copies)
+        assert not hasattr(harvester, 'config')
+
+    def test_consume_batch(self):
+        '''
+        Test that messages are taken off the queue in batches, tracked as in
+        flight and acknowledged together.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        redis.flushdb()
+        try:
+            ids = [str(uuid.uuid4()) for _ in range(5)]
+            publisher = queue.get_fetch_publisher()
+            publisher.send_many({'harvest_object_id': id} for id in ids)
+
+            consumer = queue.get_fetch_consumer()
+            batches = consumer.consume_batch(
+                queue.get_fetch_queue_name(), 3, inactivity_timeout=1)
+            batch = next(batches)
+            assert [json.loads(body)['harvest_object_id']
+                    for _, _, body in batch] == ids[:3]
+            assert redis.llen(consumer.routing_key) == 2
+            assert redis.scard(consumer.queued_key) == 2
+            assert sorted(redis.zrange(consumer.inflight_key, 0, -1)) == \
+                sorted(ids[:3])
+            for _, _, body in batch:
+                assert redis.exists(consumer.persistance_key(body))
+
+            consumer.basic_ack_many([body for _, _, body in batch])
+            assert redis.zcard(consumer.inflight_key) == 0
+
+            assert len(next(batches)) == 2
+            assert next(batches) == []
+        finally:
+            redis.flushdb()
+
+    @patch('ckanext.harvest.queue.BATCH_RESTAMP_INTERVAL', 0)
+    def test_batch_outliving_stale_age(self):
+        '''
+        Test that the messages of a batch taking longer than the stale age
+        to handle are not resubmitted while they wait for their turn.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        redis.flushdb()
+        try:
+            ids = [str(uuid.uuid4()) for _ in range(3)]
+            queue.get_fetch_publisher().send_many(
+                {'harvest_object_id': id} for id in ids)
+            consumer = queue.get_fetch_consumer()
+            batch = next(consumer.consume_batch(
+                queue.get_fetch_queue_name(), 3, inactivity_timeout=1))
+            # as if the batch was taken off the queue an hour ago
+            redis.zadd(consumer.inflight_key,
+                       dict((id, time.time() - 3600) for id in ids))
+            handled = []
+
+            def callback(channel, method, header, body):
+                # harvester run while the batch is being handled
+                queue.resubmit_jobs()
+                handled.append(json.loads(body)['harvest_object_id'])
+                channel.basic_ack(method.delivery_tag)
+
+            with patch.object(queue, 'fetch_callback', callback):
+                queue.fetch_batch_callback(consumer, batch)
+
+            assert handled == ids
+            assert redis.llen(consumer.routing_key) == 0
+            assert redis.zcard(consumer.inflight_key) == 0
+        finally:
+            redis.flushdb()
+
+    def test_connection_is_reused(self):
+        connection = queue.get_connection()
+        assert queue.get_connection() is connection
+
+        publisher = queue.get_fetch_publisher()
+        publisher.close()
+        assert queue.get_connection() is connection
+        if config.get('ckan.harvest.mq.type') == 'redis':
+            assert publisher.redis is connection
+        else:
+            assert connection.is_open
+
+    @pytest.mark.ckan_config('ckan.harvest.mq.type', 'amqp')
+    def test_dead_amqp_connection_replaced(self):
+        '''
+        Test that a cached RabbitMQ connection that says it is open, but was
+        dropped by the server, is replaced when a channel can't be opened.
+        '''
+        dead = Mock(is_open=True)
+        dead.channel.side_effect = pika.exceptions.StreamLostError('gone')
+        new = Mock(is_open=True)
+        with patch.object(queue, 'get_connection_amqp',
+                          side_effect=[dead, new]):
+            queue._amqp_connections.connections = {}
+            try:
+                queue.get_connection()
+
+                publisher = queue.get_fetch_publisher()
+
+                assert publisher.connection is new
+                assert publisher.channel is new.channel.return_value
+                assert queue.get_connection() is new
+                dead.close.assert_called_once_with()
+            finally:
+                queue._amqp_connections.connections = {}
+
+    def test_dead_letter_from_worker_amqp(self):
+        '''
+        Test that the workers of consume_with_workers publish dead letters
+        through the consumer's channel, on the consumer's thread.
+        '''
+        consumer = Mock()
+        channel = queue.ThreadSafeChannel(consumer)
+
+        channel.add_dead_letter({'harvest_object_id': 'obj'})
+
+        consumer.basic_publish.assert_not_called()
+        callback, = consumer.connection.add_callback_threadsafe.call_args[0]
+        callback()
+        consumer.queue_declare.assert_called_once_with(
+            queue=queue.get_fetch_queue_name() + '.dead', durable=True)
+        assert consumer.basic_publish.call_args[0][:2] == (
+            '', queue.get_fetch_queue_name() + '.dead')
+        consumer.close.assert_not_called()
+
+    def test_batch_ack_amqp(self):
+        '''
+        Test that a batch is acknowledged with multiple=True, after putting
+        back on the queue the messages that were not acknowledged.
+        '''
+        channel = Mock()
+        acks = queue.BatchAck(channel, [1, 2, 3])
+        acks.basic_ack(1)
+        acks.basic_ack(3)
+        acks.flush()
+
+        channel.basic_nack.assert_called_once_with(2, requeue=True)
+        channel.basic_ack.assert_called_once_with(3, multiple=True)
+        assert channel.mock_calls.index(call.basic_nack(2, requeue=True)) < \
+            channel.mock_calls.index(call.basic_ack(3, multiple=True))
+
+    @pytest.mark.ckan_config('ckan.harvest.mq.source_lanes', 'true')
+    def test_source_lanes(self):
+        '''
+        Test that with source lanes the consumer takes messages from each
+        source in turns, so a small source doesn't wait for a big one.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        redis.flushdb()
+        try:
+            publisher = queue.get_fetch_publisher()
+            publisher.send_many(
+                {'harvest_object_id': 'big-{0}'.format(i),
+                 'harvest_source_id': 'big-source'} for i in range(10))
+            publisher.send_many(
+                {'harvest_object_id': 'small-{0}'.format(i),
+                 'harvest_source_id': 'small-source'} for i in range(2))
+
+            consumer = queue.get_fetch_consumer()
+            messages = consumer.consume(
+                queue.get_fetch_queue_name(), inactivity_timeout=1)
+            ids = [json.loads(next(messages)[2])['harvest_object_id']
+                   for _ in range(4)]
+            assert sorted(ids) == ['big-0', 'big-1', 'small-0', 'small-1']
+
+            assert consumer.queue_purge() == 8
+            # only the persistence keys of the messages taken are left
+            assert redis.dbsize() == 4
+        finally:
+            redis.flushdb()
+
+    @pytest.mark.parametrize('config_, object_count, priority', [
+        (None, 1, 9),
+        (None, 150, 7),
+        (None, 300000, 4),
+        ('{"fetch_priority": 2}', 1, 2),
+    ])
+    def test_get_fetch_priority(self, config_, object_count, priority):
+        source = HarvestSource(url='http://example.com', type='test',
+                               config=config_)
+        assert queue.get_fetch_priority(source, object_count) == priority
+
+    @pytest.mark.ckan_config('ckan.harvest.fetch_concurrency', '3')
+    def test_get_fetch_concurrency(self):
+        source = HarvestSource(url='http://example.com', type='test')
+        assert queue.get_fetch_concurrency(source) == 3
+
+        source.config = json.dumps({'fetch_concurrency': 20})
+        assert queue.get_fetch_concurrency(source) == 20
+
+        source.config = 'not json'
+        assert queue.get_fetch_concurrency(source) == 3
+
+    def test_resubmit_jobs(self):
+        '''
+        Test that only messages in flight for too long are put back on the
+        queue.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        fetch_routing_key = queue.get_fetch_routing_key()
+        redis.flushdb()
+        try:
+            fetch_publisher = queue.get_fetch_publisher()
+            fetch_publisher.send({'harvest_object_id': 'stale-object'})
+            fetch_publisher.send({'harvest_object_id': 'recent-object'})
+            fetch_consumer = queue.get_fetch_consumer()
+            messages = fetch_consumer.consume(queue.get_fetch_queue_name())
+            next(messages)
+            next(messages)
+            assert redis.llen(fetch_routing_key) == 0
+            assert redis.zcard(fetch_consumer.inflight_key) == 2
+
+            # Pretend the first one was taken off the queue an hour ago
+            redis.zadd(fetch_consumer.inflight_key,
+                       {'stale-object': time.time() - 3600})
+
+            queue.resubmit_jobs()
+
+            assert redis.lrange(fetch_routing_key, 0, -1) == [
+                json.dumps({'harvest_object_id': 'stale-object'})]
+            assert redis.zrange(fetch_consumer.inflight_key, 0, -1) == [
+                'recent-object']
+            assert not redis.exists(fetch_routing_key + ':stale-object')
+            assert redis.exists(fetch_routing_key + ':recent-object')
+        finally:
+            redis.flushdb()
+
+    def test_resubmit_jobs_taken_before_upgrade(self):
+        '''
+        Test that messages taken off the queue by a version without the
+        in-flight sorted set, which only have a persistence key, are put
+        back on the queue when they are stale.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        fetch_routing_key = queue.get_fetch_routing_key()
+        redis.flushdb()
+        try:
+            now = datetime.datetime.now()
+            redis.set(fetch_routing_key + ':stale-object',
+                      str(now - datetime.timedelta(hours=1)))
+            redis.set(fetch_routing_key + ':recent-object', str(now))
+
+            queue.resubmit_jobs()
+
+            fetch_consumer = queue.get_fetch_consumer()
+            assert redis.lrange(fetch_routing_key, 0, -1) == [
+                json.dumps({'harvest_object_id': 'stale-object'})]
+            assert redis.zrange(fetch_consumer.inflight_key, 0, -1) == [
+                'recent-object']
+            assert not redis.exists(fetch_routing_key + ':stale-object')
+
+            # only done once
+            redis.set(fetch_routing_key + ':other-object',
+                      str(now - datetime.timedelta(hours=1)))
+            assert fetch_consumer.seed_inflight() == 0
+        finally:
+            redis.flushdb()
+
     def test_resubmit_objects(self):
         '''
         Test that only harvest objects re-submitted which were not be present in the redis fetch queue.
@@ -321,7 +766,142 @@ class TestHarvestQueue(object):
             assert redis.llen(fetch_routing_key) == 2
             fetch_queue_items = redis.lrange(fetch_routing_key, 0, 10)
             assert harvest_object_id in fetch_queue_items
-            assert redis.dbsize() == 1
+            # the fetch queue and its set of queued ids
+            assert redis.dbsize() == 2
+            assert redis.smembers(consumer_fetch.queued_key) == set(
+                json.loads(item)['harvest_object_id']
+                for item in fetch_queue_items)
+        finally:
+            redis.flushdb()
+
+    def test_dead_letters(self):
+        '''
+        Test that objects delivered too many times end up on the dead letter
+        queue, and can be replayed from there.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        fetch_routing_key = queue.get_fetch_routing_key()
+        redis.flushdb()
+        try:
+            consumer = queue.get_gather_consumer()
+            consumer_fetch = queue.get_fetch_consumer()
+            user = toolkit.get_action('get_site_user')(
+                {'model': model, 'ignore_auth': True}, {}
+            )['name']
+            context = {'model': model, 'session': model.Session,
+                       'user': user, 'api_version': 3, 'ignore_auth': True}
+            self._create_harvest_job_and_finish_gather_stage(consumer, context)
+
+            reply = consumer_fetch.basic_get(queue='ckan.harvest.fetch')
+            object_id = json.loads(reply[2])['harvest_object_id']
+            # as if it had been delivered and failed before
+            redis.hset(consumer_fetch.retries_key, object_id,
+                       queue.MAX_FETCH_ATTEMPTS - 1)
+            consumer_fetch.record_error(reply[2], ValueError('Remote error'))
+            queue.fetch_callback(consumer_fetch, *reply)
+
+            assert HarvestObject.get(object_id).state == 'ERROR'
+            assert not redis.exists(consumer_fetch.retries_key)
+            dead_letters = queue.get_dead_letters()
+            records = dead_letters.list()
+            assert len(records) == 1
+            assert records[0]['harvest_object_id'] == object_id
+            assert records[0]['payload'] == json.loads(reply[2])
+            assert records[0]['attempts'] == queue.MAX_FETCH_ATTEMPTS
+            assert records[0]['last_error']['error'] == \
+                'ValueError: Remote error'
+
+            assert queue.replay_dead_letters() == 1
+            assert dead_letters.list() == []
+            assert HarvestObject.get(object_id).state == 'WAITING'
+            assert reply[2] in redis.lrange(fetch_routing_key, 0, -1)
+        finally:
+            redis.flushdb()
+
+    def test_dead_letters_removed_after_purge(self):
+        '''
+        Test that removing the records taken off the dead letter queue
+        doesn't remove others added after a purge in the meantime.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        redis.flushdb()
+        try:
+            dead_letters = queue.get_dead_letters()
+            dead_letters.add({'harvest_object_id': 'object-1'})
+            dead_letters.add({'harvest_object_id': 'object-2'})
+            records, remove = dead_letters.take(2)
+            assert len(records) == 2
+
+            dead_letters.purge()
+            dead_letters.add({'harvest_object_id': 'object-3'})
+            remove()
+
+            assert dead_letters.list() == [{'harvest_object_id': 'object-3'}]
+        finally:
+            redis.flushdb()
+
+    def test_async_fetch_and_import_stages(self):
+        consumer = queue.get_gather_consumer()
+        user = toolkit.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {}
+        )['name']
+        context = {'model': model, 'session': model.Session,
+                   'user': user, 'api_version': 3, 'ignore_auth': True}
+        self._create_harvest_job_and_finish_gather_stage(consumer, context)
+        obj = model.Session.query(HarvestObject).filter_by(guid='test1').one()
+
+        harvester = MockAsyncHarvester()
+        asyncio.run(queue.async_fetch_and_import_stages(harvester, obj))
+
+        model.Session.remove()
+        obj = model.Session.query(HarvestObject).filter_by(guid='test1').one()
+        assert obj.state == 'COMPLETE'
+        assert obj.fetch_started is not None
+        assert obj.import_finished is not None
+        assert json.loads(obj.content) == {'name': 'test1'}
+
+    def test_consume_async(self):
+        '''
+        Test that the objects are fetched at the same time, each with its own
+        session, and that an error stops the consumer once the fetches in
+        progress are done.
+        '''
+        if config.get('ckan.harvest.mq.type') != 'redis':
+            pytest.skip()
+        redis = queue.get_connection()
+        redis.flushdb()
+        try:
+            consumer = queue.get_gather_consumer()
+            consumer_fetch = queue.get_fetch_consumer()
+            user = toolkit.get_action('get_site_user')(
+                {'model': model, 'ignore_auth': True}, {}
+            )['name']
+            context = {'model': model, 'session': model.Session,
+                       'user': user, 'api_version': 3, 'ignore_auth': True}
+            self._create_harvest_job_and_finish_gather_stage(consumer, context)
+            model.Session.remove()
+
+            harvester = MockAsyncHarvester()
+            with patch.object(queue, 'get_harvester', return_value=harvester):
+                with pytest.raises(ValueError):
+                    queue.consume_async(
+                        consumer_fetch, queue.get_fetch_queue_name(), 10)
+
+            assert harvester.max_fetching == 3
+            assert len(set(map(id, harvester.sessions))) == 3
+            assert model.Session() not in harvester.sessions
+            objects = dict(model.Session.query(HarvestObject.guid,
+                                               HarvestObject.state))
+            assert objects == {'test1': 'COMPLETE', 'test2': 'COMPLETE',
+                               'test_to_delete': 'FETCH'}
+            to_delete = model.Session.query(HarvestObject) \
+                .filter_by(guid='test_to_delete').one()
+            assert redis.zrange(consumer_fetch.inflight_key, 0, -1) == [
+                to_delete.id]
         finally:
             redis.flushdb()
 
@@ -2,6 +2,7 @@
 (redis/rabbitmq)
 '''
 import json
+from unittest.mock import Mock
 
 import pytest
 
@@ -9,7 +10,8 @@ from ckan import model
 from ckan import plugins as p
 from ckan.plugins import toolkit
 
-from ckanext.harvest.tests.factories import (HarvestObjectObj)
+from ckanext.harvest import queue
+from ckanext.harvest.tests.factories import (HarvestObjectObj, HarvestJobObj)
 from ckanext.harvest.interfaces import IHarvester
 import ckanext.harvest.model as harvest_model
 from ckanext.harvest.tests.lib import run_harvest
@@ -101,6 +103,26 @@ class TestEndStates(object):
         assert result['report_status'] == 'added'
         assert result['errors'] == []
 
+    @pytest.mark.parametrize('commit_mode', ['stage', 'object'])
+    def test_create_dataset_commit_modes(self, commit_mode, ckan_config,
+                                         monkeypatch):
+        monkeypatch.setitem(
+            ckan_config, 'ckan.harvest.fetch_commit_mode', commit_mode)
+        guid = 'obj-create'
+        MockHarvester._set_test_params(guid=guid)
+
+        results_by_guid = run_harvest(
+            url='http://some-url.com',
+            harvester=MockHarvester())
+
+        result = results_by_guid[guid]
+        assert result['state'] == 'COMPLETE'
+        assert result['report_status'] == 'added'
+        obj = harvest_model.HarvestObject.get(result['obj_id'])
+        model.Session.refresh(obj)
+        assert obj.state == 'COMPLETE'
+        assert obj.fetch_started and obj.import_finished
+
     def test_update_dataset(self):
         guid = 'obj-update'
         MockHarvester._set_test_params(guid=guid)
@@ -119,6 +141,51 @@ class TestEndStates(object):
         assert result['report_status'] == 'updated'
         assert result['errors'] == []
 
+    def test_update_dataset_unchanged_content(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(
+            ckan_config, 'ckan.harvest.skip_unchanged_content', 'true')
+        guid = 'obj-unchanged-content'
+        MockHarvester._set_test_params(guid=guid)
+
+        first = run_harvest(
+            url='http://some-url.com',
+            harvester=MockHarvester())[guid]
+        # the content is the same, so it isn't imported again
+        results_by_guid = run_harvest(
+            url='http://some-url.com',
+            harvester=MockHarvester())
+
+        result = results_by_guid[guid]
+        assert result['state'] == 'COMPLETE'
+        assert result['report_status'] == 'not modified'
+        assert result['errors'] == []
+        obj = harvest_model.HarvestObject.get(result['obj_id'])
+        assert obj.content_hash == \
+            harvest_model.HarvestObject.get(first['obj_id']).content_hash
+        assert not obj.current
+        assert not obj.import_started
+
+    def test_update_dataset_unchanged_content_forced(self, ckan_config,
+                                                     monkeypatch):
+        monkeypatch.setitem(
+            ckan_config, 'ckan.harvest.skip_unchanged_content', 'true')
+        guid = 'obj-unchanged-content-forced'
+        MockHarvester._set_test_params(guid=guid)
+
+        run_harvest(
+            url='http://some-url.com',
+            harvester=MockHarvester())
+        # as harvest_objects_import does, when forcing the import
+        harvester = MockHarvester()
+        monkeypatch.setattr(harvester, 'force_import', True, raising=False)
+        results_by_guid = run_harvest(
+            url='http://some-url.com',
+            harvester=harvester)
+
+        result = results_by_guid[guid]
+        assert result['state'] == 'COMPLETE'
+        assert result['report_status'] == 'updated'
+
     def test_delete_dataset(self):
         guid = 'obj-delete'
         MockHarvester._set_test_params(guid=guid)
@@ -176,3 +243,97 @@ class TestEndStates(object):
         assert result['state'] == 'COMPLETE'
         assert result['report_status'] == 'not modified'
         assert result['errors'] == []
+
+
+class IterGatherHarvester(object):
+    def __init__(self, items):
+        self.items = items
+
+    def gather_stage(self, harvest_job):
+        raise AssertionError('iter_gather_stage should be called instead')
+
+    def iter_gather_stage(self, harvest_job):
+        for item in self.items:
+            yield item
+
+
+@pytest.mark.usefixtures('with_plugins', 'clean_db')
+class TestIterGatherStage(object):
+
+    def test_generator(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(
+            ckan_config, 'ckan.harvest.mq.publish_batch_size', '2')
+        harvester = IterGatherHarvester(['a', 'b', 'c', ['d', 'e'], 'f'])
+        job = HarvestJobObj()
+
+        batches = list(queue.iter_gather_stage(harvester, job))
+
+        assert batches == [['a', 'b'], ['c'], ['d', 'e'], ['f']]
+        assert job.gather_finished
+
+    def test_generator_failed(self):
+        harvester = IterGatherHarvester(['a', None, 'b'])
+
+        batches = list(queue.iter_gather_stage(harvester, HarvestJobObj()))
+
+        assert batches == [['a'], None]
+
+    def test_generator_failed_finishes_gather(self):
+        harvester = IterGatherHarvester(['a', None, 'b'])
+        job = HarvestJobObj()
+
+        assert queue.gather_stage(harvester, job) is None
+
+        # the generator is closed, not left suspended
+        assert job.gather_finished
+
+    def test_list(self):
+        harvester = Mock()
+        harvester.gather_stage.return_value = ['a', 'b']
+
+        assert queue.gather_stage(harvester, HarvestJobObj()) == ['a', 'b']
+
+    def test_failed(self):
+        harvester = Mock()
+        harvester.gather_stage.return_value = None
+
+        assert queue.gather_stage(harvester, HarvestJobObj()) is None
+
+
+class TestDeferIndexCommits(object):
+
+    def test_off_by_default(self):
+        with queue.defer_index_commits() as index_commits:
+            assert index_commits is None
+            assert queue._index_commits is None
+
+    def test_batches(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(
+            ckan_config, 'ckan.harvest.index_commit_batch_size', '2')
+        solr_commit = ckan_config.get('ckan.search.solr_commit')
+        commit = Mock()
+        monkeypatch.setattr(queue.search, 'commit', commit)
+
+        with queue.defer_index_commits() as index_commits:
+            assert queue._index_commits is index_commits
+            assert ckan_config['ckan.search.solr_commit'] is False
+            for _ in range(3):
+                index_commits.imported()
+            assert commit.call_count == 1
+
+        # the last object is committed when the consumer stops
+        assert commit.call_count == 2
+        assert queue._index_commits is None
+        assert ckan_config.get('ckan.search.solr_commit') == solr_commit
+
+    def test_unset_option_restored(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(
+            ckan_config, 'ckan.harvest.index_commit_batch_size', '2')
+        monkeypatch.delitem(
+            ckan_config, 'ckan.search.solr_commit', raising=False)
+        monkeypatch.setattr(queue.search, 'commit', Mock())
+
+        with queue.defer_index_commits():
+            assert ckan_config['ckan.search.solr_commit'] is False
+
+        assert 'ckan.search.solr_commit' not in ckan_config
@@ -236,6 +236,59 @@ def purge_queues():
     purge()
 
 
+def list_dead_letters(limit):
+    from ckanext.harvest.queue import get_dead_letters
+
+    dead_letters = get_dead_letters()
+    records = dead_letters.list(limit)
+    dead_letters.close()
+    output = StringIO()
+    for record in records:
+        _print_dead_letter(record, output)
+    print(_there_are("dead letter", records, "listed"), file=output)
+    return output.getvalue()
+
+
+def _print_dead_letter(record, output):
+    last_error = record.get("last_error") or {}
+    print(
+        ("Object id: {}\n"
+         "\tjob: {}\n"
+         "\tsource: {}\n"
+         "\tattempts: {}\n"
+         "\tgathered: {}\n"
+         "\tfetch started: {}\n"
+         "\tdead lettered: {}\n"
+         "\tlast error: {} {}").format(
+             record.get("harvest_object_id"),
+             record.get("harvest_job_id"),
+             record.get("harvest_source_id"),
+             record.get("attempts"),
+             record.get("gathered"),
+             record.get("fetch_started"),
+             record.get("dead_lettered"),
+             last_error.get("time", ""),
+             last_error.get("error", ""),
+         ),
+        file=output,
+    )
+
+
+def replay_dead_letters(limit):
+    from ckanext.harvest.queue import replay_dead_letters as replay
+
+    return replay(limit)
+
+
+def purge_dead_letters():
+    from ckanext.harvest.queue import get_dead_letters
+
+    dead_letters = get_dead_letters()
+    count = dead_letters.purge()
+    dead_letters.close()
+    return count
+
+
 def list_sources(all):
     if all:
         data_dict = {}
@@ -324,21 +377,85 @@ def gather_consumer():
         gather_callback(consumer, method, header, body)
 
 
-def fetch_consumer():
+def fetch_consumer(workers=1, processes=1, async_fetches=0, batch_size=1):
     import logging
 
     logging.getLogger("amqplib").setLevel(logging.INFO)
+    if processes > 1:
+        _run_in_processes(
+            lambda: _fetch_consumer(workers, async_fetches, batch_size),
+            processes)
+    else:
+        _fetch_consumer(workers, async_fetches, batch_size)
+
+
+def _fetch_consumer(workers, async_fetches, batch_size):
+    from ckanext.harvest.queue import defer_index_commits
+
+    with defer_index_commits():
+        _consume_fetch_queue(workers, async_fetches, batch_size)
+
+
+def _consume_fetch_queue(workers, async_fetches, batch_size):
     from ckanext.harvest.queue import (
         get_fetch_consumer,
         fetch_callback,
+        fetch_batch_callback,
         get_fetch_queue_name,
+        consume_with_workers,
+        consume_async,
+        consume_batches,
     )
 
     consumer = get_fetch_consumer()
+    if batch_size > 1:
+        for messages in consume_batches(
+                consumer, get_fetch_queue_name(), batch_size):
+            fetch_batch_callback(consumer, messages)
+        return
+    if async_fetches:
+        consume_async(consumer, get_fetch_queue_name(), async_fetches)
+        return
+    if workers > 1:
+        consume_with_workers(
+            consumer, get_fetch_queue_name(), fetch_callback, workers)
+        return
     for method, header, body in consumer.consume(queue=get_fetch_queue_name()):
         fetch_callback(consumer, method, header, body)
 
 
+def _run_in_processes(target, processes):
+    """Runs ``target`` in ``processes`` forked processes.
+
+    Consumers only stop on errors, so as soon as one of them exits the rest
+    are stopped too, and this exits with the same code, so the process
+    manager (e.g. supervisor) can restart all of them.
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait
+
+    # Don't share the parent's database connections with the children
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+    context = multiprocessing.get_context("fork")
+    children = [context.Process(target=target) for _ in range(processes)]
+    for child in children:
+        child.start()
+    try:
+        exited = wait([child.sentinel for child in children])
+    finally:
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+        for child in children:
+            child.join()
+    first = next(child for child in children if child.sentinel in exited)
+    log.error("Fetch consumer process %s exited with code %s, stopping",
+              first.pid, first.exitcode)
+    sys.exit(first.exitcode or 1)
+
+
 def run_harvester():
     context = {
         "model": model,
@@ -463,6 +580,14 @@ def reindex():
     tk.get_action("harvest_sources_reindex")(context, {})
 
 
+def search_index_rebuild(only_missing=False, force=False):
+    import ckan.lib.search as search
+    from ckanext.harvest.plugin import index_prefetch
+
+    with index_prefetch():
+        search.rebuild(only_missing=only_missing, force=force)
+
+
 def clean_harvest_log():
     from datetime import datetime, timedelta
     from ckantoolkit import config
@@ -476,6 +601,13 @@ def clean_harvest_log():
     clean_harvest_log(condition=condition)
 
 
+def reconcile_job_stats(job_id=None):
+    from ckanext.harvest.model import reconcile_job_stats
+
+    count = reconcile_job_stats([job_id] if job_id else None)
+    return "Counted the stats of {0} jobs".format(count)
+
+
 def harvesters_info():
     harvesters_info = tk.get_action("harvesters_info_show")()
     return harvesters_info